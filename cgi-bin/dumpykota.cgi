@@ -244,6 +244,7 @@ if __name__ == "__main__" :
                 "format" : "cups",
                 "sum" : None,
                 "orderby" : None,
+                "groupby" : None,
               }
     admin.arguments = []
     admin.guiAction()
@@ -69,7 +69,9 @@ CREATE TABLE users (id INT4 PRIMARY KEY NOT NULL AUTO_INCREMENT,
 CREATE TABLE groups (id INT4 PRIMARY KEY NOT NULL AUTO_INCREMENT,
                     groupname VARCHAR(255) UNIQUE NOT NULL,
                     description TEXT,
-                    limitby VARCHAR(30) DEFAULT 'quota') TYPE=INNODB;
+                    limitby VARCHAR(30) DEFAULT 'quota',
+                    balance FLOAT DEFAULT 0.0,
+                    lifetimepaid FLOAT DEFAULT 0.0) TYPE=INNODB;
                     
 --
 -- Create the printers table
@@ -143,6 +145,8 @@ CREATE TABLE grouppquota(id INT8 PRIMARY KEY NOT NULL AUTO_INCREMENT,
                          hardlimit INT4,
                          maxjobsize INT4,
                          datelimit DATETIME,
+                         pagecounter INT4 DEFAULT 0,
+                         lifepagecounter INT4 DEFAULT 0,
                          INDEX (groupid),
                          FOREIGN KEY (groupid) REFERENCES groups(id),
                          INDEX (printerid),
@@ -62,7 +62,9 @@ CREATE TABLE users(id SERIAL PRIMARY KEY NOT NULL,
 CREATE TABLE groups(id SERIAL PRIMARY KEY NOT NULL,
                     groupname TEXT UNIQUE NOT NULL,
                     description TEXT,
-                    limitby TEXT DEFAULT 'quota');
+                    limitby TEXT DEFAULT 'quota',
+                    balance FLOAT DEFAULT 0.0,
+                    lifetimepaid FLOAT DEFAULT 0.0);
                     
 --
 -- Create the printers table
@@ -130,7 +132,9 @@ CREATE TABLE grouppquota(id SERIAL PRIMARY KEY NOT NULL,
                          softlimit INT4,
                          hardlimit INT4,
                          maxjobsize INT4,
-                         datelimit TIMESTAMP);
+                         datelimit TIMESTAMP,
+                         pagecounter INT4 DEFAULT 0,
+                         lifepagecounter INT4 DEFAULT 0);
 CREATE INDEX grouppquota_g_id_ix ON grouppquota (groupid);
 CREATE INDEX grouppquota_p_id_ix ON grouppquota (printerid);
 CREATE UNIQUE INDEX grouppquota_up_id_ix ON grouppquota (groupid, printerid);
@@ -0,0 +1,50 @@
+--
+-- PyKota - Print Quotas for CUPS and LPRng
+--
+-- (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+-- This program is free software; you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation; either version 2 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+-- 
+-- You should have received a copy of the GNU General Public License
+-- along with this program; if not, write to the Free Software
+-- Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+--
+-- $Id$
+--
+--
+--
+-- This script has to be used if you already
+-- have a pre-1.27 version of PyKota to upgrade
+-- your database schema. 
+--
+-- YOU DON'T NEED TO USE IT IF YOU'VE JUST INSTALLED PYKOTA
+--
+                        
+--                         
+-- Modify the old database schema
+--
+ALTER TABLE groups ADD COLUMN balance FLOAT;
+ALTER TABLE groups ALTER COLUMN balance SET DEFAULT 0.0;
+ALTER TABLE groups ADD COLUMN lifetimepaid FLOAT;
+ALTER TABLE groups ALTER COLUMN lifetimepaid SET DEFAULT 0.0;
+ALTER TABLE grouppquota ADD COLUMN pagecounter INT4;
+ALTER TABLE grouppquota ALTER COLUMN pagecounter SET DEFAULT 0;
+ALTER TABLE grouppquota ADD COLUMN lifepagecounter INT4;
+ALTER TABLE grouppquota ALTER COLUMN lifepagecounter SET DEFAULT 0;
+
+--
+-- Now computes the groups' balances and page counters,
+-- which used to be computed each time they were read.
+-- 'pkcounters --rebuild' does the same.
+--
+UPDATE groups SET balance=(SELECT COALESCE(SUM(balance), 0.0) FROM users WHERE id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id)),
+                  lifetimepaid=(SELECT COALESCE(SUM(lifetimepaid), 0.0) FROM users WHERE id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id));
+UPDATE grouppquota SET pagecounter=(SELECT COALESCE(SUM(pagecounter), 0) FROM userpquota WHERE printerid=grouppquota.printerid AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=grouppquota.groupid)),
+                       lifepagecounter=(SELECT COALESCE(SUM(lifepagecounter), 0) FROM userpquota WHERE printerid=grouppquota.printerid AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=grouppquota.groupid));
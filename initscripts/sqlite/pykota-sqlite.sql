@@ -45,7 +45,9 @@ CREATE TABLE users(id INTEGER PRIMARY KEY NOT NULL,
 CREATE TABLE groups(id INTEGER PRIMARY KEY NOT NULL,
                     groupname TEXT UNIQUE NOT NULL,
                     description TEXT,
-                    limitby TEXT DEFAULT 'quota');
+                    limitby TEXT DEFAULT 'quota',
+                    balance FLOAT DEFAULT 0.0,
+                    lifetimepaid FLOAT DEFAULT 0.0);
                     
 --
 -- Create the printers table
@@ -113,7 +115,9 @@ CREATE TABLE grouppquota(id INTEGER PRIMARY KEY NOT NULL,
                          softlimit INT4,
                          hardlimit INT4,
                          maxjobsize INT4,
-                         datelimit TEXT);
+                         datelimit TEXT,
+                         pagecounter INT4 DEFAULT 0,
+                         lifepagecounter INT4 DEFAULT 0);
 CREATE INDEX grouppquota_g_id_ix ON grouppquota (groupid);
 CREATE INDEX grouppquota_p_id_ix ON grouppquota (printerid);
 CREATE UNIQUE INDEX grouppquota_up_id_ix ON grouppquota (groupid, printerid);
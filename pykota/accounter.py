@@ -26,7 +26,9 @@
 
 import sys
 import os
-import imp
+
+from pykota.plugins import loadPlugin
+from pykota.sizecache import JobSizeCache, PyKotaSizeCacheError
 
 class PyKotaAccounterError(Exception):
     """An exception for Accounter related stuff."""
@@ -87,6 +89,34 @@ class AccounterBase :
         except AttributeError :    
             return 0
         
+    def openJobSizeCache(self) :    
+        """Returns the cache of already computed job sizes, or None if disabled."""
+        directory = self.filter.config.getJobSizeCache()
+        if (directory is None) or not getattr(self.filter, "JobMD5Sum", None) :
+            return None
+        try :
+            return JobSizeCache(directory, self.filter.config.getJobSizeCacheSize())
+        except PyKotaSizeCacheError, msg :    
+            self.filter.printInfo(msg, "warn")
+            return None
+            
+    def getCachedJobSize(self, accountername) :    
+        """Returns (jobsize, inkusage) already computed for the same datas by the same accounter, or None."""
+        cache = self.openJobSizeCache()
+        if cache is not None :
+            cached = cache.get((self.filter.JobMD5Sum, accountername, self.arguments))
+            if cached is not None :
+                self.filter.logdebug("Job size cache told us that job is %s pages long." % cached[0])
+                return cached
+        return None
+        
+    def cacheJobSize(self, accountername, jobsize, inkusage=[]) :    
+        """Remembers the job's size and ink usage for the next jobs with the same datas."""
+        if jobsize :
+            cache = self.openJobSizeCache()
+            if cache is not None :
+                cache.put((self.filter.JobMD5Sum, accountername, self.arguments), jobsize, inkusage)
+        
     def computeJobSize(self) :    
         """Must be overriden in children classes."""
         raise RuntimeError, "AccounterBase.computeJobSize() must be overriden !"
@@ -98,10 +128,7 @@ def openAccounter(kotafilter, ispreaccounter=0) :
     else :
         (backend, args) = kotafilter.config.getAccounterBackend(kotafilter.PrinterName)
     try :
-        accounterbackend = imp.load_source("accounterbackend", 
-                                            os.path.join(os.path.dirname(__file__),
-                                                         "accounters",
-                                                         "%s.py" % backend.lower()))
+        accounterbackend = loadPlugin("accounter", backend)
     except ImportError :
         raise PyKotaAccounterError, _("Unsupported accounter backend %s") % backend
     else :    
@@ -22,12 +22,9 @@
 #
 #
 
-import os
-import signal
-import popen2
-
 from pykota.accounter import AccounterBase, PyKotaAccounterError
 from pykota.accounters import snmp, pjl
+from pykota.workers import runCommand, getCoProcess, PyKotaWorkerError
 
 class Accounter(AccounterBase) :
     def __init__(self, kotabackend, arguments, ispreaccounter=0) :
@@ -103,6 +100,21 @@ class Accounter(AccounterBase) :
                 jobsize = 1
         return jobsize
         
+    def isCancelled(self) :    
+        """Returns True if the current job was cancelled, else False."""
+        return getattr(self.filter, "gotSigTerm", 0)
+        
+    def askCoProcess(self, commandline, printer, timeout) :    
+        """Asks a co-process for the page counter of a printer, returns its answer or None."""
+        try :
+            coprocess = getCoProcess(commandline)
+            answer = coprocess.query(printer, timeout)
+        except (OSError, PyKotaWorkerError), msg :    
+            self.filter.printInfo(_("Unable to query printer %s via co-process %s : %s") % (printer, commandline, msg), "warn")
+            return None
+        self.filter.logdebug("Co-process %s answered %s queries in %.3f seconds." % (commandline, coprocess.queries, coprocess.elapsed))
+        return answer
+        
     def askPrinterPageCounter(self, printer) :
         """Returns the page counter from the printer via an external command.
         
@@ -112,27 +124,34 @@ class Accounter(AccounterBase) :
         commandline = self.arguments.strip() % locals()
         cmdlower = commandline.lower()
         if (cmdlower == "snmp") or cmdlower.startswith("snmp:") :
+            if hasattr(getattr(self.filter, "session", None), "getPrinterSample") \
+               and self.filter.config.getSNMPPollInterval() :
+                # pykotad polls the printer for us
+                return snmp.PolledHandler(self, printer, skipinitialwait).retrieveInternalPageCounter()
             return snmp.Handler(self, printer, skipinitialwait).retrieveInternalPageCounter()
         elif (cmdlower == "pjl") or cmdlower.startswith("pjl:") :
             return pjl.Handler(self, printer, skipinitialwait).retrieveInternalPageCounter()
             
         if printer is None :
             raise PyKotaAccounterError, _("Unknown printer address in HARDWARE(%s) for printer %s") % (commandline, self.filter.PrinterName)
+        timeout = self.filter.config.getPrinterAccounterTimeout(self.filter.PrinterName)
         while 1 :    
-            self.filter.printInfo(_("Launching HARDWARE(%s)...") % commandline)
             pagecounter = None
-            child = popen2.Popen4(commandline)    
-            try :
-                answer = child.fromchild.read()
-            except IOError :    
-                # we were interrupted by a signal, certainely a SIGTERM
-                # caused by the user cancelling the current job
-                try :
-                    os.kill(child.pid, signal.SIGTERM)
-                except :    
-                    pass # already killed ?
-                self.filter.printInfo(_("SIGTERM was sent to hardware accounter %s (pid: %s)") % (commandline, child.pid))
+            if cmdlower.startswith("coprocess:") :
+                answer = self.askCoProcess(commandline[10:].strip(), printer, timeout)
             else :    
+                self.filter.printInfo(_("Launching HARDWARE(%s)...") % commandline)
+                command = runCommand(commandline, timeout=timeout, stopped=self.isCancelled)
+                if command.interrupted :
+                    # we were interrupted by a signal, certainely a SIGTERM
+                    # caused by the user cancelling the current job
+                    self.filter.printInfo(_("SIGTERM was sent to hardware accounter %s (pid: %s)") % (commandline, command.pid))
+                elif command.timedout :    
+                    self.filter.printInfo(_("Hardware accounter %s killed after %s seconds") % (commandline, timeout), "warn")
+                self.filter.printInfo(_("Hardware accounter %s exit code is %s") % (self.arguments, str(command.exitCode())))
+                self.filter.logdebug("Hardware accounter %s ran for %.3f seconds." % (commandline, command.elapsed))
+                answer = command.output
+            if answer is not None :    
                 lines = [l.strip() for l in answer.split("\n")]
                 for i in range(len(lines)) : 
                     try :
@@ -141,16 +160,6 @@ class Accounter(AccounterBase) :
                         self.filter.printInfo(_("Line [%s] skipped in accounter's output. Trying again...") % lines[i])
                     else :    
                         break
-            child.fromchild.close()    
-            child.tochild.close()
-            try :
-                status = child.wait()
-            except OSError, msg :    
-                self.filter.logdebug("Error while waiting for hardware accounter pid %s : %s" % (child.pid, msg))
-            else :    
-                if os.WIFEXITED(status) :
-                    status = os.WEXITSTATUS(status)
-                self.filter.printInfo(_("Hardware accounter %s exit code is %s") % (self.arguments, str(status)))
                 
             if pagecounter is None :
                 message = _("Unable to query printer %s via HARDWARE(%s)") % (printer, commandline)
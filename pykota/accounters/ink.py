@@ -24,7 +24,16 @@
 
 import os
 from pykota.accounter import AccounterBase, PyKotaAccounterError
+from pykota.workers import runWorkers
+from pykota.accounters.software import computeJobSize
 
+def computeInkCoverage(infile, options) :
+    """Returns the job's colorspace and the ink coverage of each page."""
+    from pkpgpdls import analyzer
+    try :
+        return analyzer.PDLAnalyzer(infile, options).getInkCoverage()
+    finally :
+        infile.close()
 
 class Accounter(AccounterBase) :
     cspaceExpanded = {
@@ -58,6 +67,16 @@ class Accounter(AccounterBase) :
         except ValueError :    
             raise PyKotaAccounterError, "Invalid parameters for ink accounter : [%s]" % self.arguments
             
+        cached = self.getCachedJobSize("ink")
+        if cached is not None :
+            (jobsize, self.inkUsage) = cached
+            if self.filter.InputFile is not None :
+                # when a filename is passed as an argument, the backend 
+                # must generate the correct number of copies.
+                jobsize *= self.filter.Copies
+                self.inkUsage *= self.filter.Copies
+            return jobsize
+            
         self.filter.logdebug("Using internal parser to compute job's size and ink usage.")
         
         jobsize = 0
@@ -69,9 +88,12 @@ class Accounter(AccounterBase) :
                 self.filter.printInfo("Precomputed job size will be forced to 0 pages.", "error")
             else :     
                 options = analyzer.AnalyzerOptions(colorspace=colorspace, resolution=resolution)
+                timeout = self.filter.config.getPrinterPrecomputeTimeout(self.filter.PrinterName)
                 try :
-                    parser = analyzer.PDLAnalyzer(self.filter.DataFile, options)
-                    (cspace, pages) = parser.getInkCoverage()
+                    if timeout :
+                        (cspace, pages) = self.computeInParallel(options, timeout)
+                    else :    
+                        (cspace, pages) = computeInkCoverage(self.filter.openJobDatas(), options)
                 except pdlparser.PDLParserError, msg :    
                     # Here we just log the failure, but
                     # we finally ignore it and return 0 since this
@@ -79,17 +101,47 @@ class Accounter(AccounterBase) :
                     # job's size MAY be.
                     self.filter.printInfo(_("Unable to precompute the job's size and ink coverage with the generic PDL analyzer : %s") % msg, "warn")
                 else :    
-                    cspacelabels = self.cspaceExpanded[cspace]
-                    for page in pages :
-                        colordict = {}
-                        for color in page.keys() :
-                            colordict[cspacelabels[color]] = page[color]
-                        self.inkUsage.append(colordict)    
-                    jobsize = len(pages)
+                    if cspace is None :
+                        jobsize = pages # ink coverage is unknown
+                    else :    
+                        cspacelabels = self.cspaceExpanded[cspace]
+                        for page in pages :
+                            colordict = {}
+                            for color in page.keys() :
+                                colordict[cspacelabels[color]] = page[color]
+                            self.inkUsage.append(colordict)    
+                        jobsize = len(pages)
+                        self.cacheJobSize("ink", jobsize, self.inkUsage)
                     if self.filter.InputFile is not None :
                         # when a filename is passed as an argument, the backend 
                         # must generate the correct number of copies.
                         jobsize *= self.filter.Copies
                         self.inkUsage *= self.filter.Copies
                     self.filter.logdebug("Ink usage : %s ===> %s" % (cspace, repr(self.inkUsage)))
-        return jobsize        
+        return jobsize
+        
+    def computeInParallel(self, options, timeout) :    
+        """Computes the ink coverage and the number of pages at the same time in child processes.
+        
+           Returns (colorspace, pages) as the analyzer does, or (None, jobsize)
+           if the ink coverage couldn't be computed within timeout seconds.
+        """
+        from pkpgpdls import pdlparser
+        inkfile = self.filter.openJobDatas()
+        sizefile = self.filter.openJobDatas()
+        try :
+            (coverage, size) = runWorkers([(computeInkCoverage, (inkfile, options)), \
+                                           (computeJobSize, (sizefile,))], \
+                                          maxworkers=2, timeout=timeout)
+        finally :    
+            inkfile.close()
+            sizefile.close()
+        if coverage[0] == "OK" :
+            return coverage[1]
+        elif coverage[0] == "ERROR" :
+            raise pdlparser.PDLParserError, coverage[1]
+        elif size[0] == "OK" :
+            self.filter.printInfo(_("Ink coverage not computed within %s seconds, only the job's size is known.") % timeout, "warn")
+            return (None, size[1])
+        else :    
+            raise pdlparser.PDLParserError, _("Job's size not computed within %s seconds") % timeout        
@@ -25,21 +25,28 @@
 import sys
 import os
 import socket
+import select
 import errno
 import time
-import threading
-import Queue
 
 from pykota import constants
+from pykota.accounters.stabilization import Stabilizer
 
 FORMFEEDCHAR = chr(0x0c)     # Form Feed character, ends PJL answers.
 
 # Old method : pjlMessage = "\033%-12345X@PJL USTATUSOFF\r\n@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n\033%-12345X"
-# Here's a new method, which seems to work fine on my HP2300N, while the 
-# previous one didn't.
+# Then : pjlMessage = "\033%-12345X@PJL USTATUS DEVICE=ON\r\n@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n@PJL USTATUS DEVICE=OFF\033%-12345X"
+# Now the connection is kept open while we wait for the printer, with
+# unsolicited device status enabled, so that printers which support
+# it tell us as soon as their status changes.
 # TODO : We could also experiment with USTATUS JOB=ON and we would know for sure 
 # when the job is finished, without having to poll the printer repeatedly.
-pjlMessage = "\033%-12345X@PJL USTATUS DEVICE=ON\r\n@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n@PJL USTATUS DEVICE=OFF\033%-12345X"
+pjlStatusOn = "\033%-12345X@PJL USTATUS DEVICE=ON\r\n\033%-12345X"
+pjlQuery = "\033%-12345X@PJL INFO STATUS\r\n@PJL INFO PAGECOUNT\r\n\033%-12345X"
+pjlStatusOff = "\033%-12345X@PJL USTATUS DEVICE=OFF\r\n\033%-12345X"
+
+READSIZE = 4096         # maximal number of bytes read at once
+ANSWERTIMEOUT = 5.0     # number of seconds to wait for an answer before complaining
 pjlStatusValues = {
                     "10000" : "Powersave Mode",
                     "10001" : "Ready Online",
@@ -63,122 +70,143 @@ class Handler :
         except (IndexError, ValueError) :
             self.port = 9100
         self.printerInternalPageCounter = self.printerStatus = None
-        self.closed = False
         self.sock = None
-        self.queue = None
-        self.readthread = None
-        self.quitEvent = threading.Event()
+        self.buffer = ""
         
     def __del__(self) :    
         """Ensures the network connection is closed at object deletion time."""
         self.close()
         
     def open(self) :    
-        """Opens the network connection."""
+        """Opens the network connection, and asks for unsolicited status messages."""
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try :
             sock.settimeout(1.0)
             sock.connect((self.printerHostname, self.port))
+            sock.sendall(pjlStatusOn)
         except socket.error, msg :
             self.parent.filter.printInfo(_("Problem during connection to %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
+            sock.close()
             return False
         else :
             self.sock = sock
-            self.closed = False
-            self.quitEvent.clear()
-            self.queue = Queue.Queue(0)
-            self.readthread = threading.Thread(target=self.readloop)
-            self.readthread.start()
-            time.sleep(1)
+            self.buffer = ""
             self.parent.filter.logdebug("Connected to printer %s:%s" % (self.printerHostname, self.port))
             return True
         
     def close(self) :    
         """Closes the network connection."""
-        if not self.closed :
-            self.quitEvent.set()
-            if self.readthread is not None :
-                self.readthread.join()
-                self.readthread = None
-            if self.sock is not None :
-                self.sock.close()
-                self.sock = None
-            self.parent.filter.logdebug("Connection to %s:%s is now closed." % (self.printerHostname, self.port))
-            self.queue = None
-            self.closed = True
-            
-    def readloop(self) :        
-        """Reading loop thread."""
-        self.parent.filter.logdebug("Reading thread started.")
-        buffer = []
-        while not self.quitEvent.isSet() :
+        if self.sock is not None :
             try :
-                answer = self.sock.recv(1)
-            except socket.timeout :    
+                self.sock.sendall(pjlStatusOff)
+            except socket.error :    
                 pass
-            except socket.error, (err, msg) :
-                self.parent.filter.printInfo(_("Problem while receiving PJL answer from %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
-            else :    
-                if answer :
-                    buffer.append(answer)
-                    if answer.endswith(FORMFEEDCHAR) :
-                        self.queue.put("".join(buffer))
-                        buffer = []
-        if buffer :             
-            self.queue.put("".join(buffer))            
-        self.parent.filter.logdebug("Reading thread ended.")
+            self.sock.close()
+            self.sock = None
+            self.parent.filter.logdebug("Connection to %s:%s is now closed." % (self.printerHostname, self.port))
+            
+    def readAnswers(self, timeout) :        
+        """Waits at most timeout seconds for datas from the printer, and returns the complete answers received."""
+        try :
+            (readable, writable, errors) = select.select([self.sock], [], [], timeout)
+        except select.error, (err, msg) :    
+            if err == errno.EINTR :
+                return [] # probably SIGTERM
+            raise socket.error, msg
+        if not readable :
+            return []
+        data = self.sock.recv(READSIZE)
+        if not data :
+            raise socket.error, "Connection closed by printer"
+        answers = (self.buffer + data).split(FORMFEEDCHAR)
+        self.buffer = answers.pop() # incomplete answer, if any
+        return answers
+        
+    def parseAnswer(self, answer) :    
+        """Returns (status, pagecounter) extracted from a PJL answer, None for missing values."""
+        status = pagecount = None
+        readnext = False
+        self.parent.filter.logdebug("PJL answer : %s" % repr(answer))
+        for line in [l.strip() for l in answer.split()] : 
+            if line.startswith("CODE=") :
+                status = line.split("=")[1]
+                self.parent.filter.logdebug("Found status : %s" % status)
+            elif line.startswith("PAGECOUNT=") :    
+                try :
+                    pagecount = int(line.split('=')[1].strip())
+                except ValueError :    
+                    self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
+                else :
+                    self.parent.filter.logdebug("Found pages counter : %s" % pagecount)
+            elif line.startswith("PAGECOUNT") :    
+                readnext = True # page counter is on next line
+            elif readnext :    
+                try :
+                    pagecount = int(line.strip())
+                except ValueError :    
+                    self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
+                else :
+                    self.parent.filter.logdebug("Found pages counter : %s" % pagecount)
+                    readnext = False
+        return (status, pagecount)
             
     def retrievePJLValues(self) :    
         """Retrieves a printer's internal page counter and status via PJL."""
-        while not self.open() :
+        while (self.sock is None) and not self.open() :
             self.parent.filter.logdebug("Will retry in 1 second.")
             time.sleep(1)
         try :
-            try :
-                nbsent = self.sock.send(pjlMessage)
-                if nbsent != len(pjlMessage) :
-                    raise socket.error, "Short write"
-            except socket.error, msg :
-                self.parent.filter.printInfo(_("Problem while sending PJL query to %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
-            else :    
-                self.parent.filter.logdebug("Query sent to %s : %s" % (self.printerHostname, repr(pjlMessage)))
-                actualpagecount = self.printerStatus = None
-                while (actualpagecount is None) or (self.printerStatus is None) :
-                    try :
-                        answer = self.queue.get(True, 5)
-                    except Queue.Empty :    
-                        self.parent.filter.logdebug("Timeout when reading printer's answer from %s:%s" % (self.printerHostname, self.port))
-                    else :    
-                        readnext = False
-                        self.parent.filter.logdebug("PJL answer : %s" % repr(answer))
-                        for line in [l.strip() for l in answer.split()] : 
-                            if line.startswith("CODE=") :
-                                self.printerStatus = line.split("=")[1]
-                                self.parent.filter.logdebug("Found status : %s" % self.printerStatus)
-                            elif line.startswith("PAGECOUNT=") :    
-                                try :
-                                    actualpagecount = int(line.split('=')[1].strip())
-                                except ValueError :    
-                                    self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
-                                else :
-                                    self.parent.filter.logdebug("Found pages counter : %s" % actualpagecount)
-                            elif line.startswith("PAGECOUNT") :    
-                                readnext = True # page counter is on next line
-                            elif readnext :    
-                                try :
-                                    actualpagecount = int(line.strip())
-                                except ValueError :    
-                                    self.parent.filter.logdebug("Received incorrect datas : [%s]" % line.strip())
-                                else :
-                                    self.parent.filter.logdebug("Found pages counter : %s" % actualpagecount)
-                                    readnext = False
-                self.printerInternalPageCounter = max(actualpagecount, self.printerInternalPageCounter)
-        finally :        
+            self.sock.sendall(pjlQuery)
+        except socket.error, msg :
+            self.parent.filter.printInfo(_("Problem while sending PJL query to %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
             self.close()
+        else :    
+            self.parent.filter.logdebug("Query sent to %s : %s" % (self.printerHostname, repr(pjlQuery)))
+            actualpagecount = self.printerStatus = None
+            while (actualpagecount is None) or (self.printerStatus is None) :
+                try :
+                    answers = self.readAnswers(ANSWERTIMEOUT)
+                except socket.error, msg :
+                    self.parent.filter.printInfo(_("Problem while receiving PJL answer from %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
+                    self.close()
+                    break
+                if not answers :    
+                    self.parent.filter.logdebug("Timeout when reading printer's answer from %s:%s" % (self.printerHostname, self.port))
+                for answer in answers :
+                    (status, pagecount) = self.parseAnswer(answer)
+                    if status is not None :
+                        self.printerStatus = status
+                    if pagecount is not None :    
+                        actualpagecount = pagecount
+            self.printerInternalPageCounter = max(actualpagecount, self.printerInternalPageCounter)
+        
+    def pause(self, delay) :
+        """Waits at most delay seconds before checking the printer's status again.
+        
+           Returns as soon as the printer tells us its status changed.
+        """
+        deadline = time.time() + delay
+        while self.sock is not None :
+            remaining = deadline - time.time()
+            if remaining <= 0 :
+                return
+            try :
+                answers = self.readAnswers(remaining)
+            except socket.error, msg :    
+                self.parent.filter.printInfo(_("Problem while receiving PJL answer from %s:%s : %s") % (self.printerHostname, self.port, str(msg)), "warn")
+                self.close()
+                break
+            for answer in answers :
+                (status, pagecount) = self.parseAnswer(answer)
+                if (status is not None) and (status != self.printerStatus) :
+                    self.parent.filter.logdebug("Printer %s's status changed to %s" % (self.printerHostname, pjlStatusValues.get(status, status)))
+                    return
+        remaining = deadline - time.time()
+        if remaining > 0 :
+            time.sleep(remaining)
         
     def waitPrinting(self) :
         """Waits for printer status being 'printing'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
         noprintingmaxdelay = constants.get(self.parent.filter, "NoPrintingMaxDelay")
         if not noprintingmaxdelay :
             self.parent.filter.logdebug("Will wait indefinitely until printer %s is in 'printing' state." % self.parent.filter.PrinterName)
@@ -190,6 +218,7 @@ class Handler :
         while True :
             self.retrievePJLValues()
             if self.printerStatus in ('10023', '10003') :
+                self.stabilizer.printing()
                 break
             if self.printerInternalPageCounter is not None :    
                 if firstvalue is None :
@@ -218,13 +247,10 @@ class Handler :
                                 self.parent.filter.printInfo("Printer %s has probably already printed this job !!!" % self.parent.filter.PrinterName, "warn")
                             break
             self.parent.filter.logdebug(_("Waiting for printer %s to be printing...") % self.parent.filter.PrinterName)
-            time.sleep(statusstabilizationdelay)
+            self.pause(self.stabilizer.printingdelay)
         
     def waitIdle(self) :
         """Waits for printer status being 'idle'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
-        statusstabilizationloops = constants.get(self.parent.filter, "StatusStabilizationLoops")
-        idle_num = 0
         while True :
             self.retrievePJLValues()
             if self.printerStatus in ('10000', '10001', '35078', '40000') :
@@ -233,17 +259,17 @@ class Handler :
                    and (os.environ.get("PYKOTAPHASE") == "BEFORE") :
                     self.parent.filter.logdebug("No need to wait for the printer to be idle, it is the case already.")
                     return 
-                idle_num += 1
-                if idle_num >= statusstabilizationloops :
+                if self.stabilizer.idle(self.printerInternalPageCounter) :
                     # printer status is stable, we can exit
                     break
             else :    
-                idle_num = 0
+                self.stabilizer.busy()
             self.parent.filter.logdebug(_("Waiting for printer %s's idle status to stabilize...") % self.parent.filter.PrinterName)
-            time.sleep(statusstabilizationdelay)
+            self.pause(self.stabilizer.delay)
     
     def retrieveInternalPageCounter(self) :
         """Returns the page counter from the printer via internal PJL handling."""
+        self.stabilizer = Stabilizer(self.parent.filter)
         try :
             if (os.environ.get("PYKOTASTATUS") != "CANCELLED") and \
                (os.environ.get("PYKOTAACTION") == "ALLOW") and \
@@ -252,9 +278,13 @@ class Handler :
                 self.waitPrinting()
             self.waitIdle()    
         except :    
+            self.close()
             self.parent.filter.printInfo(_("PJL querying stage interrupted. Using latest value seen for internal page counter (%s) on printer %s.") % (self.printerInternalPageCounter, self.parent.filter.PrinterName), "warn")
             raise
         else :    
+            # the real backend may need to connect to the same port
+            self.close()
+            self.stabilizer.done()
             return self.printerInternalPageCounter
             
 def main(hostname) :
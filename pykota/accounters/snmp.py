@@ -34,6 +34,7 @@ import os
 import time
 import select
 import socket
+import threading
 
 try :
     from pysnmp.entity.rfc3413.oneliner import cmdgen
@@ -50,6 +51,9 @@ else :
     hasV4 = True
 
 from pykota import constants
+from pykota import metrics
+from pykota.accounters.stabilization import Stabilizer
+from pykota.daemon import PyKotaDaemonError
 
 #                      
 # Documentation taken from RFC 3805 (Printer MIB v2) and RFC 2790 (Host Resource MIB)
@@ -104,6 +108,16 @@ defaultErrorMask = 0x4fcc # [ 'No Paper',
                           
 # WARNING : some printers don't support this one :                  
 prtConsoleDisplayBufferTextOID = "1.3.6.1.2.1.43.16.5.1.2.1.1" # SNMPv2-SMI::mib-2.43.16.5.1.2.1.1
+
+# OIDs as expected by pysnmp v4, computed once
+oidTuples = [tuple([int(i) for i in oid.split('.')]) \
+                 for oid in (pageCounterOID, hrPrinterStatusOID, hrDeviceStatusOID, hrPrinterDetectedErrorStateOID)]
+
+# Shared poller's settings
+POLLERRINGSIZE = 64     # number of samples kept for each printer
+POLLEREXPIRATION = 600  # printers nobody asked about for this number of seconds aren't polled anymore
+POLLERTIMEOUT = 30.0    # maximal number of seconds to wait for a new sample
+
 class BaseHandler :
     """A class for SNMP print accounting."""
     def __init__(self, parent, printerhostname, skipinitialwait=False) :
@@ -115,6 +129,7 @@ class BaseHandler :
         except IndexError :    
             self.community = "public"
         self.port = 161
+        self.sampletime = None # when the values were sampled, None meaning just now
         self.initValues()
         
     def initValues(self) :    
@@ -164,9 +179,12 @@ class BaseHandler :
             self.parent.filter.logdebug("No error condition matching mask 0x%04x" % errormask)
             return False    
         
+    def pause(self, delay) :
+        """Waits before checking the printer's status again."""
+        time.sleep(delay)
+        
     def waitPrinting(self) :
         """Waits for printer status being 'printing'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
         noprintingmaxdelay = constants.get(self.parent.filter, "NoPrintingMaxDelay")
         if not noprintingmaxdelay :
             self.parent.filter.logdebug("Will wait indefinitely until printer %s is in 'printing' state." % self.parent.filter.PrinterName)
@@ -178,6 +196,7 @@ class BaseHandler :
             self.retrieveSNMPValues()
             statusAsString = printerStatusValues.get(self.printerStatus)
             if statusAsString in ('printing', 'warmup') :
+                self.stabilizer.printing(self.sampletime)
                 break
             if self.printerInternalPageCounter is not None :    
                 if firstvalue is None :
@@ -212,13 +231,11 @@ class BaseHandler :
                                 self.parent.filter.printInfo("Printer %s has probably already printed this job !!!" % self.parent.filter.PrinterName, "warn")
                             break
             self.parent.filter.logdebug(_("Waiting for printer %s to be printing...") % self.parent.filter.PrinterName)    
-            time.sleep(statusstabilizationdelay)
+            self.pause(self.stabilizer.printingdelay)
         
     def waitIdle(self) :
         """Waits for printer status being 'idle'."""
-        statusstabilizationdelay = constants.get(self.parent.filter, "StatusStabilizationDelay")
-        statusstabilizationloops = constants.get(self.parent.filter, "StatusStabilizationLoops")
-        idle_num = idle_flag = 0
+        idle_flag = 0
         while 1 :
             self.retrieveSNMPValues()
             pstatusAsString = printerStatusValues.get(self.printerStatus)
@@ -235,17 +252,18 @@ class BaseHandler :
                    and (os.environ.get("PYKOTAPHASE") == "BEFORE") :
                     self.parent.filter.logdebug("No need to wait for the printer to be idle, it is the case already.")
                     return 
-                idle_num += 1
-                if idle_num >= statusstabilizationloops :
+                if self.stabilizer.idle(self.printerInternalPageCounter, self.sampletime) :
                     # printer status is stable, we can exit
                     break
             else :    
-                idle_num = 0
+                self.stabilizer.busy(self.sampletime)
             self.parent.filter.logdebug(_("Waiting for printer %s's idle status to stabilize...") % self.parent.filter.PrinterName)    
-            time.sleep(statusstabilizationdelay)
+            self.pause(self.stabilizer.delay)
             
     def retrieveInternalPageCounter(self) :
         """Returns the page counter from the printer via internal SNMP handling."""
+        self.stabilizer = Stabilizer(self.parent.filter)
+        started = time.time()
         try :
             if (os.environ.get("PYKOTASTATUS") != "CANCELLED") and \
                (os.environ.get("PYKOTAACTION") == "ALLOW") and \
@@ -256,21 +274,24 @@ class BaseHandler :
         except :    
             self.parent.filter.printInfo(_("SNMP querying stage interrupted. Using latest value seen for internal page counter (%s) on printer %s.") % (self.printerInternalPageCounter, self.parent.filter.PrinterName), "warn")
             raise
+        self.stabilizer.done()
+        metrics.observe("pykota_snmp_wait_seconds", time.time() - started, printer=self.parent.filter.PrinterName)
         return self.printerInternalPageCounter
             
 if hasV4 :            
     class Handler(BaseHandler) :
         """A class for pysnmp v4.x"""
+        generator = None
+        
         def retrieveSNMPValues(self) :
             """Retrieves a printer's internal page counter and status via SNMP."""
+            if self.generator is None :
+                self.generator = cmdgen.CommandGenerator()
             try :
                 errorIndication, errorStatus, errorIndex, varBinds = \
-                 cmdgen.CommandGenerator().getCmd(cmdgen.CommunityData("pykota", self.community, 0), \
+                 self.generator.getCmd(cmdgen.CommunityData("pykota", self.community, 0), \
                                                   cmdgen.UdpTransportTarget((self.printerHostname, self.port)), \
-                                                  tuple([int(i) for i in pageCounterOID.split('.')]), \
-                                                  tuple([int(i) for i in hrPrinterStatusOID.split('.')]), \
-                                                  tuple([int(i) for i in hrDeviceStatusOID.split('.')]), \
-                                                  tuple([int(i) for i in hrPrinterDetectedErrorStateOID.split('.')]))
+                                                  *oidTuples)
             except socket.gaierror, msg :                                      
                 errorIndication = repr(msg)
             except :                                      
@@ -351,6 +372,148 @@ else :
                         else :    
                             return 1
                     
+class PolledHandler(Handler) :                    
+    """A class for SNMP print accounting through pykotad's shared poller.
+    
+       The printer's state is read from the samples taken by pykotad.
+       Two checks use samples taken at least the status stabilization
+       delay apart, as if we had slept between them, and when the job
+       didn't begin yet the printer's states sampled just before can
+       prove its idleness already.
+    """
+    def __init__(self, parent, printerhostname, skipinitialwait=False) :
+        Handler.__init__(self, parent, printerhostname, skipinitialwait)
+        self.session = self.parent.filter.session
+        self.lastsample = time.time() # the next sample must be taken after this time
+        if os.environ.get("PYKOTAPHASE") == "BEFORE" :
+            loops = constants.get(self.parent.filter, "StatusStabilizationLoops")
+            delay = constants.get(self.parent.filter, "StatusStabilizationDelay")
+            self.lastsample -= loops * delay
+        
+    def pause(self, delay) :
+        """Makes the next check use a sample taken at least delay seconds after the current one."""
+        if self.session is None :
+            Handler.pause(self, delay)
+        else :    
+            self.lastsample += delay
+        
+    def retrieveSNMPValues(self) :    
+        """Retrieves the first printer's internal page counter and status sampled after the previous ones."""
+        if self.session is None :
+            return Handler.retrieveSNMPValues(self)
+        try :
+            sample = self.session.getPrinterSample(self.printerHostname, self.community, self.lastsample, POLLERTIMEOUT)
+        except PyKotaDaemonError, msg :    
+            self.parent.filter.printInfo(_("%s : SNMP queries on printer %s will be done directly.") % (msg, self.printerHostname), "warn")
+            self.session = None
+            self.sampletime = None
+            return Handler.retrieveSNMPValues(self)
+        if sample is None :
+            self.parent.filter.printInfo(_("No SNMP answer from printer %s within %i seconds.") % (self.printerHostname, POLLERTIMEOUT), "warn")
+            self.sampletime = None
+            self.initValues()
+            return
+        (self.lastsample, pagecounter, printerstatus, devicestatus, errorstate) = sample
+        self.sampletime = self.lastsample
+        if pagecounter is None :
+            self.initValues()
+        else :    
+            self.printerInternalPageCounter = max(self.printerInternalPageCounter, pagecounter)
+            self.printerStatus = printerstatus
+            self.deviceStatus = devicestatus
+            self.printerDetectedErrorState = errorstate
+            self.parent.filter.logdebug("SNMP sample read : PageCounter : %s  PrinterStatus : '%s'  DeviceStatus : '%s'  PrinterErrorState : '%s'" \
+                 % (self.printerInternalPageCounter, \
+                    printerStatusValues.get(self.printerStatus), \
+                    deviceStatusValues.get(self.deviceStatus), \
+                    self.printerDetectedErrorState))
+                    
+class PrinterWatch(threading.Thread) :
+    """Samples the state of a single printer for the shared poller."""
+    def __init__(self, poller, hostname, community) :
+        """Initializes the printer's sampling."""
+        threading.Thread.__init__(self, name="snmp-%s" % hostname)
+        self.setDaemon(True)
+        self.poller = poller
+        self.key = (hostname, community)
+        self.arguments = "snmp:%s" % community  # for Handler
+        self.filter = poller.tool               # for Handler
+        self.handler = Handler(self, hostname)
+        self.samples = []
+        self.lastrequest = time.time()
+        
+    def run(self) :
+        """Samples the printer's state until nobody asks for it anymore."""
+        poller = self.poller
+        handler = self.handler
+        while True :
+            handler.initValues()
+            handler.retrieveSNMPValues()
+            sample = (time.time(), \
+                      handler.printerInternalPageCounter, \
+                      handler.printerStatus, \
+                      handler.deviceStatus, \
+                      handler.printerDetectedErrorState)
+            poller.condition.acquire()
+            try :
+                poller.samples += 1
+                self.samples.append(sample)
+                if len(self.samples) > POLLERRINGSIZE :
+                    del self.samples[0]
+                poller.condition.notifyAll()
+                if (sample[0] - self.lastrequest) > POLLEREXPIRATION :
+                    del poller.watches[self.key]
+                    return
+            finally :        
+                poller.condition.release()
+            time.sleep(poller.interval)
+            
+class SNMPPoller :
+    """Samples the state of all the printers pykotad is asked about, one thread per printer."""
+    def __init__(self, tool, interval) :
+        """Initializes the poller, which doesn't poll anything yet."""
+        self.tool = tool
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.watches = {}
+        self.samples = 0
+        self.requests = 0
+        self.waits = 0
+        
+    def getSample(self, hostname, community, since, timeout) :
+        """Returns the first sample of a printer's state taken after since, or None after timeout seconds.
+        
+           A sample is a tuple (time, pagecounter, printerstatus, devicestatus, errorstates),
+           whose last four values are None if the printer didn't answer.
+        """
+        deadline = time.time() + timeout
+        key = (hostname, community)
+        self.condition.acquire()
+        try :
+            self.requests += 1
+            watch = self.watches.get(key)
+            if watch is None :
+                self.tool.logdebug("Starting to poll printer %s" % hostname)
+                watch = self.watches[key] = PrinterWatch(self, hostname, community)
+                watch.start()
+            while True :
+                watch.lastrequest = time.time()
+                for sample in watch.samples :
+                    if sample[0] > since :
+                        return sample
+                remaining = deadline - time.time()
+                if remaining <= 0 :
+                    return None
+                self.waits += 1
+                self.condition.wait(remaining)
+        finally :        
+            self.condition.release()
+            
+    def dumpStatistics(self, output) :        
+        """Outputs the poller's statistics."""
+        output("SNMP poller : %i printers polled every %.2f seconds, %i samples taken, %i requests, %i waits" \
+                   % (len(self.watches), self.interval, self.samples, self.requests, self.waits))
+        
 def main(hostname) :
     """Tries SNMP accounting for a printer host."""
     class fakeFilter :
@@ -0,0 +1,338 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota - Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module sends SNMP v1 GET requests to many printers at once.
+
+All the requests are sent from a single UDP socket and their answers
+are processed as they come, so querying hundreds of printers takes
+about as long as querying the slowest one. It doesn't need pysnmp.
+"""
+
+import sys
+import time
+import errno
+import select
+import socket
+
+# BER tags
+INTEGER = 0x02
+OCTETSTRING = 0x04
+NULL = 0x05
+OBJECTIDENTIFIER = 0x06
+SEQUENCE = 0x30
+IPADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+COUNTER64 = 0x46
+GETREQUEST = 0xa0
+GETRESPONSE = 0xa2
+UNSIGNEDTAGS = (COUNTER32, GAUGE32, TIMETICKS, COUNTER64)
+
+MAXMESSAGESIZE = 65535
+
+class PyKotaSNMPError(Exception):
+    """An exception for SNMP related stuff."""
+    def __init__(self, message = ""):
+        self.message = message
+        Exception.__init__(self, message)
+    def __repr__(self):
+        return self.message
+    __str__ = __repr__
+
+def encodeLength(length) :
+    """Returns the BER encoding of a length."""
+    if length < 0x80 :
+        return chr(length)
+    encoded = ""
+    while length :
+        encoded = chr(length & 0xff) + encoded
+        length >>= 8
+    return chr(0x80 | len(encoded)) + encoded
+
+def encodeTLV(tag, value) :
+    """Returns the BER encoding of an already encoded value."""
+    return chr(tag) + encodeLength(len(value)) + value
+
+def encodeInteger(number) :
+    """Returns the BER encoding of an integer."""
+    encoded = ""
+    while True :
+        encoded = chr(number & 0xff) + encoded
+        number >>= 8
+        if ((number == 0) and not (ord(encoded[0]) & 0x80)) \
+           or ((number == -1) and (ord(encoded[0]) & 0x80)) :
+            break
+    return encodeTLV(INTEGER, encoded)
+
+def encodeOID(oid) :
+    """Returns the BER encoding of an OID given as a dotted string."""
+    parts = [int(p) for p in oid.strip(".").split(".")]
+    encoded = chr(40 * parts[0] + parts[1])
+    for part in parts[2:] :
+        chunk = chr(part & 0x7f)
+        part >>= 7
+        while part :
+            chunk = chr(0x80 | (part & 0x7f)) + chunk
+            part >>= 7
+        encoded += chunk
+    return encodeTLV(OBJECTIDENTIFIER, encoded)
+
+def compileVarBindList(oids) :
+    """Returns the BER encoding of the variable bindings asking for a list of OIDs."""
+    return encodeTLV(SEQUENCE, "".join([encodeTLV(SEQUENCE, encodeOID(oid) + encodeTLV(NULL, "")) for oid in oids]))
+
+def decodeTLV(data, offset) :
+    """Returns (tag, value, nextoffset) for the BER encoded value at offset."""
+    try :
+        tag = ord(data[offset])
+        length = ord(data[offset+1])
+        offset += 2
+        if length & 0x80 :
+            size = length & 0x7f
+            length = 0
+            for i in range(size) :
+                length = (length << 8) | ord(data[offset+i])
+            offset += size
+    except IndexError :
+        raise PyKotaSNMPError, "Truncated SNMP message"
+    end = offset + length
+    if end > len(data) :
+        raise PyKotaSNMPError, "Truncated SNMP message"
+    return (tag, data[offset:end], end)
+
+def decodeInteger(value, signed=True) :
+    """Returns the integer BER encoded in value."""
+    number = 0
+    for char in value :
+        number = (number << 8) | ord(char)
+    if signed and value and (ord(value[0]) & 0x80) :
+        number -= 1 << (8 * len(value))
+    return number
+
+def decodeOID(value) :
+    """Returns the OID BER encoded in value as a dotted string."""
+    if not value :
+        return ""
+    first = ord(value[0])
+    parts = [str(min(first / 40, 2)), str(first - 40 * min(first / 40, 2))]
+    part = 0
+    for char in value[1:] :
+        part = (part << 7) | (ord(char) & 0x7f)
+        if not (ord(char) & 0x80) :
+            parts.append(str(part))
+            part = 0
+    return ".".join(parts)
+
+def decodeValue(tag, value) :
+    """Returns the Python value of a variable binding's value."""
+    if tag == INTEGER :
+        return decodeInteger(value)
+    elif tag in UNSIGNEDTAGS :
+        return decodeInteger(value, signed=False)
+    elif tag == OCTETSTRING :
+        return value
+    elif tag == OBJECTIDENTIFIER :
+        return decodeOID(value)
+    elif tag == IPADDRESS :
+        return ".".join([str(ord(c)) for c in value])
+    else :
+        return None # NULL, noSuchObject, noSuchInstance, endOfMibView
+
+def decodeResponse(data) :
+    """Returns (requestid, errorstatus, errorindex, values) decoded from a GetResponse message."""
+    (tag, message, end) = decodeTLV(data, 0)
+    if tag != SEQUENCE :
+        raise PyKotaSNMPError, "Not an SNMP message"
+    (tag, version, offset) = decodeTLV(message, 0)
+    (tag, community, offset) = decodeTLV(message, offset)
+    (tag, pdu, offset) = decodeTLV(message, offset)
+    if tag != GETRESPONSE :
+        raise PyKotaSNMPError, "Not an SNMP GetResponse"
+    (tag, requestid, offset) = decodeTLV(pdu, 0)
+    (tag, errorstatus, offset) = decodeTLV(pdu, offset)
+    (tag, errorindex, offset) = decodeTLV(pdu, offset)
+    (tag, varbindlist, offset) = decodeTLV(pdu, offset)
+    values = []
+    offset = 0
+    while offset < len(varbindlist) :
+        (tag, varbind, offset) = decodeTLV(varbindlist, offset)
+        (tag, oid, valueoffset) = decodeTLV(varbind, 0)
+        (tag, value, valueoffset) = decodeTLV(varbind, valueoffset)
+        values.append(decodeValue(tag, value))
+    return (decodeInteger(requestid), decodeInteger(errorstatus), decodeInteger(errorindex), values)
+
+class SNMPRequest :
+    """A GET request sent to a single printer, and its result."""
+    def __init__(self, hostname, port) :
+        """Initializes the request."""
+        self.hostname = hostname
+        self.port = port
+        self.address = None
+        self.requestid = None
+        self.attempts = 0
+        self.sent = None
+        self.deadline = None
+        self.values = None
+        self.error = None
+        self.latency = None
+
+class SNMPEngine :
+    """Sends the same SNMP v1 GET request to many printers at once.
+
+       Each printer is given timeout seconds to answer, and the request
+       is sent again up to retries times if it doesn't. At most window
+       requests are waiting for an answer at the same time.
+    """
+    def __init__(self, timeout=2.0, retries=1, window=256) :
+        """Initializes the engine."""
+        self.timeout = timeout
+        self.retries = retries
+        self.window = window
+        self.nextrequestid = int(time.time()) & 0x3fffffff
+
+    def newRequestId(self) :
+        """Returns a new request id."""
+        self.nextrequestid = (self.nextrequestid + 1) & 0x7fffffff
+        return self.nextrequestid
+
+    def encodeRequest(self, community, requestid, varbindlist) :
+        """Returns the GetRequest message."""
+        pdu = encodeTLV(GETREQUEST, encodeInteger(requestid) \
+                                    + encodeInteger(0) \
+                                    + encodeInteger(0) \
+                                    + varbindlist)
+        return encodeTLV(SEQUENCE, encodeInteger(0) + encodeTLV(OCTETSTRING, community) + pdu)
+
+    def send(self, sock, request, message) :
+        """Sends a request, recording an error if it can't be sent."""
+        request.attempts += 1
+        request.sent = time.time()
+        request.deadline = request.sent + self.timeout
+        try :
+            sock.sendto(message, request.address)
+        except socket.error, msg :
+            if msg[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS) :
+                request.error = str(msg)
+
+    def query(self, hostnames, oids, community="public", port=161) :
+        """Asks all the printers for the values of the same OIDs.
+
+           Returns a mapping of hostnames to SNMPRequest instances,
+           whose values attribute is the list of values, or None
+           with the error attribute set to an error message.
+        """
+        varbindlist = compileVarBindList(oids)
+        results = {}
+        waiting = []
+        for hostname in hostnames :
+            if results.has_key(hostname) :
+                continue
+            request = results[hostname] = SNMPRequest(hostname, port)
+            try :
+                request.address = (socket.gethostbyname(hostname), port)
+            except socket.error, msg :
+                request.error = "Unknown host : %s" % msg
+            else :
+                waiting.append(request)
+        waiting.reverse()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        pending = {}
+        messages = {}
+        try :
+            while waiting or pending :
+                while waiting and (len(pending) < self.window) :
+                    request = waiting.pop()
+                    request.requestid = self.newRequestId()
+                    messages[request.requestid] = self.encodeRequest(community, request.requestid, varbindlist)
+                    self.send(sock, request, messages[request.requestid])
+                    if request.error is None :
+                        pending[request.requestid] = request
+                now = time.time()
+                for request in pending.values() :
+                    if request.deadline <= now :
+                        if request.attempts > self.retries :
+                            request.error = "No answer after %i attempts" % request.attempts
+                            del pending[request.requestid]
+                        else :
+                            self.send(sock, request, messages[request.requestid])
+                            if request.error is not None :
+                                del pending[request.requestid]
+                if not pending :
+                    continue
+                deadline = min([r.deadline for r in pending.values()])
+                try :
+                    (readable, writable, errors) = select.select([sock], [], [], max(deadline - time.time(), 0))
+                except select.error, msg :
+                    if msg[0] == errno.EINTR :
+                        continue
+                    raise
+                while readable :
+                    try :
+                        (data, address) = sock.recvfrom(MAXMESSAGESIZE)
+                    except socket.error :
+                        break
+                    try :
+                        (requestid, errorstatus, errorindex, values) = decodeResponse(data)
+                    except PyKotaSNMPError :
+                        continue
+                    request = pending.get(requestid)
+                    if (request is None) or (request.address[0] != address[0]) :
+                        continue # late or foreign answer
+                    del pending[requestid]
+                    request.latency = time.time() - request.sent
+                    if errorstatus :
+                        request.error = "SNMP error status %i at index %i" % (errorstatus, errorindex)
+                    else :
+                        request.values = values
+        finally :
+            sock.close()
+        return results
+
+def main(hostnames, community="public") :
+    """Displays the page counter and status of printers, and how long they took to answer."""
+    pageCounterOID = "1.3.6.1.2.1.43.10.2.1.4.1.1"  # SNMPv2-SMI::mib-2.43.10.2.1.4.1.1
+    hrPrinterStatusOID = "1.3.6.1.2.1.25.3.5.1.1.1" # SNMPv2-SMI::mib-2.25.3.5.1.1.1
+    printerStatusValues = { 1 : 'other',
+                            2 : 'unknown',
+                            3 : 'idle',
+                            4 : 'printing',
+                            5 : 'warmup',
+                          }
+    results = SNMPEngine().query(hostnames, (pageCounterOID, hrPrinterStatusOID), community)
+    for hostname in hostnames :
+        request = results[hostname]
+        if request.values is None :
+            print "%s : %s" % (hostname, request.error)
+        else :
+            print "%s : page counter %s, status %s, answered in %.3f seconds after %i attempt(s)" \
+                  % (hostname, request.values[0], printerStatusValues.get(request.values[1]), request.latency, request.attempts)
+
+if __name__ == "__main__" :
+    if len(sys.argv) < 2 :
+        sys.stderr.write("Usage :  python  %s  printer_ip_address [printer_ip_address ...]\n" % sys.argv[0])
+    else :
+        main(sys.argv[1:])
@@ -22,9 +22,16 @@
 #
 #
 
-import os
-import popen2
 from pykota.accounter import AccounterBase, PyKotaAccounterError
+from pykota.workers import runWorkers, runCommand
+
+def computeJobSize(infile) :
+    """Returns the job's number of pages."""
+    from pkpgpdls import analyzer
+    try :
+        return analyzer.PDLAnalyzer(infile).getJobSize()
+    finally :
+        infile.close()
 
 class Accounter(AccounterBase) :
     def computeJobSize(self) :    
@@ -37,12 +44,22 @@ class Accounter(AccounterBase) :
             self.filter.logdebug("Precomputing pass told us that job is %s pages long." % self.filter.softwareJobSize)
             return self.filter.softwareJobSize   # Optimize : already computed !
             
-        if self.arguments :
-            self.filter.logdebug("Using external script %s to compute job's size." % self.arguments)
-            return self.withExternalScript()
+        cached = self.getCachedJobSize("software")
+        if cached is not None :
+            jobsize = cached[0]
         else :    
-            self.filter.logdebug("Using internal parser to compute job's size.")
-            return self.withInternalParser()
+            if self.arguments :
+                self.filter.logdebug("Using external script %s to compute job's size." % self.arguments)
+                jobsize = self.withExternalScript()
+            else :    
+                self.filter.logdebug("Using internal parser to compute job's size.")
+                jobsize = self.withInternalParser()
+            self.cacheJobSize("software", jobsize)
+        if self.filter.InputFile is not None :
+            # when a filename is passed as an argument, the backend 
+            # must generate the correct number of copies.
+            jobsize *= self.filter.Copies
+        return jobsize
         
     def withInternalParser(self) :    
         """Does software accounting through an external script."""
@@ -54,66 +71,58 @@ class Accounter(AccounterBase) :
                 self.filter.printInfo("pkpgcounter is now distributed separately, please grab it from http://www.pykota.com/software/pkpgcounter", "error")
                 self.filter.printInfo("Precomputed job size will be forced to 0 pages.", "error")
             else :     
-                infile = open(self.filter.DataFile, "rb")
+                timeout = self.filter.config.getPrinterPrecomputeTimeout(self.filter.PrinterName)
                 try :
-                    parser = analyzer.PDLAnalyzer(infile)
-                    jobsize = parser.getJobSize()
+                    if timeout :
+                        jobsize = self.computeInChild(timeout)
+                    else :    
+                        jobsize = computeJobSize(self.filter.openJobDatas())
                 except pdlparser.PDLParserError, msg :    
                     # Here we just log the failure, but
                     # we finally ignore it and return 0 since this
                     # computation is just an indication of what the
                     # job's size MAY be.
                     self.filter.printInfo(_("Unable to precompute the job's size with the generic PDL analyzer : %s") % msg, "warn")
-                else :    
-                    if self.filter.InputFile is not None :
-                        # when a filename is passed as an argument, the backend 
-                        # must generate the correct number of copies.
-                        jobsize *= self.filter.Copies
-                infile.close()        
         return jobsize        
                 
+    def computeInChild(self, timeout) :
+        """Computes the job's size in a child process, giving up after timeout seconds."""
+        from pkpgpdls import pdlparser
+        infile = self.filter.openJobDatas()
+        try :
+            (status, value) = runWorkers([(computeJobSize, (infile,))], timeout=timeout)[0]
+        finally :    
+            infile.close()
+        if status != "OK" :
+            raise pdlparser.PDLParserError, value or (_("Job's size not computed within %s seconds") % timeout)
+        return value
+                
     def withExternalScript(self) :    
         """Does software accounting through an external script."""
         self.filter.printInfo(_("Launching SOFTWARE(%s)...") % self.arguments)
-        MEGABYTE = 1024*1024
-        infile = open(self.filter.DataFile, "rb")
-        child = popen2.Popen4(self.arguments)
+        infile = self.filter.openJobDatas()
+        timeout = self.filter.config.getPrinterAccounterTimeout(self.filter.PrinterName)
         try :
-            data = infile.read(MEGABYTE)    
-            while data :
-                child.tochild.write(data)
-                data = infile.read(MEGABYTE)
-            child.tochild.flush()
-            child.tochild.close()    
-        except (IOError, OSError), msg :    
-            msg = "%s : %s" % (self.arguments, msg) 
+            command = runCommand(self.arguments, infile, timeout)
+        finally :    
+            infile.close()
+        if command.feederror is not None :
+            msg = "%s : %s" % (self.arguments, command.feederror) 
             self.filter.printInfo(_("Unable to compute job size with accounter %s") % msg)
-        infile.close()
+        if command.timedout :
+            self.filter.printInfo(_("Software accounter %s killed after %s seconds") % (self.arguments, timeout), "warn")
+            
         pagecounter = None
-        try :
-            answer = child.fromchild.read()
-        except (IOError, OSError), msg :    
-            msg = "%s : %s" % (self.arguments, msg) 
-            self.filter.printInfo(_("Unable to compute job size with accounter %s") % msg)
-        else :    
-            lines = [l.strip() for l in answer.split("\n")]
-            for i in range(len(lines)) : 
-                try :
-                    pagecounter = int(lines[i])
-                except (AttributeError, ValueError) :
-                    self.filter.printInfo(_("Line [%s] skipped in accounter's output. Trying again...") % lines[i])
-                else :    
-                    break
-        child.fromchild.close()
-        
-        try :
-            status = child.wait()
-        except OSError, msg :    
-            self.filter.printInfo(_("Problem while waiting for software accounter pid %s to exit : %s") % (child.pid, msg))
-        else :    
-            if os.WIFEXITED(status) :
-                status = os.WEXITSTATUS(status)
-            self.filter.printInfo(_("Software accounter %s exit code is %s") % (self.arguments, str(status)))
+        lines = [l.strip() for l in command.output.split("\n")]
+        for i in range(len(lines)) : 
+            try :
+                pagecounter = int(lines[i])
+            except (AttributeError, ValueError) :
+                self.filter.printInfo(_("Line [%s] skipped in accounter's output. Trying again...") % lines[i])
+            else :    
+                break
+        self.filter.printInfo(_("Software accounter %s exit code is %s") % (self.arguments, str(command.exitCode())))
+        self.filter.logdebug("Software accounter %s ran for %.3f seconds." % (self.arguments, command.elapsed))
             
         if pagecounter is None :    
             message = _("Unable to compute job size with accounter %s") % self.arguments
@@ -123,10 +132,4 @@ class Accounter(AccounterBase) :
                 raise PyKotaAccounterError, message
         self.filter.logdebug("Software accounter %s said job is %s pages long." % (self.arguments, repr(pagecounter)))
             
-        pagecounter = pagecounter or 0    
-        if self.filter.InputFile is not None :
-            # when a filename is passed as an argument, the backend 
-            # must generate the correct number of copies.
-            pagecounter *= self.filter.Copies
-                        
-        return pagecounter
+        return pagecounter or 0
@@ -0,0 +1,221 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota - Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module decides when a printer's idle status is stable.
+
+By default the printer must be seen idle a fixed number of times,
+with a fixed delay between two checks. When the 'adaptivestabilization'
+directive is set for a printer, how long its idle status lasted before
+it began to print again, and how long its page counter took to be
+updated once idle, are remembered from job to job, and the idle
+status is considered stable once it lasted a bit longer than that.
+"""
+
+import sys
+import os
+import time
+import marshal
+import tempfile
+
+from pykota import constants
+
+MINIMUMCHECKS = 5       # number of jobs to learn from before adapting
+CALIBRATIONCHECKS = 10  # one check out of this number waits as configured, to keep learning
+HISTORYSIZE = 20        # number of observations kept for each kind of delay
+SAFETYFACTOR = 1.5      # how much longer than the longest observation to wait
+MINIMUMDELAY = 0.5      # minimal number of seconds between two checks
+
+def timingsFileName(directory, printername) :
+    """Returns the name of the file containing a printer's timings."""
+    return os.path.join(directory, "pykota-%s.timings" % printername)
+
+def loadTimings(filename) :
+    """Returns the timings saved in a file, or empty timings."""
+    timings = { "checks" : 0,     # jobs learned from
+                "waits" : 0,      # idle statuses which became stable
+                "waited" : 0.0,
+                "saved" : 0.0,
+                "falseidles" : [],
+                "counterlags" : [],
+                "printingdelays" : [],
+              }
+    try :
+        timingsfile = open(filename, "rb")
+        try :
+            timings.update(marshal.load(timingsfile))
+        finally :
+            timingsfile.close()
+    except (IOError, EOFError, ValueError, TypeError) :
+        pass
+    return timings
+
+def observedWindow(timings) :
+    """Returns how long the idle status must last according to the observations only."""
+    return max([0.0] + timings["falseidles"] + timings["counterlags"]) * SAFETYFACTOR
+
+def saveTimings(filename, timings) :
+    """Atomically saves timings into a file."""
+    (fd, tempname) = tempfile.mkstemp(prefix=".", dir=os.path.dirname(filename))
+    try :
+        try :
+            os.write(fd, marshal.dumps(timings))
+        finally :
+            os.close(fd)
+        os.rename(tempname, filename)
+    except OSError :
+        try :
+            os.remove(tempname)
+        except OSError :
+            pass
+        raise
+
+class Stabilizer :
+    """Decides when a printer's status is stable, and learns from it if asked to."""
+    def __init__(self, filter) :
+        """Initializes the stabilization for the current printer."""
+        self.filter = filter
+        self.delay = self.printingdelay = constants.get(filter, "StatusStabilizationDelay")
+        self.loops = constants.get(filter, "StatusStabilizationLoops")
+        self.fixedwait = self.delay * (self.loops - 1)
+        self.window = None
+        self.timings = None
+        self.started = time.time()
+        self.firstidle = None   # when the current idle status began
+        self.stablesince = None # when the page counter last changed during the current idle status
+        self.idlecounter = None
+        self.idlesamples = 0
+        self.idlenum = 0
+        self.waited = None
+        try :
+            adaptive = filter.config.getPrinterAdaptiveStabilization(filter.PrinterName)
+        except AttributeError : # testing mode
+            adaptive = False
+        if adaptive :
+            self.filename = timingsFileName(filter.config.getPrinterDirectory(filter.PrinterName), filter.PrinterName)
+            self.timings = loadTimings(self.filename)
+            self.adapt()
+
+    def adapt(self) :
+        """Chooses the delay between two checks and how long the idle status must last."""
+        timings = self.timings
+        checks = timings["checks"]
+        if (checks < MINIMUMCHECKS) or not ((checks + 1) % CALIBRATIONCHECKS) :
+            self.filter.logdebug("Learning printer %s's timings (%i checks done so far)." % (self.filter.PrinterName, checks))
+            return
+        # never shorter than a single configured delay, even for a printer never seen busy again
+        self.window = max(self.delay, observedWindow(timings))
+        self.delay = max(MINIMUMDELAY, min(self.delay, self.window / 2.0))
+        if timings["printingdelays"] :
+            self.printingdelay = max(MINIMUMDELAY, min(self.printingdelay, min(timings["printingdelays"]) / 2.0))
+        self.filter.logdebug("Printer %s's idle status must last %.1f seconds, checked every %.1f seconds." \
+                                 % (self.filter.PrinterName, self.window, self.delay))
+
+    def isLearning(self) :
+        """Returns True if what is seen now should be remembered, else False."""
+        return (self.timings is not None) and (os.environ.get("PYKOTAPHASE") == "AFTER")
+
+    def remember(self, kind, value) :
+        """Remembers a delay."""
+        if self.isLearning() :
+            values = self.timings[kind]
+            values.append(value)
+            del values[:-HISTORYSIZE]
+
+    def printing(self, now=None) :
+        """Records that the printer is printing, as seen at time now."""
+        if now is None :
+            now = time.time()
+        self.remember("printingdelays", now - self.started)
+
+    def idle(self, counter, now=None) :
+        """Records that the printer is idle, as seen at time now, and returns True if this is stable, else False."""
+        if now is None :
+            now = time.time()
+        if self.firstidle is None :
+            self.firstidle = self.stablesince = now
+            self.idlecounter = counter
+            self.idlesamples = 0
+        elif counter != self.idlecounter :
+            self.remember("counterlags", now - self.firstidle)
+            self.stablesince = now
+            self.idlecounter = counter
+            self.idlesamples = 0
+        self.idlesamples += 1
+        self.idlenum += 1
+        if self.window is None :
+            stable = (self.idlenum >= self.loops)
+        else :
+            stable = (self.idlesamples >= 2) and ((now - self.stablesince) >= self.window)
+        if stable :
+            self.waited = now - self.firstidle
+        return stable
+
+    def busy(self, now=None) :
+        """Records that the printer is not idle, as seen at time now."""
+        if now is None :
+            now = time.time()
+        if self.firstidle is not None :
+            self.remember("falseidles", now - self.firstidle)
+            self.firstidle = None
+        self.idlenum = 0
+
+    def done(self) :
+        """Saves what was learned."""
+        if self.timings is not None :
+            timings = self.timings
+            if self.isLearning() and (self.waited is not None) :
+                # only the idle status after a job tells how long to wait
+                timings["checks"] += 1
+            if self.waited is not None :
+                timings["waits"] += 1
+                timings["waited"] += self.waited
+                timings["saved"] += self.fixedwait - self.waited
+                self.filter.logdebug("Printer %s's idle status was stable after %.1f seconds instead of %.1f" \
+                                         % (self.filter.PrinterName, self.waited, self.fixedwait))
+            try :
+                saveTimings(self.filename, timings)
+            except (IOError, OSError), msg :
+                self.filter.printInfo(_("Unable to save printer %s's timings into %s : %s") % (self.filter.PrinterName, self.filename, msg), "warn")
+
+def main(directories) :
+    """Displays the timings learned for all the printers."""
+    print "%-20s %8s %10s %10s %12s" % ("Printer", "Checks", "Observed", "Avg wait", "Time saved")
+    for directory in directories :
+        names = os.listdir(directory)
+        names.sort()
+        for name in names :
+            if name.startswith("pykota-") and name.endswith(".timings") :
+                timings = loadTimings(os.path.join(directory, name))
+                window = observedWindow(timings)
+                if timings["waits"] :
+                    average = timings["waited"] / timings["waits"]
+                else :
+                    average = 0.0
+                print "%-20s %8i %9.1fs %9.1fs %11.1fs" % (name[7:-8], timings["checks"], window, average, timings["saved"])
+
+if __name__ == "__main__" :
+    if len(sys.argv) < 2 :
+        sys.stderr.write("Usage :  python  %s  directory [directory ...]\n" % sys.argv[0])
+    else :
+        main(sys.argv[1:])
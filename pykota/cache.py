@@ -0,0 +1,181 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines the bounded caches used by the storage layer."""
+
+import time
+
+REFERENCESIZE = 8
+
+def estimateSize(value) :
+    """Returns a rough estimation of the memory used by a cached value, in bytes.
+
+       Only the value itself and its direct attributes or elements
+       are taken into account, referenced objects are not.
+    """
+    if isinstance(value, (str, unicode)) :
+        return len(value) + REFERENCESIZE
+    elif isinstance(value, (list, tuple)) :
+        return REFERENCESIZE * (len(value) + 1)
+    elif hasattr(value, "__dict__") :
+        size = REFERENCESIZE
+        for (name, attribute) in value.__dict__.items() :
+            size += len(name) + REFERENCESIZE
+            if isinstance(attribute, (str, unicode)) :
+                size += len(attribute)
+            elif isinstance(attribute, (list, tuple)) :
+                size += REFERENCESIZE * len(attribute)
+        return size
+    else :
+        return REFERENCESIZE
+
+class LRUCache :
+    """A cache which keeps at most maxentries entries, each for at most ttl seconds.
+
+       When full, the least recently used entry is evicted.
+       A maxentries or a ttl of 0 means unlimited.
+    """
+    def __init__(self, name, maxentries=0, ttl=0) :
+        """Initializes an empty cache."""
+        self.name = name
+        self.maxentries = maxentries
+        self.ttl = ttl
+        self.entries = {}
+        # Circular doubly linked list of [previous, next, key, value, expiration, size],
+        # most recently used entries first.
+        self.head = [None, None, None, None, None, 0]
+        self.head[0] = self.head[1] = self.head
+        self.hits = 0
+        self.sharedhits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.flushes = 0
+        self.bytes = 0
+
+    def __len__(self) :
+        """Returns the number of entries in the cache."""
+        return len(self.entries)
+
+    def __contains__(self, key) :
+        """Returns True if key is in the cache, else False."""
+        return self.entries.has_key(key)
+
+    def keys(self) :
+        """Returns the list of keys in the cache."""
+        return self.entries.keys()
+
+    def unlink(self, node) :
+        """Removes an entry from the usage list."""
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def linkFirst(self, node) :
+        """Marks an entry as the most recently used."""
+        head = self.head
+        node[0] = head
+        node[1] = head[1]
+        head[1][0] = node
+        head[1] = node
+
+    def discard(self, key) :
+        """Removes an entry, returns True if it was there, else False."""
+        node = self.entries.pop(key, None)
+        if node is None :
+            return False
+        self.unlink(node)
+        self.bytes -= node[5]
+        return True
+
+    def get(self, key) :
+        """Returns the value cached for key, or None, and counts the lookup."""
+        node = self.entries.get(key)
+        if node is None :
+            self.misses += 1
+            return None
+        if node[4] and (node[4] < time.time()) :
+            self.discard(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.unlink(node)
+        self.linkFirst(node)
+        self.hits += 1
+        return node[3]
+
+    def peek(self, key) :
+        """Returns the value cached for key, or None, without counting the lookup."""
+        node = self.entries.get(key)
+        if node is not None :
+            return node[3]
+
+    def put(self, key, value) :
+        """Stores a value in the cache, evicting the least recently used entries if needed."""
+        self.discard(key)
+        if self.ttl :
+            expiration = time.time() + self.ttl
+        else :
+            expiration = None
+        node = [None, None, key, value, expiration, estimateSize(value)]
+        self.linkFirst(node)
+        self.entries[key] = node
+        self.bytes += node[5]
+        self.stores += 1
+        if self.maxentries :
+            while len(self.entries) > self.maxentries :
+                self.discard(self.head[0][2])
+                self.evictions += 1
+
+    def flush(self, key) :
+        """Removes an entry, returns True if it was there, else False."""
+        if self.discard(key) :
+            self.flushes += 1
+            return True
+        return False
+
+    def clear(self) :
+        """Removes all the entries."""
+        self.entries = {}
+        self.head[0] = self.head[1] = self.head
+        self.bytes = 0
+
+    def statistics(self) :
+        """Returns a mapping of this cache's counters."""
+        lookups = self.hits + self.misses
+        if lookups :
+            hitrate = 100.0 * (self.hits + self.sharedhits) / lookups
+        else :
+            hitrate = 0.0
+        return { "entries" : len(self.entries),
+                 "hits" : self.hits,
+                 "sharedhits" : self.sharedhits,
+                 "misses" : self.misses - self.sharedhits,
+                 "hitrate" : hitrate,
+                 "stores" : self.stores,
+                 "evictions" : self.evictions,
+                 "expirations" : self.expirations,
+                 "flushes" : self.flushes,
+                 "bytes" : self.bytes,
+               }
@@ -25,9 +25,13 @@
 """This module defines classes used to parse PyKota configuration files."""
 
 import os
+import stat
+import marshal
 import tempfile
 import ConfigParser
 
+SNAPSHOTVERSION = 1
+
 class PyKotaConfigError(Exception):
     """An exception for PyKota config related stuff."""
     def __init__(self, message = ""):
@@ -39,6 +43,8 @@ class PyKotaConfigError(Exception):
     
 class PyKotaConfig :
     """A class to deal with PyKota's configuration."""
+    # getters which are not checked by checkConfiguration()
+    uncheckedgetters = ("getPrinterNames", "getPrinterOptions", "getLDAPInfo")
     def __init__(self, directory) :
         """Reads and checks the configuration file."""
         self.isAdmin = 0
@@ -51,8 +57,113 @@ class PyKotaConfig :
             raise PyKotaConfigError, _("Configuration file %s not found.") % self.adminfilename
         if os.access(self.adminfilename, os.R_OK) :    
             self.isAdmin = 1
-        self.config = ConfigParser.ConfigParser()
-        self.config.read([self.filename])
+        self.snapshotfilename = self.filename + ".snapshot"
+        (self.sectionnames, self.sections) = self.loadSnapshot()
+        self.printeroptions = {}
+        self.resolved = {}
+            
+    def snapshotKey(self) :    
+        """Returns what identifies the current content of the configuration file."""
+        st = os.stat(self.filename)
+        return (SNAPSHOTVERSION, self.filename, st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        
+    def parseConfiguration(self) :    
+        """Parses the configuration file.
+        
+           Returns the list of its sections' names, and a mapping
+           of its sections to mappings of their options.
+        """
+        parser = ConfigParser.ConfigParser()
+        parser.read([self.filename])
+        sections = {}
+        for section in parser.sections() :
+            sections[section] = dict(parser.items(section, raw=1))
+        return (parser.sections(), sections)
+        
+    def loadSnapshot(self) :    
+        """Returns the parsed configuration file, from its snapshot if it is up to date.
+        
+           The snapshot is rewritten if it is missing or out of date and
+           its directory is writable. It is only trusted if it belongs to
+           root or to the configuration file's owner, and can't be modified
+           by anybody else.
+        """
+        key = self.snapshotKey()
+        try :
+            snapshotfile = open(self.snapshotfilename, "rb")
+            try :
+                st = os.fstat(snapshotfile.fileno())
+                if (st.st_uid in (0, os.stat(self.filename).st_uid)) \
+                   and not (st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)) :
+                    (snapshotkey, parsed) = marshal.load(snapshotfile)
+                    if snapshotkey == key :
+                        return parsed
+            finally :    
+                snapshotfile.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError) :
+            pass
+        parsed = self.parseConfiguration()
+        self.saveSnapshot(key, parsed)
+        return parsed
+        
+    def saveSnapshot(self, key, parsed) :    
+        """Atomically saves the parsed configuration file, readable by the same users as the file itself."""
+        directory = os.path.dirname(self.snapshotfilename)
+        if not os.access(directory, os.W_OK) :
+            return
+        try :
+            (fd, tempname) = tempfile.mkstemp(prefix=".pykota.conf.", dir=directory)
+        except (IOError, OSError) :
+            return
+        try :
+            try :
+                os.write(fd, marshal.dumps((key, parsed)))
+                os.fchmod(fd, stat.S_IMODE(os.stat(self.filename).st_mode) & 0644)
+            finally :
+                os.close(fd)
+            os.rename(tempname, self.snapshotfilename)
+        except OSError :
+            try :
+                os.remove(tempname)
+            except OSError :
+                pass
+            
+    def checkConfiguration(self) :
+        """Returns the list of error messages for all the incorrect directives.
+        
+           All the getters are called, globally and for each printer
+           or each storage cache type.
+        """
+        from pykota.storage import CACHETYPES # only here : unlike this module, pykota.storage needs mx
+        errors = []
+        printernames = ["global"] + self.getPrinterNames()
+        names = [n for n in dir(self) if n.startswith("get") and (n not in self.uncheckedgetters)]
+        names.sort()
+        if (self.getGlobalOption("storagebackend", ignore=1) or "").strip().lower() == "ldapstorage" :
+            names.append("getLDAPInfo")
+        for name in names :
+            getter = getattr(self, name)
+            function = getattr(getter, "im_func", None)
+            function = getattr(function, "getter", function) # cached getters
+            code = getattr(function, "func_code", None)
+            if code is None :
+                continue
+            if code.co_argcount == 1 :
+                calls = [()]
+            elif (code.co_argcount == 2) and (code.co_varnames[1] == "printername") :
+                calls = [(printername,) for printername in printernames]
+            elif (code.co_argcount == 2) and (code.co_varnames[1] == "cachetype") :
+                calls = [(cachetype,) for cachetype in CACHETYPES]
+            else :
+                continue
+            for arguments in calls :
+                try :
+                    getter(*arguments)
+                except PyKotaConfigError, msg :
+                    msg = str(msg)
+                    if msg not in errors :
+                        errors.append(msg)
+        return errors
             
     def isTrue(self, option) :        
         """Returns True if option is set to true, else False."""
@@ -70,28 +181,34 @@ class PyKotaConfig :
                         
     def getPrinterNames(self) :    
         """Returns the list of configured printers, i.e. all sections names minus 'global'."""
-        return [pname for pname in self.config.sections() if pname != "global"]
+        return [pname for pname in self.sectionnames if pname != "global"]
         
     def getGlobalOption(self, option, ignore=0) :    
         """Returns an option from the global section, or raises a PyKotaConfigError if ignore is not set, else returns None."""
         try :
-            return self.config.get("global", option, raw=1)
-        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError) :    
+            return self.sections["global"][option]
+        except KeyError :    
             if ignore :
                 return None
             else :
                 raise PyKotaConfigError, _("Option %s not found in section global of %s") % (option, self.filename)
                 
+    def getPrinterOptions(self, printername) :    
+        """Returns a mapping of the options set for a printer, either in its section or globally."""
+        try :
+            return self.printeroptions[printername]
+        except KeyError :    
+            options = self.sections.get("global", {}).copy()
+            options.update(self.sections.get(printername, {}))
+            self.printeroptions[printername] = options
+            return options
+            
     def getPrinterOption(self, printername, option) :    
         """Returns an option from the printer section, or the global section, or raises a PyKotaConfigError."""
-        globaloption = self.getGlobalOption(option, ignore=1)
         try :
-            return self.config.get(printername, option, raw=1)
-        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError) :    
-            if globaloption is not None :
-                return globaloption
-            else :
-                raise PyKotaConfigError, _("Option %s not found in section %s of %s") % (option, printername, self.filename)
+            return self.getPrinterOptions(printername)[option]
+        except KeyError :    
+            raise PyKotaConfigError, _("Option %s not found in section %s of %s") % (option, printername, self.filename)
         
     def getStorageBackend(self) :    
         """Returns the storage backend information as a Python mapping."""        
@@ -170,7 +287,7 @@ class PyKotaConfig :
         
     def getLoggingBackend(self) :    
         """Returns the logging backend information."""
-        validloggers = [ "stderr", "system" ] 
+        validloggers = [ "stderr", "system", "batch" ] 
         try :
             logger = self.getGlobalOption("logger").lower()
         except PyKotaConfigError :    
@@ -179,6 +296,41 @@ class PyKotaConfig :
             raise PyKotaConfigError, _("Option logger only supports values in %s") % str(validloggers)
         return logger    
         
+    def getLoggerOutput(self) :
+        """Returns where the batch logger writes : 'system' for syslog, or ('text' or 'json', filename)."""
+        output = (self.getGlobalOption("loggeroutput", ignore=1) or "system").strip()
+        if output.lower() == "system" :
+            return "system"
+        if output.lower().startswith("json:") :
+            (format, filename) = ("json", output[5:].strip())
+        else :
+            (format, filename) = ("text", output)
+        if not filename.startswith("/") :
+            raise PyKotaConfigError, _("Incorrect value %s for the loggeroutput directive") % output
+        return (format, filename)
+        
+    def getLoggerFlushDelay(self) :
+        """Returns the maximal number of seconds the batch logger keeps records before writing them."""
+        delay = self.getGlobalOption("loggerflushdelay", ignore=1)
+        if delay is None :
+            return 1.0
+        try :
+            delay = float(delay)
+            if delay < 0.0 :
+                raise ValueError
+        except ValueError :
+            raise PyKotaConfigError, _("Incorrect value %s for the loggerflushdelay directive") % delay
+        return delay
+        
+    def getMetricsFile(self) :
+        """Returns the name of the file into which metrics are merged, or None if metrics are disabled."""
+        filename = self.getGlobalOption("metricsfile", ignore=1)
+        if filename is not None :
+            filename = filename.strip()
+            if not filename.startswith("/") :
+                raise PyKotaConfigError, _("Incorrect value %s for the metricsfile directive") % filename
+        return filename
+        
     def getLogoURL(self) :
         """Returns the URL to use for the logo in the CGI scripts."""
         url = self.getGlobalOption("logourl", ignore=1) or \
@@ -514,6 +666,64 @@ class PyKotaConfig :
         """Returns True if database caching is enabled, else False."""
         return self.isTrue(self.getGlobalOption("storagecaching", ignore=1))
             
+    def getCacheTypeOption(self, prefix, cachetype, default) :
+        """Returns the non negative integer value of the prefix_cachetype directive, or of the prefix one, or default."""
+        for option in ("%s_%s" % (prefix, cachetype.lower()), prefix) :
+            try :
+                value = self.getGlobalOption(option)
+            except PyKotaConfigError :
+                continue
+            try :
+                value = int(value)
+                if value < 0 :
+                    raise ValueError
+            except (TypeError, ValueError) :
+                raise PyKotaConfigError, _("Incorrect value %s for the %s directive") % (str(value), option)
+            return value
+        return default
+
+    def getCacheSize(self, cachetype) :
+        """Returns the maximum number of entries in a storage cache, 0 meaning unlimited."""
+        return self.getCacheTypeOption("storagecachesize", cachetype, 5000)
+
+    def getCacheTTL(self, cachetype) :
+        """Returns the number of seconds an entry stays in a storage cache, 0 meaning forever."""
+        return self.getCacheTypeOption("storagecachettl", cachetype, 0)
+
+    def getSharedCache(self) :
+        """Returns the directory of the cache shared by all PyKota processes, or None if unset."""
+        try :
+            return self.getGlobalOption("sharedcache").strip() or None
+        except PyKotaConfigError :
+            return None
+
+    def getSharedCacheTTL(self, cachetype) :
+        """Returns the number of seconds an entry of a given type stays in the shared cache."""
+        return self.getCacheTypeOption("sharedcachettl", cachetype, 30)
+
+    def getStoragePool(self) :
+        """Returns the database connection pool's settings as a Python mapping."""
+        pool = {}
+        for (option, key, converter, default) in (("storagepoolmin", "minsize", int, 0),
+                                                  ("storagepoolmax", "maxsize", int, 5),
+                                                  ("storagepoolidle", "idletimeout", int, 60),
+                                                  ("storageretries", "retries", int, 3),
+                                                  ("storageretrydelay", "retrydelay", float, 1.0)) :
+            try :
+                value = self.getGlobalOption(option)
+            except PyKotaConfigError :
+                pool[key] = default
+            else :
+                try :
+                    pool[key] = converter(value)
+                    if pool[key] < 0 :
+                        raise ValueError
+                except (TypeError, ValueError) :
+                    raise PyKotaConfigError, _("Incorrect value %s for the %s directive") % (str(value), option)
+        if pool["maxsize"] and (pool["minsize"] > pool["maxsize"]) :
+            raise PyKotaConfigError, _("The storagepoolmin directive can't be greater than the storagepoolmax one")
+        return pool
+
     def getLDAPCache(self) :          
         """Returns True if low-level LDAP caching is enabled, else False."""
         return self.isTrue(self.getGlobalOption("ldapcache", ignore=1))
@@ -582,6 +792,13 @@ class PyKotaConfig :
             except (TypeError, ValueError) :
                 raise PyKotaConfigError, _("Incorrect value %s for the duplicatesdelay directive in section %s") % (str(duplicatesdelay), printername)
         
+    def getLongestDuplicatesDelay(self) :
+        """Returns the longest duplicatesdelay set, globally or for any printer."""
+        delays = [self.getDuplicatesDelay("global")]
+        for printername in self.getPrinterNames() :
+            delays.append(self.getDuplicatesDelay(printername))
+        return max(delays)
+        
     def getNoPrintingMaxDelay(self, printername) :          
         """Returns the max number of seconds to wait for the printer to be in 'printing' mode."""
         try : 
@@ -729,13 +946,10 @@ class PyKotaConfig :
         """Returns a mapping of coefficients for a particular printer."""
         branchbasename = "coefficient_"
         try :
-            globalbranches = [ (k, self.config.get("global", k)) for k in self.config.options("global") if k.startswith(branchbasename) ]
-        except ConfigParser.NoSectionError, msg :
-            raise PyKotaConfigError, "Invalid configuration file : %s" % msg
-        try :
-            sectionbranches = [ (k, self.config.get(printername, k)) for k in self.config.options(printername) if k.startswith(branchbasename) ]
-        except ConfigParser.NoSectionError, msg :
-            sectionbranches = []
+            globalbranches = [ (k, v) for (k, v) in self.sections["global"].items() if k.startswith(branchbasename) ]
+        except KeyError :
+            raise PyKotaConfigError, "Invalid configuration file : No section: 'global'"
+        sectionbranches = [ (k, v) for (k, v) in self.sections.get(printername, {}).items() if k.startswith(branchbasename) ]
         branches = {}
         for (k, v) in globalbranches :
             k = k.split('_', 1)[1]
@@ -764,3 +978,138 @@ class PyKotaConfig :
             return self.isTrue(self.getPrinterOption(printername, "skipinitialwait"))
         except PyKotaConfigError :
             return False
+
+    def getDaemonSocket(self) :
+        """Returns the path to the pykotad accounting daemon's socket, or None if unset."""
+        try :
+            return self.getGlobalOption("daemonsocket").strip() or None
+        except PyKotaConfigError :
+            return None
+
+    def getDaemonTimeout(self) :
+        """Returns the number of seconds to wait for an answer from the pykotad accounting daemon."""
+        try :
+            timeout = self.getGlobalOption("daemontimeout")
+        except PyKotaConfigError :
+            return 60.0
+        else :
+            try :
+                timeout = float(timeout)
+                if timeout <= 0.0 :
+                    raise ValueError
+            except (TypeError, ValueError) :
+                raise PyKotaConfigError, _("Incorrect value %s for the daemontimeout directive") % str(timeout)
+            else :
+                return timeout
+
+    def getJobSizeCache(self) :
+        """Returns the directory of the cache of already computed job sizes, or None if unset."""
+        try :
+            return self.getGlobalOption("jobsizecache").strip() or None
+        except PyKotaConfigError :
+            return None
+
+    def getJobSizeCacheSize(self) :
+        """Returns the maximal number of entries in the cache of already computed job sizes, 0 meaning unlimited."""
+        try :
+            size = self.getGlobalOption("jobsizecachesize")
+        except PyKotaConfigError :
+            return 1000
+        else :
+            try :
+                size = int(size)
+                if size < 0 :
+                    raise ValueError
+            except (TypeError, ValueError) :
+                raise PyKotaConfigError, _("Incorrect value %s for the jobsizecachesize directive") % str(size)
+            else :
+                return size
+
+    def getPrinterPrecomputeTimeout(self, printername) :
+        """Returns the number of seconds after which precomputing the ink coverage gives up, 0 meaning never."""
+        try :
+            timeout = self.getPrinterOption(printername, "precomputetimeout")
+        except PyKotaConfigError :
+            return 0
+        else :
+            try :
+                timeout = float(timeout)
+                if timeout < 0.0 :
+                    raise ValueError
+            except (TypeError, ValueError) :
+                raise PyKotaConfigError, _("Incorrect value %s for the precomputetimeout directive in section %s") % (str(timeout), printername)
+            else :
+                return timeout
+
+    def getPrinterAccounterTimeout(self, printername) :
+        """Returns the number of seconds after which external accounting commands are killed, 0 meaning never."""
+        try :
+            timeout = self.getPrinterOption(printername, "accountertimeout")
+        except PyKotaConfigError :
+            return 0
+        else :
+            try :
+                timeout = float(timeout)
+                if timeout < 0.0 :
+                    raise ValueError
+            except (TypeError, ValueError) :
+                raise PyKotaConfigError, _("Incorrect value %s for the accountertimeout directive in section %s") % (str(timeout), printername)
+            else :
+                return timeout
+
+    def getPrinterRecordLatencies(self, printername) :
+        """Returns True if the durations of the phases of the printer's jobs should be saved, else False."""
+        try :
+            return self.isTrue(self.getPrinterOption(printername, "recordlatencies"))
+        except PyKotaConfigError :
+            return False
+            
+    def getPrinterAdaptiveStabilization(self, printername) :
+        """Returns True if the printer's timings should be learned to wait less for its idle status, else False."""
+        try :
+            return self.isTrue(self.getPrinterOption(printername, "adaptivestabilization"))
+        except PyKotaConfigError :
+            return False
+
+    def getSNMPPollInterval(self) :
+        """Returns the number of seconds between two SNMP queries done by pykotad's shared poller, 0 meaning disabled."""
+        try :
+            interval = self.getGlobalOption("snmppollinterval")
+        except PyKotaConfigError :
+            return 1.0
+        else :
+            try :
+                interval = float(interval)
+                if (interval < 0.0) or (0.0 < interval < 0.25) :
+                    raise ValueError
+            except (TypeError, ValueError) :
+                raise PyKotaConfigError, _("Incorrect value %s for the snmppollinterval directive") % str(interval)
+            else :
+                return interval
+
+def cachedGetter(getter) :
+    """Returns a getter which computes its result only once for each set of arguments."""
+    name = getter.__name__
+    def cached(self, *arguments) :
+        key = (name,) + arguments
+        try :
+            return self.resolved[key]
+        except KeyError :
+            value = self.resolved[key] = getter(self, *arguments)
+            return value
+    cached.__doc__ = getter.__doc__
+    cached.getter = getter
+    return cached
+
+# these getters are called several times for each job, and validate
+# their values each time : their results are computed once.
+for name in ("getPreAccounterBackend", "getAccounterBackend", "getUnknownBillingCode", \
+             "getPrinterEnforcement", "getPrinterOnBackendError", "getPrinterOnAccounterError", \
+             "getPrinterPolicy", "getMailTo", "getMaxDenyBanners", "getGraceDelay", \
+             "getDenyDuplicates", "getDuplicatesDelay", "getNoPrintingMaxDelay", \
+             "getStatusStabilizationLoops", "getStatusStabilizationDelay", \
+             "getPrinterSNMPErrorMask", "getAccountBanner", "getAvoidDuplicateBanners", \
+             "getTrustJobSize", "getPrinterCoefficients", "getCacheTypeOption", \
+             "getPrinterPrecomputeTimeout", "getPrinterAccounterTimeout", \
+             "getDaemonTimeout", "getSNMPPollInterval") :
+    setattr(PyKotaConfig, name, cachedGetter(getattr(PyKotaConfig, name).im_func))
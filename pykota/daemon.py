@@ -0,0 +1,851 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines the accounting sessions used by the CUPS backend, either locally or through the pykotad daemon."""
+
+import os
+import sys
+import pwd
+import socket
+import struct
+import signal
+import marshal
+import threading
+import SocketServer
+
+from mx import DateTime
+
+from pykota import config, storage
+from pykota.tool import PyKotaTool
+from pykota.plugins import dumpImportStatistics
+from pykota.latency import timedCall
+
+class PyKotaDaemonError(Exception):
+    """An exception for accounting daemon related stuff."""
+    def __init__(self, message = ""):
+        self.message = message
+        Exception.__init__(self, message)
+    def __repr__(self):
+        return self.message
+    __str__ = __repr__
+
+SNAPSHOTTYPES = (type(None), bool, int, long, float, str, unicode)
+
+STRINGS = (str, unicode)
+OPTIONALSTRINGS = (type(None), str, unicode)
+COUNTS = (int, long)
+NUMBERS = (int, long, float)
+
+# the parameters the backends send with each command, and their types
+COMMANDPARAMETERS = { "PREPARE" : { "printername" : STRINGS,
+                                    "username" : STRINGS,
+                                    "jobid" : STRINGS,
+                                    "title" : OPTIONALSTRINGS,
+                                    "copies" : COUNTS,
+                                    "options" : OPTIONALSTRINGS,
+                                    "filename" : OPTIONALSTRINGS,
+                                    "clienthost" : OPTIONALSTRINGS,
+                                    "jobsizebytes" : COUNTS,
+                                    "md5sum" : OPTIONALSTRINGS,
+                                    "billingcode" : OPTIONALSTRINGS,
+                                    "softwarejobsize" : (type(None), int, long),
+                                    "inkusage" : (list,),
+                                    "action" : STRINGS,
+                                    "reason" : OPTIONALSTRINGS,
+                                  },
+                      "DENYBANNER" : {},
+                      "COMMIT" : { "action" : STRINGS,
+                                   "jobsize" : COUNTS,
+                                   "lastpagecounter" : COUNTS,
+                                   "inkusage" : (list,),
+                                 },
+                      "SNMPSAMPLE" : { "hostname" : STRINGS,
+                                       "community" : STRINGS,
+                                       "since" : NUMBERS,
+                                       "timeout" : NUMBERS,
+                                     },
+                    }
+
+# How to ask the kernel who is at the other end of a Unix socket, since
+# Python 2's socket module knows neither getpeereid() nor the options
+# involved : platform prefix -> (level, option, buffer size, format, uid's index)
+PEERCREDENTIALS = (("linux", (socket.SOL_SOCKET, 17, 12, "3i", 1)),      # SO_PEERCRED : struct ucred
+                   ("openbsd", (socket.SOL_SOCKET, 0x1022, 12, "3i", 0)), # SO_PEERCRED : struct sockpeercred
+                   ("netbsd", (0, 3, 12, "3i", 1)),                       # LOCAL_PEEREID : struct unpcbid
+                   ("freebsd", (0, 1, 256, "Ii", 1)),                     # LOCAL_PEERCRED : struct xucred
+                   ("darwin", (0, 1, 256, "Ii", 1)),                      # LOCAL_PEERCRED : struct xucred
+                  )
+
+class Snapshot :
+    """A read only copy of some storage object's attributes."""
+    def __init__(self, attributes) :
+        """Initializes the snapshot from a mapping."""
+        self.__dict__.update(attributes)
+
+def takeSnapshot(obj, attributes) :
+    """Returns a mapping of obj's attributes suitable for transmission."""
+    values = {}
+    for name in attributes :
+        value = getattr(obj, name, None)
+        if not isinstance(value, SNAPSHOTTYPES) :
+            value = str(value)
+        values[name] = value
+    return values
+
+def sendMessage(sock, command, parameters) :
+    """Sends a command and its parameters through a connected socket."""
+    data = marshal.dumps((command, parameters))
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+def receiveExactly(sock, size) :
+    """Reads exactly size bytes from a connected socket, or returns None at end of file."""
+    chunks = []
+    while size :
+        data = sock.recv(size)
+        if not data :
+            return None
+        chunks.append(data)
+        size -= len(data)
+    return "".join(chunks)
+
+def receiveMessage(sock) :
+    """Receives a command and its parameters from a connected socket.
+
+       Returns (None, None) if the peer closed the connection.
+    """
+    header = receiveExactly(sock, 4)
+    if header is None :
+        return (None, None)
+    data = receiveExactly(sock, struct.unpack(">I", header)[0])
+    if data is None :
+        return (None, None)
+    try :
+        message = marshal.loads(data)
+    except (ValueError, EOFError, TypeError) :
+        raise PyKotaDaemonError, "Invalid message received from accounting daemon peer."
+    if (not isinstance(message, tuple)) or (len(message) != 2) or (not isinstance(message[0], str)) :
+        raise PyKotaDaemonError, "Invalid message received from accounting daemon peer."
+    return message
+
+def checkParameters(command, parameters) :
+    """Raises PyKotaDaemonError if a command's parameters are missing, of the wrong type, or negative."""
+    expected = COMMANDPARAMETERS.get(command)
+    if expected is None :
+        raise PyKotaDaemonError, "Unknown command %s" % command
+    if not isinstance(parameters, dict) :
+        raise PyKotaDaemonError, "Invalid parameters for %s" % command
+    for (name, types) in expected.items() :
+        if not parameters.has_key(name) :
+            raise PyKotaDaemonError, "Missing parameter %s for %s" % (name, command)
+        value = parameters[name]
+        if (not isinstance(value, types)) \
+           or (isinstance(value, NUMBERS) and (value < 0)) :
+            raise PyKotaDaemonError, "Incorrect value %s for parameter %s of %s" % (repr(value)[:50], name, command)
+        if name == "inkusage" :
+            for usage in value :
+                if not isinstance(usage, dict) :
+                    raise PyKotaDaemonError, "Incorrect ink usage for %s" % command
+                for (ink, percent) in usage.items() :
+                    if (not isinstance(ink, STRINGS)) \
+                       or (not isinstance(percent, NUMBERS)) \
+                       or (percent < 0) :
+                        raise PyKotaDaemonError, "Incorrect ink usage for %s" % command
+
+def getPeerUid(sock) :
+    """Returns the user id of the process connected to a Unix socket, or None if it can't be known."""
+    for (platform, (level, option, size, format, index)) in PEERCREDENTIALS :
+        if sys.platform.startswith(platform) :
+            try :
+                credentials = sock.getsockopt(level, option, size)
+                return struct.unpack(format, credentials[:struct.calcsize(format)])[index]
+            except (socket.error, struct.error) :
+                return None
+    return None
+
+def checkPeerCredentials() :
+    """Raises PyKotaDaemonError if getPeerUid() can't identify processes on this system."""
+    (first, second) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    try :
+        peeruid = getPeerUid(first)
+    finally :
+        first.close()
+        second.close()
+    if peeruid != os.geteuid() :
+        raise PyKotaDaemonError, "pykotad can't identify the processes connecting to its socket on this system (%s), and so can't run there." % sys.platform
+
+class AccountingSession :
+    """Storage related part of a print job's processing, done in the current process."""
+    userattributes = ("Name", "Exists", "Email", "LimitBy", "OverCharge", \
+                      "AccountBalance", "LifeTimePaid", "Description")
+    printerattributes = ("Name", "Exists", "Description", "MaxJobSize", \
+                         "PassThrough", "PricePerPage", "PricePerJob")
+    upquotaattributes = ("Exists", "PageCounter", "LifePageCounter", "SoftLimit", \
+                         "HardLimit", "DateLimit", "WarnCount")
+    lastjobattributes = ("Exists", "UserName", "JobDate", "JobMD5Sum", \
+                         "PrinterPageCounter", "JobSize")
+    def __init__(self, tool) :
+        """Initializes the session."""
+        self.tool = tool
+        self.config = tool.config
+        self.storage = tool.storage
+        self.Printer = None
+        self.User = None
+        self.UserPQuota = None
+        self.BillingCode = None
+
+    # the tool's quota checks, run with the session's configuration and storage,
+    # which pykotad may have replaced in the tool since the session began
+    _checkUserPQuota = PyKotaTool._checkUserPQuota.im_func
+    checkGroupPQuota = PyKotaTool.checkGroupPQuota.im_func
+    checkUserPQuota = PyKotaTool.checkUserPQuota.im_func
+
+    def logdebug(self, message) :
+        """Logs a debug message."""
+        self.tool.logdebug(message)
+
+    def printInfo(self, message, level="info") :
+        """Logs an informational message."""
+        self.tool.printInfo(message, level)
+
+    def close(self) :
+        """Nothing to do for local sessions."""
+        pass
+
+    def snapshots(self) :
+        """Returns the current printer, user and user print quota as transmissible mappings."""
+        printer = takeSnapshot(self.Printer, self.printerattributes)
+        printer["ParentPrinters"] = [p.Name for p in self.storage.getParentPrinters(self.Printer)]
+        printer["LastJob"] = takeSnapshot(self.Printer.LastJob, self.lastjobattributes)
+        return { "printer" : printer,
+                 "user" : takeSnapshot(self.User, self.userattributes),
+                 "userpquota" : takeSnapshot(self.UserPQuota, self.upquotaattributes),
+               }
+
+    def prepare(self, ticket) :
+        """Retrieves printer, user and user print quota, and decides if the job can be printed.
+
+           The ticket is a mapping describing the job. The answer is a
+           mapping containing the policy, the action and its reason,
+           the precomputed job's price, and snapshots of the printer,
+           user and user print quota entries.
+        """
+        self.Ticket = ticket
+        self.PrinterName = ticket["printername"]
+        self.UserName = ticket["username"]
+        self.Action = ticket["action"]
+        self.Reason = ticket["reason"]
+        self.softwareJobPrice = 0.0
+        timedCall(self.tool, "getPrinterUserAndUserPQuota", self.getPrinterUserAndUserPQuota)
+        if self.Policy == "OK" :
+            self.checkJob()
+        answer = { "policy" : self.Policy,
+                   "action" : self.Action,
+                   "reason" : self.Reason,
+                   "softwarejobprice" : self.softwareJobPrice,
+                 }
+        answer.update(self.snapshots())
+        return answer
+
+    def getPrinterUserAndUserPQuota(self) :
+        """Retrieves the policy, printer, user, and user print quota on this printer.
+
+           "OK" is set as the policy if both printer, user and user print quota
+           exist in the Quota Storage.
+           Otherwise, the policy as defined for this printer in pykota.conf is used.
+
+           If policy was set to "EXTERNAL" and one of printer, user, or user print quota
+           doesn't exist in the Quota Storage, then an external command is launched, as
+           defined in the external policy for this printer in pykota.conf
+           This external command can do anything, like automatically adding printers
+           or users, for example, and finally extracting printer, user and user print
+           quota from the Quota Storage is tried a second time.
+
+           "EXTERNALERROR" is set in case policy was "EXTERNAL" and an error status
+           was returned by the external command.
+        """
+        self.logdebug("Retrieving printer, user, and user print quota entry from database...")
+        for passnumber in range(1, 3) :
+            (printer, user, userpquota) = self.storage.getAccountingContext(self.PrinterName, self.UserName)
+            if printer.Exists and user.Exists and userpquota.Exists :
+                policy = "OK"
+                break
+            (policy, args) = self.config.getPrinterPolicy(self.PrinterName)
+            if policy == "EXTERNAL" :
+                commandline = self.tool.formatCommandLine(args, user, printer)
+                if not printer.Exists :
+                    self.printInfo(_("Printer %s not registered in the PyKota system, applying external policy (%s) for printer %s") % (self.PrinterName, commandline, self.PrinterName))
+                if not user.Exists :
+                    self.printInfo(_("User %s not registered in the PyKota system, applying external policy (%s) for printer %s") % (self.UserName, commandline, self.PrinterName))
+                if not userpquota.Exists :
+                    self.printInfo(_("User %s doesn't have quota on printer %s in the PyKota system, applying external policy (%s) for printer %s") % (self.UserName, self.PrinterName, commandline, self.PrinterName))
+                if os.system(commandline) :
+                    self.printInfo(_("External policy %s for printer %s produced an error. Job rejected. Please check PyKota's configuration files.") % (commandline, self.PrinterName), "error")
+                    policy = "EXTERNALERROR"
+                    break
+            else :
+                if not printer.Exists :
+                    self.printInfo(_("Printer %s not registered in the PyKota system, applying default policy (%s)") % (self.PrinterName, policy))
+                if not user.Exists :
+                    self.printInfo(_("User %s not registered in the PyKota system, applying default policy (%s) for printer %s") % (self.UserName, policy, self.PrinterName))
+                if not userpquota.Exists :
+                    self.printInfo(_("User %s doesn't have quota on printer %s in the PyKota system, applying default policy (%s)") % (self.UserName, self.PrinterName, policy))
+                break
+
+        if policy == "EXTERNAL" :
+            if not printer.Exists :
+                self.printInfo(_("Printer %s still not registered in the PyKota system, job will be rejected") % self.PrinterName)
+            if not user.Exists :
+                self.printInfo(_("User %s still not registered in the PyKota system, job will be rejected on printer %s") % (self.UserName, self.PrinterName))
+            if not userpquota.Exists :
+                self.printInfo(_("User %s still doesn't have quota on printer %s in the PyKota system, job will be rejected") % (self.UserName, self.PrinterName))
+        self.Policy = policy
+        self.Printer = printer
+        self.User = user
+        self.UserPQuota = userpquota
+        self.logdebug("Retrieval of printer, user and user print quota entry done.")
+
+    def precomputeJobPrice(self) :
+        """Precomputes the job price with a software method."""
+        self.logdebug("Precomputing job's price...")
+        self.softwareJobPrice = self.UserPQuota.computeJobPrice(self.Ticket["softwarejobsize"], \
+                                                                self.Ticket["inkusage"])
+        self.logdebug("Precomputed job's price is %.3f credits." \
+                                   % self.softwareJobPrice)
+
+    def checkJob(self) :
+        """Checks if the job can be printed."""
+        self.precomputeJobPrice()
+        softwarejobsize = self.Ticket["softwarejobsize"]
+        if self.Action not in ("DENY", "CANCEL") :
+            if self.Printer.MaxJobSize and (softwarejobsize > self.Printer.MaxJobSize) :
+                # This printer was set to refuse jobs this large.
+                self.printInfo(_("Precomputed job size (%s pages) too large for printer %s.") % (softwarejobsize, self.PrinterName), "warn")
+                self.Action = "DENY"
+                # here we don't put the precomputed job size in the message
+                # because in case of error the user could complain :-)
+                self.Reason = _("You are not allowed to print so many pages on printer %s at this time.") % self.PrinterName
+
+        if self.Action not in ("DENY", "CANCEL") :
+            if self.User.LimitBy == "noprint" :
+                self.printInfo(_("User %s is not allowed to print at this time.") % self.UserName, "warn")
+                self.Action = "DENY"
+                self.Reason = _("Your account settings forbid you to print at this time.")
+
+        if self.Action not in ("DENY", "CANCEL") :
+            # If printing is still allowed at this time, we
+            # need to extract the billing code information from the database.
+            # No need to do this if the job is denied, this way we
+            # save some database queries.
+            self.getBillingCode()
+
+        if self.Action not in ("DENY", "CANCEL") :
+            # If printing is still allowed at this time, we
+            # need to check if the job is a dupe or not, and what to do then.
+            # No need to do this if the job is denied, this way we
+            # save some database queries.
+            self.checkIfDupe()
+
+        if self.Action not in ("DENY", "CANCEL") :
+            # If printing is still allowed at this time, we
+            # need to check the user's print quota on the current printer.
+            # No need to do this if the job is denied, this way we
+            # save some database queries.
+            if self.User.LimitBy in ('noquota', 'nochange') :
+                self.logdebug("User %s is allowed to print with no limit, no need to check quota." % self.UserName)
+            elif self.Printer.PassThrough :
+                self.logdebug("Printer %s is in PassThrough mode, no need to check quota." % self.PrinterName)
+            else :
+                self.logdebug("Checking user %s print quota entry on printer %s" \
+                                    % (self.UserName, self.PrinterName))
+                self.Action = timedCall(self.tool, "checkUserPQuota", self.checkUserPQuota, \
+                                        self.UserPQuota, softwarejobsize, self.softwareJobPrice)
+                if self.Action.startswith("POLICY_") :
+                    self.Action = self.Action[7:]
+                if self.Action == "DENY" :
+                    self.printInfo(_("Print Quota exceeded for user %s on printer %s") % (self.UserName, self.PrinterName))
+                    self.Reason = self.config.getHardWarn(self.PrinterName)
+                elif self.Action == "WARN" :
+                    self.printInfo(_("Print Quota low for user %s on printer %s") % (self.UserName, self.PrinterName))
+                    if self.User.LimitBy and (self.User.LimitBy.lower() == "balance") :
+                        self.Reason = self.config.getPoorWarn()
+                    else :
+                        self.Reason = self.config.getSoftWarn(self.PrinterName)
+
+    def getBillingCode(self) :
+        """Extracts the billing code from the database.
+
+           An optional script is launched to notify the user when
+           the billing code is unknown and PyKota was configured to
+           deny printing in this case.
+        """
+        self.logdebug("Retrieving billing code information from the database...")
+        self.BillingCode = None
+        jobbillingcode = self.Ticket["billingcode"]
+        if jobbillingcode :
+            self.BillingCode = self.storage.getBillingCode(jobbillingcode)
+            if self.BillingCode.Exists :
+                self.logdebug("Billing code [%s] found in database." % jobbillingcode)
+            else :
+                msg = "Unknown billing code [%s] : " % jobbillingcode
+                (newaction, script) = self.config.getUnknownBillingCode(self.PrinterName)
+                if newaction == "CREATE" :
+                    self.logdebug(msg + "will be created.")
+                    self.storage.addBillingCode(self.BillingCode)
+                    self.BillingCode = self.storage.getBillingCode(jobbillingcode)
+                    if self.BillingCode.Exists :
+                        self.logdebug(msg + "has been created.")
+                    else :
+                        self.printInfo(msg + "couldn't be created.", "error")
+                else :
+                    self.logdebug(msg + "job will be denied.")
+                    self.Action = newaction
+                    if script is not None :
+                        self.logdebug(msg + "launching subprocess [%s] to notify user." % script)
+                        os.system(script)
+        self.logdebug("Retrieval of billing code information done.")
+
+    def checkIfDupe(self) :
+        """Checks if the job is a duplicate, and handles the situation."""
+        self.logdebug("Checking if the job is a duplicate...")
+        denyduplicates = self.config.getDenyDuplicates(self.PrinterName)
+        if not denyduplicates :
+            self.logdebug("We don't care about duplicate jobs after all.")
+        else :
+            now = DateTime.now()
+            previous = None
+            recentjob = self.storage.getUserRecentJob(self.UserName)
+            if recentjob is not None :
+                # the user's recent jobs, whatever the printer
+                jobtime = recentjob.getJobTimes().get(self.Ticket["md5sum"])
+                if jobtime is not None :
+                    self.logdebug("User %s recently printed the same job." % self.UserName)
+                    previous = DateTime.DateTimeFromTicks(jobtime)
+            if (previous is None) \
+                    and self.Printer.LastJob.Exists \
+                    and (self.Printer.LastJob.UserName == self.UserName) \
+                    and (self.Printer.LastJob.JobMD5Sum == self.Ticket["md5sum"]) :
+                try :
+                    previous = DateTime.ISO.ParseDateTime(str(self.Printer.LastJob.JobDate)[:19])
+                except :
+                    previous = now
+            if previous is not None :
+                difference = (now - previous).seconds
+                duplicatesdelay = self.config.getDuplicatesDelay(self.PrinterName)
+                self.logdebug("Difference with previous job : %.2f seconds. Duplicates delay : %.2f seconds." % (difference, duplicatesdelay))
+                if difference > duplicatesdelay :
+                    self.logdebug("Duplicate job allowed because previous one is more than %.2f seconds old." % duplicatesdelay)
+                else :
+                    msg = _("Job is a dupe")
+                    if denyduplicates == 1 :
+                        self.printInfo("%s : %s." % (msg, _("Printing is denied by configuration")), "warn")
+                        self.Action = "DENY"
+                        self.Reason = _("Duplicate print jobs are not allowed on printer %s.") % self.PrinterName
+                    else :
+                        self.logdebug("Launching subprocess [%s] to see if duplicate jobs should be allowed or not." % denyduplicates)
+                        fanswer = os.popen(denyduplicates, "r")
+                        self.Action = fanswer.read().strip().upper()
+                        fanswer.close()
+                        if self.Action == "DENY" :
+                            self.printInfo("%s : %s." % (msg, _("Subprocess denied printing of a dupe")), "warn")
+                            self.Reason = _("Duplicate print jobs are not allowed on printer %s at this time.") % self.PrinterName
+                        else :
+                            self.printInfo("%s : %s." % (msg, _("Subprocess allowed printing of a dupe")), "warn")
+            else :
+                self.logdebug("Job doesn't seem to be a duplicate.")
+        self.logdebug("Checking if the job is a duplicate done.")
+
+    def denyBanner(self) :
+        """Increments the number of deny banners and returns the new user print quota snapshot."""
+        self.UserPQuota.incDenyBannerCounter() # increments the warning counter
+        return takeSnapshot(self.UserPQuota, self.upquotaattributes)
+
+    def commit(self, results) :
+        """Updates the user's quota and the history once the job was sent to the printer.
+
+           The results are a mapping containing the final action, the
+           job's size, the printer's page counter and the ink usage.
+           The answer is a mapping containing the job's price and
+           fresh snapshots of the user and user print quota entries.
+        """
+        # Do all these database changes within a single transaction
+        # NB : we don't enclose ALL the changes within a single transaction
+        # because while waiting for the printer to answer its internal page
+        # counter, we would open the door to accounting problems for other
+        # jobs launched by the same user at the same time on other printers.
+        # All the code below doesn't take much time, so it's fine.
+        ticket = self.Ticket
+        action = results["action"]
+        jobsize = results["jobsize"]
+        self.storage.beginTransaction()
+        try :
+            onbackenderror = self.config.getPrinterOnBackendError(self.PrinterName)
+            if action not in ("DENY", "CANCEL") :
+                self.UserPQuota.resetDenyBannerCounter()
+
+            if ((action == "PROBLEM") and ("NOCHARGE" in onbackenderror)) or \
+                (action in ("DENY", "CANCEL")) :
+                jobprice = 0.0
+            elif (self.User.LimitBy == "nochange") or self.Printer.PassThrough :
+                # no need to update the quota for the current user on this printer
+                self.printInfo(_("User %s's quota on printer %s won't be modified") % (self.UserName, self.PrinterName))
+                jobprice = 0.0
+            else :
+                # update the quota for the current user on this printer
+                self.printInfo(_("Updating user %s's quota on printer %s") % (self.UserName, self.PrinterName))
+                jobprice = self.UserPQuota.increasePagesUsage(jobsize, results["inkusage"])
+
+            # adds the current job to history
+            self.Printer.addJobToHistory(ticket["jobid"], self.User, results["lastpagecounter"], \
+                                    action, jobsize, jobprice, ticket["filename"], \
+                                    ticket["title"], ticket["copies"], ticket["options"], ticket["clienthost"], \
+                                    ticket["jobsizebytes"], ticket["md5sum"], None, ticket["billingcode"], \
+                                    ticket["softwarejobsize"], self.softwareJobPrice)
+            self.printInfo(_("Job added to history."))
+            self.storage.rememberUserJob(self.UserName, ticket["md5sum"])
+
+            if self.BillingCode and self.BillingCode.Exists :
+                if (action in ("ALLOW", "WARN")) or \
+                   ((action == "PROBLEM") and ("CHARGE" in onbackenderror)) :
+                    self.BillingCode.consume(jobsize, jobprice)
+                    self.printInfo(_("Billing code %s was updated.") % self.BillingCode.BillingCode)
+        except :
+            self.storage.rollbackTransaction()
+            raise
+        else :
+            self.storage.commitTransaction()
+        return { "jobprice" : jobprice,
+                 "user" : takeSnapshot(self.User, self.userattributes),
+                 "userpquota" : takeSnapshot(self.UserPQuota, self.upquotaattributes),
+               }
+
+class DaemonSession(AccountingSession) :
+    """Accounting session done inside the pykotad daemon on behalf of a CUPS backend."""
+    def improveMessage(self, message) :
+        """Improves a message by adding more informations in it if possible."""
+        try :
+            return "%s@%s(%s) => %s" % (self.UserName, \
+                                        self.PrinterName, \
+                                        self.Ticket["jobid"], \
+                                        message)
+        except AttributeError :
+            return message
+
+    def logdebug(self, message) :
+        """Improves the debug message before outputting it."""
+        if self.tool.debug :
+            self.tool.logdebug(self.improveMessage(message))
+
+    def printInfo(self, message, level="info") :
+        """Improves the informational message before outputting it."""
+        self.tool.printInfo(self.improveMessage(message), level)
+
+    def prepare(self, ticket) :
+        """Flushes cached entries which accounting may have changed, then prepares the job."""
+        username = ticket["username"]
+        printername = ticket["printername"]
+        # Entries modified by other processes are already invalidated in
+        # the shared cache, if any, so only our own copies are flushed.
+        self.storage.flushEntry("USERS", username, shared=False)
+        self.storage.flushEntry("LASTJOBS", printername, shared=False)
+        self.storage.flushEntries("USERPQUOTAS", lambda key : key.split("@", 1)[0] == username, shared=False)
+        self.storage.flushEntries("GROUPPQUOTAS", shared=False)
+        if self.storage.usecache :
+            printer = self.storage.caches["PRINTERS"].peek(printername)
+            if (printer is not None) and hasattr(printer, "LastJob") :
+                del printer.LastJob
+        return AccountingSession.prepare(self, ticket)
+
+class DaemonClient :
+    """Accounting session done by the pykotad daemon, as seen from the CUPS backend."""
+    def __init__(self, tool, socketpath, timeout=None) :
+        """Connects to the accounting daemon."""
+        self.tool = tool
+        self.socketpath = socketpath
+        self.timeout = timeout
+        try :
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(socketpath)
+        except socket.error, msg :
+            raise PyKotaDaemonError, _("Unable to connect to accounting daemon on %s : %s") % (socketpath, msg)
+        self.tool.logdebug("Connected to accounting daemon on %s" % socketpath)
+
+    def request(self, command, parameters) :
+        """Sends a command to the accounting daemon and returns its answer."""
+        try :
+            sendMessage(self.sock, command, parameters)
+            (status, answer) = receiveMessage(self.sock)
+        except socket.error, msg :
+            raise PyKotaDaemonError, _("Communication with accounting daemon on %s failed : %s") % (self.socketpath, msg)
+        if status is None :
+            raise PyKotaDaemonError, _("Accounting daemon on %s closed the connection.") % self.socketpath
+        elif status != "OK" :
+            raise PyKotaDaemonError, _("Accounting daemon on %s failed : %s") % (self.socketpath, answer)
+        return answer
+
+    def prepare(self, ticket) :
+        """Asks the daemon to prepare the job."""
+        return self.request("PREPARE", ticket)
+
+    def denyBanner(self) :
+        """Asks the daemon to increment the number of deny banners."""
+        return self.request("DENYBANNER", {})
+
+    def commit(self, results) :
+        """Asks the daemon to account for the job."""
+        return self.request("COMMIT", results)
+
+    def getPrinterSample(self, hostname, community, since, timeout) :
+        """Asks the daemon for the first sample of a printer's SNMP state taken after since."""
+        if self.timeout is not None :
+            timeout = min(timeout, self.timeout / 2.0)
+        return self.request("SNMPSAMPLE", { "hostname" : hostname,
+                                            "community" : community,
+                                            "since" : since,
+                                            "timeout" : timeout,
+                                          })
+
+    def close(self) :
+        """Closes the connection to the daemon."""
+        try :
+            sendMessage(self.sock, "QUIT", {})
+        except socket.error :
+            pass
+        self.sock.close()
+
+def openSession(tool) :
+    """Returns an accounting session, through the pykotad daemon if possible."""
+    socketpath = tool.config.getDaemonSocket()
+    if socketpath :
+        try :
+            return DaemonClient(tool, socketpath, tool.config.getDaemonTimeout())
+        except PyKotaDaemonError, msg :
+            tool.printInfo("%s : %s" % (msg, _("accounting will be done locally")), "warn")
+    if getattr(tool, "storage", None) is None :
+        tool.storage = storage.openConnection(tool)
+    return AccountingSession(tool)
+
+class DaemonRequestHandler(SocketServer.BaseRequestHandler) :
+    """Handles the connection of a single CUPS backend to the daemon."""
+    def handle(self) :
+        """Checks who the backend is, then serves it through a new session."""
+        daemon = self.server.daemon
+        peeruid = getPeerUid(self.request)
+        if peeruid not in daemon.alloweduids :
+            daemon.printInfo("Connection refused to a process running as uid %s" % peeruid, "warn")
+            return
+        daemon.lock.acquire()
+        try :
+            daemon.reloadConfigurationIfNeeded()
+            session = DaemonSession(daemon)
+            daemon.useStorage(session.storage)
+        finally :
+            daemon.lock.release()
+        try :
+            self.serve(session)
+        finally :
+            daemon.lock.acquire()
+            try :
+                daemon.releaseStorage(session.storage)
+            finally :
+                daemon.lock.release()
+
+    def serve(self, session) :
+        """Serves commands until the backend disconnects."""
+        daemon = self.server.daemon
+        while True :
+            try :
+                (command, parameters) = receiveMessage(self.request)
+            except (socket.error, PyKotaDaemonError), msg :
+                daemon.printInfo("Connection to backend lost : %s" % msg, "warn")
+                break
+            if command in (None, "QUIT") :
+                break
+            try :
+                checkParameters(command, parameters)
+            except PyKotaDaemonError, msg :
+                daemon.printInfo("Request refused : %s" % msg, "warn")
+                (status, answer) = ("ERROR", str(msg))
+            else :
+                if command == "SNMPSAMPLE" :
+                    # may wait for a while, but doesn't need the database
+                    (status, answer) = daemon.getPrinterSample(parameters)
+                else :
+                    (status, answer) = self.process(session, command, parameters)
+            try :
+                sendMessage(self.request, status, answer)
+            except socket.error, msg :
+                daemon.printInfo("Connection to backend lost : %s" % msg, "warn")
+                break
+
+    def process(self, session, command, parameters) :
+        """Processes a command which accesses the database, one at a time."""
+        daemon = self.server.daemon
+        daemon.lock.acquire()
+        try :
+            try :
+                if command == "PREPARE" :
+                    (status, answer) = ("OK", session.prepare(parameters))
+                elif command == "DENYBANNER" :
+                    (status, answer) = ("OK", session.denyBanner())
+                elif command == "COMMIT" :
+                    (status, answer) = ("OK", session.commit(parameters))
+                else :
+                    (status, answer) = ("ERROR", "Unknown command %s" % command)
+            except :
+                daemon.crashed("pykotad failed while processing %s" % command)
+                (status, answer) = ("ERROR", "%s failed" % command)
+        finally :
+            daemon.lock.release()
+        return (status, answer)
+
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer) :
+    """Multithreaded Unix socket server."""
+    daemon_threads = True
+
+class PyKotaDaemon(PyKotaTool) :
+    """A class for the pykotad accounting daemon."""
+    def dumpStatistics(self, signum, frame) :
+        """Outputs the storage statistics when SIGUSR1 is received."""
+        self.storage.dumpCacheStatistics(self.printInfo)
+        dumpImportStatistics(self.printInfo)
+        if hasattr(self.storage, "dumpStatementStatistics") :
+            self.storage.dumpStatementStatistics(self.printInfo)
+        if hasattr(self.storage, "dumpPoolStatistics") :
+            self.storage.dumpPoolStatistics(self.printInfo)
+        if self.poller is not None :
+            self.poller.dumpStatistics(self.printInfo)
+
+    def requestReload(self, signum, frame) :
+        """Makes the configuration be read again before the next session when SIGHUP is received."""
+        self.reloadrequested = True
+
+    def reloadConfigurationIfNeeded(self) :
+        """Reads the configuration again and reopens the storage if SIGHUP was received or pykota.conf was modified.
+
+           Sessions already opened keep the previous configuration and
+           storage until their job is done, then the previous storage
+           is closed. If the new configuration
+           is incorrect, the previous one is kept.
+        """
+        try :
+            configkey = self.config.snapshotKey()
+        except OSError :
+            configkey = self.configkey
+        if (not self.reloadrequested) and (configkey == self.configkey) :
+            return
+        self.reloadrequested = False
+        self.configkey = configkey
+        (previousconfig, previousstorage) = (self.config, self.storage)
+        try :
+            self.config = config.PyKotaConfig(previousconfig.directory)
+            debug = self.config.getDebug()
+            smtpserver = self.config.getSMTPServer()
+            maildomain = self.config.getMailDomain()
+            newstorage = storage.openConnection(self) # uses self.config
+        except (config.PyKotaConfigError, storage.PyKotaStorageError), msg :
+            self.config = previousconfig
+            self.printInfo(_("Unable to reload the configuration, the previous one is kept : %s") % msg, "error")
+            return
+        except :
+            self.config = previousconfig
+            raise
+        (self.debug, self.smtpserver, self.maildomain, self.storage) = (debug, smtpserver, maildomain, newstorage)
+        if not self.storageusers.has_key(id(previousstorage)) :
+            previousstorage.close()
+        self.printInfo(_("pykotad reloaded its configuration from %s") % self.config.filename)
+
+    def useStorage(self, storage) :
+        """Records that a session uses a storage, the lock being held."""
+        self.storageusers[id(storage)] = self.storageusers.get(id(storage), 0) + 1
+
+    def releaseStorage(self, storage) :
+        """Records that a session doesn't use a storage anymore, the lock being held.
+
+           A storage replaced when the configuration was reloaded is
+           closed once the last session using it is over.
+        """
+        key = id(storage)
+        self.storageusers[key] -= 1
+        if not self.storageusers[key] :
+            del self.storageusers[key]
+            if storage is not self.storage :
+                storage.close()
+
+    def getPrinterSample(self, parameters) :
+        """Returns the first sample of a printer's SNMP state taken after a given time, starting to poll it if needed."""
+        self.lock.acquire()
+        try :
+            if self.poller is None :
+                interval = self.config.getSNMPPollInterval()
+                if not interval :
+                    return ("ERROR", "SNMP polling is disabled")
+                try :
+                    from pykota.accounters import snmp
+                except RuntimeError, msg :
+                    return ("ERROR", str(msg))
+                self.poller = snmp.SNMPPoller(self, interval)
+        finally :
+            self.lock.release()
+        try :
+            return ("OK", self.poller.getSample(parameters["hostname"], \
+                                                parameters["community"], \
+                                                parameters["since"], \
+                                                parameters["timeout"]))
+        except :
+            self.crashed("pykotad failed while polling printer %s" % parameters.get("hostname"))
+            return ("ERROR", "SNMPSAMPLE failed")
+
+    def main(self, options) :
+        """Serves CUPS backends until killed."""
+        checkPeerCredentials()
+        socketpath = options["socket"]
+        if os.path.exists(socketpath) :
+            os.remove(socketpath)
+        self.lock = threading.Lock()
+        self.poller = None
+        self.reloadrequested = False
+        self.configkey = self.config.snapshotKey()
+        self.storageusers = {} # number of sessions using each storage
+        self.alloweduids = [0]
+        for username in ("lp", "pykota") :
+            try :
+                self.alloweduids.append(pwd.getpwnam(username)[2])
+            except KeyError :
+                pass
+        server = DaemonServer(socketpath, DaemonRequestHandler)
+        server.daemon = self
+        os.chmod(socketpath, 0660)
+        signal.signal(signal.SIGUSR1, self.dumpStatistics)
+        signal.signal(signal.SIGHUP, self.requestReload)
+        self.printInfo(_("pykotad listening on %s") % socketpath)
+        try :
+            server.serve_forever()
+        finally :
+            server.server_close()
+            try :
+                os.remove(socketpath)
+            except OSError :
+                pass
+        return 0
@@ -30,17 +30,8 @@ from xml.sax import saxutils
 
 from mx import DateTime
 
-try :
-    import jaxml
-except ImportError :    
-    sys.stderr.write("The jaxml Python module is not installed. XML output is disabled.\n")
-    sys.stderr.write("Download jaxml from http://www.librelogiciel.com/software/ or from your Debian archive of choice\n")
-    hasJAXML = 0
-else :    
-    hasJAXML = 1
-
 from pykota import version
-from pykota.tool import PyKotaTool, PyKotaToolError, PyKotaCommandLineError, N_
+from pykota.tool import PyKotaTool, PyKotaCommandLineError, N_
 
 class DumPyKota(PyKotaTool) :        
     """A class for dumpykota."""
@@ -94,6 +85,9 @@ class DumPyKota(PyKotaTool) :
         else :
             orderby = []
             
+        if options["groupby"] :
+            options["sum"] = 1
+            
         extractonly = {}
         if datatype == "all" :            
             if (options["format"] != "xml") or options["sum"] or arguments :
@@ -119,8 +113,8 @@ class DumPyKota(PyKotaTool) :
               and ((datatype != "history") or options["sum"])) :
             raise PyKotaCommandLineError, _("Invalid modifier [%s] for --format command line option, see help.") % format
             
-        if (format == "xml") and not hasJAXML :
-            raise PyKotaToolError, _("XML output is disabled because the jaxml module is not available.")
+        if format == "cups" :
+            orderby = ["+jobdate"] # CUPS' page_log is chronological
             
         if datatype not in ("payments", "history") : 
             if options["sum"] : 
@@ -136,8 +130,19 @@ class DumPyKota(PyKotaTool) :
                 except KeyError :    
                     pass
             
+        if options["sum"] :
+            if options["groupby"] :
+                keys = [k.strip().lower() for k in options["groupby"].split(",") if k.strip()]
+                for key in keys :
+                    if key not in self.storage.summarykeys[datatype] :
+                        raise PyKotaCommandLineError, _("Invalid grouping key [%s] for --groupby command line option, see help.") % key
+            elif datatype == "payments" :
+                keys = [ "username" ]
+            else :    
+                keys = [ k for k in ("username", "printername", "hostname", "billingcode") if k in extractonly.keys() ]
+                
         retcode = 0
-        nbentries = 0    
+        dumped = 0    
         mustclose = 0    
         if options["output"].strip() == "-" :    
             self.outfile = sys.stdout
@@ -147,96 +152,36 @@ class DumPyKota(PyKotaTool) :
             
         if datatype == "all" :    
             # NB : order does matter to allow easier or faster restore
-            allentries = []
             datatypes = [ "printers", "pmembers", "users", "groups", \
                           "billingcodes", "umembers", "upquotas", \
                           "gpquotas", "payments", "history" ]
-            neededdatatypes = datatypes[:]              
+            # Each data type is extracted only once the previous one
+            # has been written, so only one of them is in memory.
+            self.startXml()
             for datatype in datatypes :
                 entries = getattr(self.storage, "extract%s" % datatype.title())(extractonly) # We don't care about ordering here
                 if entries :
-                    nbentries += len(entries)
-                    allentries.append(entries)
-                else :    
-                    neededdatatypes.remove(datatype)
-            retcode = self.dumpXml(allentries, neededdatatypes)
+                    dumped = 1
+                    retcode = self.dumpXmlEntries(entries, datatype)
+                    if retcode :
+                        break
+            self.endXml()
         else :    
-            entries = getattr(self.storage, "extract%s" % datatype.title())(extractonly, orderby)
+            if options["sum"] :
+                entries = getattr(self.storage, "summarize%s" % datatype.title())(extractonly, keys)
+            else :    
+                entries = getattr(self.storage, "extract%s" % datatype.title())(extractonly, orderby)
             if entries :
-                nbentries = len(entries)
-                retcode = getattr(self, "dump%s" % format.title())([self.summarizeDatas(entries, datatype, extractonly, options["sum"])], [datatype])
+                dumped = 1
+                retcode = getattr(self, "dump%s" % format.title())([entries], [datatype])
                 
         if mustclose :
             self.outfile.close()
-            if not nbentries : 
+            if not dumped : 
                 os.remove(options["output"])
             
         return retcode
         
-    def summarizeDatas(self, entries, datatype, extractonly, sum=0) :    
-        """Transforms the datas into a summarized view (with totals).
-        
-           If sum is false, returns the entries unchanged.
-        """   
-        if not sum :
-            return entries
-        else :    
-            headers = entries[0]
-            nbheaders = len(headers)
-            fieldnumber = {}
-            fieldname = {}
-            for i in range(nbheaders) :
-                fieldnumber[headers[i]] = i
-            
-            if datatype == "payments" :
-                totalize = [ ("amount", float) ]
-                keys = [ "username" ]
-            else : # elif datatype == "history"
-                totalize = [ ("jobsize", int), 
-                             ("jobprice", float),
-                             ("jobsizebytes", int),
-                             ("precomputedjobsize", int),
-                             ("precomputedjobprice", float),
-                           ]
-                keys = [ k for k in ("username", "printername", "hostname", "billingcode") if k in extractonly.keys() ]
-                
-            newentries = [ headers ]
-            sortedentries = entries[1:]
-            if keys :
-                # If we have several keys, we can sort only on the first one, because they
-                # will vary the same way.
-                sortedentries.sort(lambda x, y, fnum=fieldnumber[keys[0]] : cmp(x[fnum], y[fnum]))
-            totals = {}
-            for (k, t) in totalize :
-                totals[k] = { "convert" : t, "value" : 0.0 }
-            prevkeys = {}
-            for k in keys :
-                prevkeys[k] = sortedentries[0][fieldnumber[k]]
-            for entry in sortedentries :
-                curval = '-'.join([str(entry[fieldnumber[k]]) for k in keys])
-                prevval = '-'.join([str(prevkeys[k]) for k in keys])
-                if curval != prevval :
-                    summary = [ "*" ] * nbheaders
-                    for k in keys :
-                        summary[fieldnumber[k]] = prevkeys[k]
-                    for k in totals.keys() :    
-                        summary[fieldnumber[k]] = totals[k]["convert"](totals[k]["value"])
-                    newentries.append(summary)
-                    for k in totals.keys() :    
-                        totals[k]["value"] = totals[k]["convert"](entry[fieldnumber[k]])
-                else :    
-                    for k in totals.keys() :    
-                        totals[k]["value"] += totals[k]["convert"](entry[fieldnumber[k]] or 0.0)
-                for k in keys :
-                    prevkeys[k] = entry[fieldnumber[k]]
-            summary = [ "*" ] * nbheaders
-            for k in keys :
-                summary[fieldnumber[k]] = prevkeys[k]
-            for k in totals.keys() :    
-                summary[fieldnumber[k]] = totals[k]["convert"](totals[k]["value"])
-            newentries.append(summary)
-            return newentries
-            
     def dumpWithSeparator(self, separator, allentries) :    
         """Dumps datas with a separator."""
         for entries in allentries :
@@ -269,14 +214,11 @@ class DumPyKota(PyKotaTool) :
     def dumpCups(self, allentries, dummy) :    
         """Dumps history datas as CUPS' page_log format."""
         months = [ "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec" ]
-        entries = allentries[0]
-        fieldnames = entries[0]
+        entries = iter(allentries[0]) # already sorted by date
+        fieldnames = entries.next()
         fields = {}
         for i in range(len(fieldnames)) :
             fields[fieldnames[i]] = i
-        sortindex = fields["jobdate"]    
-        entries = entries[1:]
-        entries.sort(lambda m, n, si=sortindex : cmp(m[si], n[si]))
         for entry in entries :    
             printername = entry[fields["printername"]]
             username = entry[fields["username"]]
@@ -300,17 +242,26 @@ class DumPyKota(PyKotaTool) :
                 self.outfile.write("%s %s %s [%s] %s %s %s %s\n" % (printername, username, jobid, jobdate, pagenum, copies, billingcode, hostname))
         return 0        
         
-    def dumpXml(self, allentries, datatypes) :
-        """Dumps datas as XML."""
-        x = jaxml.XML_document(encoding="UTF-8")
-        x.pykota(version=version.__version__, author=version.__author__)
-        for (entries, datatype) in zip(allentries, datatypes) :
-            x._push()
-            x.dump(storage=self.config.getStorageBackend()["storagebackend"], type=datatype)
-            headers = entries[0]
-            for entry in entries[1:] :
-                x._push()
-                x.entry()
+    def startXml(self) :
+        """Writes the beginning of an XML dump."""
+        self.outfile.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.outfile.write("<pykota version=%s author=%s>\n" % (saxutils.quoteattr(version.__version__), \
+                                                               saxutils.quoteattr(version.__author__)))
+        
+    def endXml(self) :
+        """Writes the end of an XML dump."""
+        self.outfile.write("</pykota>\n")
+        
+    def dumpXmlEntries(self, entries, datatype) :
+        """Writes the entries of a data type as XML, one at a time."""
+        write = self.outfile.write
+        try :
+            write('  <dump storage=%s type=%s>\n' % (saxutils.quoteattr(self.config.getStorageBackend()["storagebackend"]), \
+                                                    saxutils.quoteattr(datatype)))
+            entries = iter(entries)
+            headers = entries.next()
+            for entry in entries :
+                write("    <entry>\n")
                 for (header, value) in zip(headers, entry) :
                     strvalue = str(value)
                     typval = type(value).__name__
@@ -320,10 +271,23 @@ class DumPyKota(PyKotaTool) :
                             strvalue = unicode(strvalue, self.charset).encode("UTF-8")
                         except UnicodeError :    
                             pass
-                        strvalue = saxutils.escape(strvalue, { "'" : "&apos;", \
-                                                               '"' : "&quot;" })
-                    x.attribute(strvalue, type=typval, name=header)
-                x._pop()    
-            x._pop()    
-        x._output(self.outfile)
-        return 0        
+                    write('      <attribute type=%s name=%s>%s</attribute>\n' % (saxutils.quoteattr(typval), \
+                                                                               saxutils.quoteattr(header), \
+                                                                               saxutils.escape(strvalue, { "'" : "&apos;", \
+                                                                                                           '"' : "&quot;" })))
+                write("    </entry>\n")
+            write("  </dump>\n")
+        except IOError, msg :    
+            sys.stderr.write("%s : %s\n" % (_("PyKota data dumper failed : I/O error"), msg))
+            return -1
+        return 0
+        
+    def dumpXml(self, allentries, datatypes) :
+        """Dumps datas as XML."""
+        self.startXml()
+        for (entries, datatype) in zip(allentries, datatypes) :
+            retcode = self.dumpXmlEntries(entries, datatype)
+            if retcode :
+                return retcode
+        self.endXml()
+        return 0
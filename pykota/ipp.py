@@ -27,7 +27,8 @@
 """This module provides basic IPP request parsing facilities."""
 
 import sys
-from struct import pack, unpack
+import time
+from struct import pack, unpack, error
 
 class IPPError(Exception):
     """An exception for IPP related stuff."""
@@ -38,6 +39,68 @@ class IPPError(Exception):
         return self.message
     __str__ = __repr__
 
+# Tags, indexed by their value, None meaning reserved
+TAGS = [ None ] * 256
+
+# Delimiter tags
+TAGS[0x01] = "operation-attributes-tag"
+TAGS[0x02] = "job-attributes-tag"
+TAGS[0x03] = "end-of-attributes-tag"
+TAGS[0x04] = "printer-attributes-tag"
+TAGS[0x05] = "unsupported-attributes-tag"
+TAGS[0x06] = "subscription-attributes-tag"
+TAGS[0x07] = "event_notification-attributes-tag"
+
+# out of band values
+TAGS[0x10] = "unsupported"
+TAGS[0x11] = "reserved-for-future-default"
+TAGS[0x12] = "unknown"
+TAGS[0x13] = "no-value"
+TAGS[0x15] = "not-settable"
+TAGS[0x16] = "delete-attribute"
+TAGS[0x17] = "admin-define"
+
+# integer values
+TAGS[0x20] = "generic-integer"
+TAGS[0x21] = "integer"
+TAGS[0x22] = "boolean"
+TAGS[0x23] = "enum"
+
+# octetString
+TAGS[0x30] = "octetString-with-an-unspecified-format"
+TAGS[0x31] = "dateTime"
+TAGS[0x32] = "resolution"
+TAGS[0x33] = "rangeOfInteger"
+TAGS[0x34] = "begCollection" # TODO : find sample files for testing
+TAGS[0x35] = "textWithLanguage"
+TAGS[0x36] = "nameWithLanguage"
+TAGS[0x37] = "endCollection"
+
+# character strings
+TAGS[0x40] = "generic-character-string"
+TAGS[0x41] = "textWithoutLanguage"
+TAGS[0x42] = "nameWithoutLanguage"
+TAGS[0x44] = "keyword"
+TAGS[0x45] = "uri"
+TAGS[0x46] = "uriScheme"
+TAGS[0x47] = "charset"
+TAGS[0x48] = "naturalLanguage"
+TAGS[0x49] = "mimeMediaType"
+TAGS[0x4a] = "memberAttrName"
+
+# Reverse mapping to generate IPP messages
+DICTAGS = {}
+for i in range(len(TAGS)) :
+    if TAGS[i] is not None :
+        DICTAGS[TAGS[i]] = i
+
+ENDOFATTRIBUTES = DICTAGS["end-of-attributes-tag"]
+MAXDELIMITER = DICTAGS["event_notification-attributes-tag"]
+DECODERS = { "integer" : lambda value : unpack(">I", value)[0],
+             "enum" : lambda value : unpack(">I", value)[0],
+             "boolean" : ord,
+           }
+
 class IPPRequest :
     """A class for IPP requests.
     
@@ -96,61 +159,8 @@ class IPPRequest :
         for attrtype in self.attributes_types :
             setattr(self, "%s_attributes" % attrtype, {})
             
-        # Initialize tags    
-        self.tags = [ None ] * 256 # by default all tags reserved
-        
-        # Delimiter tags
-        self.tags[0x01] = "operation-attributes-tag"
-        self.tags[0x02] = "job-attributes-tag"
-        self.tags[0x03] = "end-of-attributes-tag"
-        self.tags[0x04] = "printer-attributes-tag"
-        self.tags[0x05] = "unsupported-attributes-tag"
-        self.tags[0x06] = "subscription-attributes-tag"
-        self.tags[0x07] = "event_notification-attributes-tag"
-        
-        # out of band values
-        self.tags[0x10] = "unsupported"
-        self.tags[0x11] = "reserved-for-future-default"
-        self.tags[0x12] = "unknown"
-        self.tags[0x13] = "no-value"
-        self.tags[0x15] = "not-settable"
-        self.tags[0x16] = "delete-attribute"
-        self.tags[0x17] = "admin-define"
-  
-        # integer values
-        self.tags[0x20] = "generic-integer"
-        self.tags[0x21] = "integer"
-        self.tags[0x22] = "boolean"
-        self.tags[0x23] = "enum"
-        
-        # octetString
-        self.tags[0x30] = "octetString-with-an-unspecified-format"
-        self.tags[0x31] = "dateTime"
-        self.tags[0x32] = "resolution"
-        self.tags[0x33] = "rangeOfInteger"
-        self.tags[0x34] = "begCollection" # TODO : find sample files for testing
-        self.tags[0x35] = "textWithLanguage"
-        self.tags[0x36] = "nameWithLanguage"
-        self.tags[0x37] = "endCollection"
-        
-        # character strings
-        self.tags[0x40] = "generic-character-string"
-        self.tags[0x41] = "textWithoutLanguage"
-        self.tags[0x42] = "nameWithoutLanguage"
-        self.tags[0x44] = "keyword"
-        self.tags[0x45] = "uri"
-        self.tags[0x46] = "uriScheme"
-        self.tags[0x47] = "charset"
-        self.tags[0x48] = "naturalLanguage"
-        self.tags[0x49] = "mimeMediaType"
-        self.tags[0x4a] = "memberAttrName"
-        
-        # Reverse mapping to generate IPP messages
-        self.dictags = {}
-        for i in range(len(self.tags)) :
-            value = self.tags[i]
-            if value is not None :
-                self.dictags[value] = i
+        self.tags = TAGS
+        self.dictags = DICTAGS
         
     def logdebug(self, msg) :    
         """Prints a debug message."""
@@ -211,108 +221,104 @@ class IPPRequest :
         mybuffer.append(self.data)    
         return "".join(mybuffer)
             
-    def parse(self) :
+    def parse(self, wanted=None) :
         """Parses an IPP Request.
         
+           If wanted is a list of attributes names, parsing stops as
+           soon as all their values were seen, and the values of the
+           other attributes are not decoded : this is enough to extract
+           a few attributes from large messages without reading them
+           completely.
+           
            NB : Only a subset of RFC2910 is implemented.
         """
-        self._curname = None
-        self._curdict = None
-        self.version = (ord(self._data[0]), ord(self._data[1]))
-        self.operation_id = unpack(">H", self._data[2:4])[0]
-        self.request_id = unpack(">I", self._data[4:8])[0]
-        self.position = 8
-        endofattributes = self.dictags["end-of-attributes-tag"]
-        maxdelimiter = self.dictags["event_notification-attributes-tag"]
+        data = self._data
+        tags = TAGS
+        decoders = DECODERS
+        debug = self.debug
+        groups = {}
+        for attrtype in self.attributes_types :
+            groups[DICTAGS["%s-attributes-tag" % attrtype]] = getattr(self, "%s_attributes" % attrtype)
+        if wanted is None :    
+            missing = None
+        else :    
+            missing = {}
+            for name in wanted :
+                missing[name] = None
+        curdict = None
+        curname = None
+        keep = 0
+        position = 8
         try :
-            tag = ord(self._data[self.position])
-            while tag != endofattributes :
-                self.position += 1
-                name = self.tags[tag]
-                if name is not None :
-                    func = getattr(self, name.replace("-", "_"), None)
-                    if func is not None :
-                        self.position += func()
-                        if ord(self._data[self.position]) > maxdelimiter :
-                            self.position -= 1
-                            continue
-                tag = ord(self._data[self.position])
-        except IndexError :
+            self.version = (ord(data[0]), ord(data[1]))
+            (self.operation_id, self.request_id) = unpack(">HI", data[2:8])
+            while 1 :
+                tag = ord(data[position])
+                position += 1
+                if tag <= MAXDELIMITER :
+                    if tag == ENDOFATTRIBUTES :
+                        self.data = data[position:]
+                        break
+                    curdict = groups.get(tag)
+                    self.logdebug("Start of %s" % tags[tag])
+                    continue
+                namelength = unpack(">H", data[position:position+2])[0]
+                position += 2
+                if namelength :
+                    if (missing is not None) and not missing :
+                        # all the wanted attributes were seen
+                        self.data = ""
+                        break
+                    curname = data[position:position+namelength]
+                    position += namelength
+                    keep = (curdict is not None) and ((missing is None) or missing.has_key(curname))
+                    if keep and missing :
+                        del missing[curname]
+                valuelength = unpack(">H", data[position:position+2])[0]
+                position += 2
+                if keep :
+                    tagtype = tags[tag]
+                    value = data[position:position+valuelength]
+                    decoder = decoders.get(tagtype)
+                    if decoder is not None :
+                        value = decoder(value)
+                    curdict.setdefault(curname, []).append((tagtype, value))
+                    if debug :
+                        self.logdebug("%s(%s) : %s" % (curname, tagtype, value))
+                position += valuelength
+        except (IndexError, TypeError, error) :
             raise IPPError, "Unexpected end of IPP message."
             
         # Now transform all one-element lists into single values
-        for attrtype in self.attributes_types :
-            attrdict = getattr(self, "%s_attributes" % attrtype)
+        for attrdict in groups.values() :
             for (key, value) in attrdict.items() :
                 if len(value) == 1 :
                     attrdict[key] = value[0]
-        self.data = self._data[self.position+1:]            
         self.parsed = 1            
-        
-    def parseTag(self) :    
-        """Extracts information from an IPP tag."""
-        pos = self.position
-        tagtype = self.tags[ord(self._data[pos])]
-        pos += 1
-        posend = pos2 = pos + 2
-        namelength = unpack(">H", self._data[pos:pos2])[0]
-        if not namelength :
-            name = self._curname
-        else :    
-            posend += namelength
-            self._curname = name = self._data[pos2:posend]
-        pos2 = posend + 2
-        valuelength = unpack(">H", self._data[posend:pos2])[0]
-        posend = pos2 + valuelength
-        value = self._data[pos2:posend]
-        if tagtype in ("integer", "enum") :
-            value = unpack(">I", value)[0]
-        elif tagtype == "boolean" :    
-            value = ord(value)
-        oldval = self._curdict.setdefault(name, [])
-        oldval.append((tagtype, value))
-        self.logdebug("%s(%s) : %s" % (name, tagtype, value))
-        return posend - self.position
-        
-    def operation_attributes_tag(self) : 
-        """Indicates that the parser enters into an operation-attributes-tag group."""
-        self.logdebug("Start of operation_attributes_tag")
-        self._curdict = self.operation_attributes
-        return self.parseTag()
-        
-    def job_attributes_tag(self) : 
-        """Indicates that the parser enters into a job-attributes-tag group."""
-        self.logdebug("Start of job_attributes_tag")
-        self._curdict = self.job_attributes
-        return self.parseTag()
-        
-    def printer_attributes_tag(self) : 
-        """Indicates that the parser enters into a printer-attributes-tag group."""
-        self.logdebug("Start of printer_attributes_tag")
-        self._curdict = self.printer_attributes
-        return self.parseTag()
-        
-    def unsupported_attributes_tag(self) : 
-        """Indicates that the parser enters into an unsupported-attributes-tag group."""
-        self.logdebug("Start of unsupported_attributes_tag")
-        self._curdict = self.unsupported_attributes
-        return self.parseTag()
-        
-    def subscription_attributes_tag(self) : 
-        """Indicates that the parser enters into a subscription-attributes-tag group."""
-        self.logdebug("Start of subscription_attributes_tag")
-        self._curdict = self.subscription_attributes
-        return self.parseTag()
-        
-    def event_notification_attributes_tag(self) : 
-        """Indicates that the parser enters into an event-notification-attributes-tag group."""
-        self.logdebug("Start of event_notification_attributes_tag")
-        self._curdict = self.event_notification_attributes
-        return self.parseTag()
             
+def benchmark(filenames, wanted, loops=100) :
+    """Displays how long parsing CUPS control files takes, completely or for a few attributes only."""
+    messages = []
+    for filename in filenames :
+        infile = open(filename, "rb")
+        messages.append(infile.read())
+        infile.close()
+    if not messages :
+        return
+    for (label, names) in (("all attributes", None), (", ".join(wanted), wanted)) :
+        before = time.time()
+        for i in range(loops) :
+            for data in messages :
+                IPPRequest(data).parse(names)
+        elapsed = time.time() - before
+        print "%s : %.1f microseconds per message" % (label, 1000000.0 * elapsed / (loops * len(messages)))
+    
 if __name__ == "__main__" :            
     if (len(sys.argv) < 2) or (sys.argv[1] == "--debug") :
         print "usage : python ipp.py /var/spool/cups/c00005 [--debug] (for example)\n"
+        print "        python ipp.py --benchmark /var/spool/cups/c* (for example)\n"
+    elif sys.argv[1] == "--benchmark" :    
+        benchmark(sys.argv[2:], ["job-originating-host-name", "job-billing"])
     else :    
         infile = open(sys.argv[1], "rb")
         data = infile.read()
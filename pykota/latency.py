@@ -0,0 +1,159 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module measures where a job's time goes.
+
+A job timer records a span for each phase of a job and for each
+storage query. When the 'recordlatencies' directive is set for a
+printer, the durations of each job's phases are saved along with the
+ones of the printer's last jobs, from which percentiles are computed.
+"""
+
+import sys
+import os
+import time
+import marshal
+import tempfile
+
+HISTORYSIZE = 1000          # number of jobs kept for each printer
+PERCENTILES = (50, 95, 99)
+
+class JobTimer :
+    """Records how long the phases of a job take."""
+    def __init__(self) :
+        """Starts timing a job."""
+        self.started = time.time()
+        self.spans = [] # (name, seconds since the job started, duration)
+
+    def addSpan(self, name, started, ended) :
+        """Records a span."""
+        self.spans.append((name, started - self.started, ended - started))
+
+    def call(self, name, function, *arguments) :
+        """Calls function(*arguments), recording how long it took, and returns its result."""
+        started = time.time()
+        try :
+            return function(*arguments)
+        finally :
+            self.addSpan(name, started, time.time())
+
+    def durations(self) :
+        """Returns mappings of the total duration and number of spans of each kind, including the whole job."""
+        durations = { "total" : time.time() - self.started }
+        counts = { "total" : 1 }
+        for (name, offset, duration) in self.spans :
+            durations[name] = durations.get(name, 0.0) + duration
+            counts[name] = counts.get(name, 0) + 1
+        return (durations, counts)
+
+def timedCall(tool, name, function, *arguments) :
+    """Calls function(*arguments), recording how long it took in the tool's job timer, if any."""
+    timer = getattr(tool, "timer", None)
+    if timer is None :
+        return function(*arguments)
+    return timer.call(name, function, *arguments)
+
+def recordSpan(tool, name, started, ended) :
+    """Records a span in the tool's job timer, if any."""
+    timer = getattr(tool, "timer", None)
+    if timer is not None :
+        timer.addSpan(name, started, ended)
+
+def latenciesFileName(directory, printername) :
+    """Returns the name of the file containing a printer's last jobs' durations."""
+    return os.path.join(directory, "pykota-%s.latencies" % printername)
+
+def loadLatencies(filename) :
+    """Returns the list of jobs' records saved in a file, or an empty list."""
+    try :
+        latenciesfile = open(filename, "rb")
+        try :
+            return marshal.load(latenciesfile)
+        finally :
+            latenciesfile.close()
+    except (IOError, EOFError, ValueError, TypeError) :
+        return []
+
+def saveJobLatencies(filename, jobid, username, timer) :
+    """Atomically adds a job's record to the ones saved in a file."""
+    (durations, counts) = timer.durations()
+    records = loadLatencies(filename)
+    records.append({ "jobid" : jobid,
+                     "username" : username,
+                     "date" : timer.started,
+                     "durations" : durations,
+                     "counts" : counts,
+                   })
+    del records[:-HISTORYSIZE]
+    (fd, tempname) = tempfile.mkstemp(prefix=".", dir=os.path.dirname(filename))
+    try :
+        try :
+            os.write(fd, marshal.dumps(records))
+        finally :
+            os.close(fd)
+        os.rename(tempname, filename)
+    except OSError :
+        try :
+            os.remove(tempname)
+        except OSError :
+            pass
+        raise
+
+def percentile(values, percent) :
+    """Returns the percentile of a sorted list of values, with the nearest rank method."""
+    rank = max(0, (len(values) * percent + 99) / 100 - 1)
+    return values[rank]
+
+def computePercentiles(records) :
+    """Returns a mapping of phases' names to (number of jobs, percentiles of their durations)."""
+    values = {}
+    for record in records :
+        for (name, duration) in record["durations"].items() :
+            values.setdefault(name, []).append(duration)
+    results = {}
+    for (name, durations) in values.items() :
+        durations.sort()
+        results[name] = (len(durations), [percentile(durations, p) for p in PERCENTILES])
+    return results
+
+def main(directories) :
+    """Displays the percentiles of the durations of the phases of each printer's last jobs."""
+    print "%-20s %-28s %6s %10s %10s %10s" % ("Printer", "Phase", "Jobs", "p50", "p95", "p99")
+    for directory in directories :
+        names = os.listdir(directory)
+        names.sort()
+        for name in names :
+            if name.startswith("pykota-") and name.endswith(".latencies") :
+                results = computePercentiles(loadLatencies(os.path.join(directory, name)))
+                phases = results.keys()
+                phases.sort()
+                for phase in phases :
+                    (jobs, values) = results[phase]
+                    print "%-20s %-28s %6i %9.3fs %9.3fs %9.3fs" % tuple([name[7:-10], phase, jobs] + values)
+
+if __name__ == "__main__" :
+    if len(sys.argv) < 2 :
+        sys.stderr.write("Usage :  python  %s  directory [directory ...]\n" % sys.argv[0])
+    else :
+        main(sys.argv[1:])
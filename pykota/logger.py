@@ -25,7 +25,8 @@
 """This module defines base classes used by all logging backends."""
 
 import os
-import imp
+
+from pykota.plugins import loadPlugin
 
 class PyKotaLoggingError(Exception):
     """An exception for logging related stuff."""
@@ -36,14 +37,11 @@ class PyKotaLoggingError(Exception):
         return self.message
     __str__ = __repr__
 
-def openLogger(backend) :
-    """Returns the appropriate logger subsystem object."""
+def openLogger(backend, *arguments) :
+    """Returns the appropriate logger subsystem object, initialized with arguments."""
     try :
-        loggingbackend = imp.load_source("loggingbackend", 
-                                         os.path.join(os.path.dirname(__file__),
-                                                      "loggers",
-                                                      "%s.py" % backend.lower()))
+        loggingbackend = loadPlugin("logger", backend)
     except ImportError :
         raise PyKotaLoggingError, _("Unsupported logging subsystem %s") % backend
     else :    
-        return loggingbackend.Logger()
+        return loggingbackend.Logger(*arguments)
@@ -0,0 +1,166 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines a class for PyKota logging through a background thread.
+
+Records are queued, and a separate thread writes them many at a time
+to syslog, to a text file, or to a file as JSON lines. Each record
+can carry fields, like the printer, user, job id and phase, which are
+kept apart in JSON lines.
+"""
+
+import os
+import time
+import atexit
+import syslog
+import threading
+import Queue
+
+MAXBATCH = 100      # maximal number of records written at once
+CLOSETIMEOUT = 5.0  # maximal number of seconds to wait for the last records to be written
+
+def jsonString(value) :
+    """Returns the JSON representation of a string."""
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    escaped = []
+    for char in value :
+        if char < " " :
+            char = "\\u%04x" % ord(char)
+        escaped.append(char)
+    return '"%s"' % "".join(escaped)
+
+def jsonValue(value) :
+    """Returns the JSON representation of a simple value."""
+    if value is None :
+        return "null"
+    elif isinstance(value, (int, long, float)) :
+        return repr(value)
+    else :
+        return jsonString(str(value))
+
+def prefixMessage(message, fields) :
+    """Returns a message with the job's informations in front of it, if any."""
+    if fields and fields.get("user") :
+        return "%s@%s(%s) => %s" % (fields["user"], fields.get("printer"), fields.get("jobid"), message)
+    return message
+
+class Logger :
+    """A logger class which logs through a background thread."""
+    levels = { "error" : "ERR", "warn": "WARNING", \
+               "info": "INFO", "debug": "DEBUG" }
+    def __init__(self, output="system", delay=1.0) :
+        """Opens the logging subsystem and starts the writer thread.
+
+           output is either 'system' for syslog, or a tuple
+           ('text' or 'json', filename). Records are written at
+           most delay seconds after they were logged.
+        """
+        self.delay = delay
+        self.pid = os.getpid()
+        self.logfile = None
+        if output == "system" :
+            self.format = "system"
+            syslog.openlog("PyKota", 0, syslog.LOG_LPR)
+        else :
+            (self.format, filename) = output
+            self.logfile = open(filename, "a")
+        self.queue = Queue.Queue()
+        self.writer = threading.Thread(target=self.writeRecords)
+        self.writer.setDaemon(True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def log_message(self, message, level="info") :
+        """Queues a message."""
+        self.log_record(message, level)
+
+    def log_record(self, message, level="info", fields=None) :
+        """Queues a message and its fields, formatted later by the writer thread."""
+        record = (time.time(), os.getpid(), level.lower(), message, fields)
+        if os.getpid() != self.pid :
+            # forked child : the writer thread only exists in our parent
+            self.output([record])
+        elif self.writer is not None :
+            self.queue.put(record)
+
+    def writeRecords(self) :
+        """Writes the queued records by batches, until None is queued."""
+        while 1 :
+            records = [self.queue.get()]
+            deadline = time.time() + self.delay
+            while (records[-1] is not None) and (len(records) < MAXBATCH) :
+                remaining = deadline - time.time()
+                if remaining <= 0 :
+                    break
+                try :
+                    records.append(self.queue.get(True, remaining))
+                except Queue.Empty :
+                    break
+            if records[-1] is None :
+                self.output(records[:-1])
+                return
+            self.output(records)
+
+    def output(self, records) :
+        """Writes records."""
+        if self.format == "system" :
+            for (when, pid, level, message, fields) in records :
+                priority = getattr(syslog, \
+                                   "LOG_%s" % self.levels.get(level, "DEBUG"), \
+                                   syslog.LOG_DEBUG)
+                syslog.syslog(priority, "(PID %s) : %s" \
+                                          % (pid, prefixMessage(message.strip(), fields)))
+        else :
+            lines = []
+            for (when, pid, level, message, fields) in records :
+                if self.format == "json" :
+                    items = [("time", when), ("pid", pid), ("level", level), ("message", message.strip())]
+                    if fields :
+                        names = fields.keys()
+                        names.sort()
+                        items.extend([(name, fields[name]) for name in names])
+                    lines.append("{%s}\n" % ", ".join(["%s: %s" % (jsonString(name), jsonValue(value)) for (name, value) in items]))
+                else :
+                    lines.append("%s.%03i %s: PyKota (PID %s) : %s\n" \
+                                     % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), \
+                                        int((when % 1) * 1000), \
+                                        level.upper(), \
+                                        pid, \
+                                        prefixMessage(message.strip(), fields)))
+            try :
+                self.logfile.write("".join(lines))
+                self.logfile.flush()
+            except (IOError, ValueError) :
+                pass # What else could we do ?
+
+    def close(self) :
+        """Writes the remaining records and closes the logging subsystem."""
+        if (self.writer is not None) and (os.getpid() == self.pid) :
+            self.queue.put(None)
+            self.writer.join(CLOSETIMEOUT)
+            self.writer = None
+            if self.logfile is not None :
+                self.logfile.close()
+            else :
+                syslog.closelog()
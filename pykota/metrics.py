@@ -0,0 +1,246 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module keeps counters and histograms shared by all PyKota processes.
+
+Each process accumulates its own changes, and merges them into a file
+shared by all processes when it exits, or every FLUSHDELAY seconds
+for long running ones. The file's content can be served over HTTP
+in the Prometheus text format :
+
+  python metrics.py /var/run/pykota/metrics 9464
+"""
+
+import sys
+import os
+import time
+import fcntl
+import atexit
+import marshal
+import threading
+import BaseHTTPServer
+
+FLUSHDELAY = 10.0   # maximal number of seconds changes are kept before being merged into the file
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class MetricsRegistry :
+    """Counters and histograms merged into a file shared with other processes.
+
+       Metrics are identified by their name and their labels, a
+       tuple of sorted (label, value) tuples.
+    """
+    def __init__(self, filename) :
+        """Initializes the registry."""
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) :
+        """Forgets the changes not merged yet."""
+        self.counters = {}
+        self.histograms = {}
+        self.flushed = time.time()
+
+    def increment(self, name, labels=(), value=1) :
+        """Increments a counter."""
+        key = (name, labels)
+        self.lock.acquire()
+        try :
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally :
+            self.lock.release()
+        self.flushIfNeeded()
+
+    def observe(self, name, value, labels=()) :
+        """Adds a value to an histogram."""
+        key = (name, labels)
+        self.lock.acquire()
+        try :
+            histogram = self.histograms.get(key)
+            if histogram is None :
+                histogram = self.histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+            for i in range(len(BUCKETS)) :
+                if value <= BUCKETS[i] :
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        finally :
+            self.lock.release()
+        self.flushIfNeeded()
+
+    def flushIfNeeded(self) :
+        """Merges the changes into the file if they are old enough."""
+        if (time.time() - self.flushed) > FLUSHDELAY :
+            self.flush()
+
+    def flush(self) :
+        """Merges the changes into the file."""
+        self.lock.acquire()
+        try :
+            (counters, histograms) = (self.counters, self.histograms)
+            self.reset()
+        finally :
+            self.lock.release()
+        if not (counters or histograms) :
+            return
+        try :
+            metricsfile = open(self.filename, "a+b")
+        except IOError :
+            return
+        try :
+            fcntl.lockf(metricsfile, fcntl.LOCK_EX)
+            metricsfile.seek(0)
+            (allcounters, allhistograms) = readMetrics(metricsfile)
+            for (key, value) in counters.items() :
+                allcounters[key] = allcounters.get(key, 0) + value
+            for (key, histogram) in histograms.items() :
+                total = allhistograms.get(key)
+                if total is None :
+                    allhistograms[key] = histogram
+                else :
+                    for i in range(len(histogram)) :
+                        total[i] += histogram[i]
+            metricsfile.seek(0)
+            metricsfile.truncate()
+            metricsfile.write(marshal.dumps((allcounters, allhistograms)))
+        finally :
+            metricsfile.close()
+
+def readMetrics(metricsfile) :
+    """Returns the (counters, histograms) saved in an opened file."""
+    try :
+        return marshal.loads(metricsfile.read())
+    except (EOFError, ValueError, TypeError) :
+        return ({}, {})
+
+def loadMetrics(filename) :
+    """Returns the (counters, histograms) saved in a file."""
+    try :
+        metricsfile = open(filename, "rb")
+    except IOError :
+        return ({}, {})
+    try :
+        fcntl.lockf(metricsfile, fcntl.LOCK_SH)
+        return readMetrics(metricsfile)
+    finally :
+        metricsfile.close()
+
+registry = None
+
+def openMetrics(filename) :
+    """Makes this process' metrics be merged into a file."""
+    global registry
+    if (registry is None) or (registry.filename != filename) :
+        if registry is not None :
+            registry.flush()
+        registry = MetricsRegistry(filename)
+        atexit.register(registry.flush)
+
+def makeLabels(labels) :
+    """Returns labels given as a mapping as a tuple of sorted (label, value) tuples."""
+    items = [(name, str(value)) for (name, value) in labels.items()]
+    items.sort()
+    return tuple(items)
+
+def increment(name, value=1, **labels) :
+    """Increments a counter, if metrics are enabled."""
+    if registry is not None :
+        registry.increment(name, makeLabels(labels), value)
+
+def observe(name, value, **labels) :
+    """Adds a value to an histogram, if metrics are enabled."""
+    if registry is not None :
+        registry.observe(name, value, makeLabels(labels))
+
+def formatLabels(labels, extra=()) :
+    """Returns labels in the Prometheus text format."""
+    labels = tuple(labels) + tuple(extra)
+    if not labels :
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) \
+                                  for (name, value) in labels])
+
+def formatMetrics(counters, histograms) :
+    """Returns counters and histograms in the Prometheus text format."""
+    lines = []
+    for (metrics, kind) in ((counters, "counter"), (histograms, "histogram")) :
+        keys = metrics.keys()
+        keys.sort()
+        previous = None
+        for key in keys :
+            (name, labels) = key
+            if name != previous :
+                lines.append("# TYPE %s %s" % (name, kind))
+                previous = name
+            if kind == "counter" :
+                lines.append("%s%s %s" % (name, formatLabels(labels), metrics[key]))
+            else :
+                histogram = metrics[key]
+                for i in range(len(BUCKETS)) :
+                    lines.append("%s_bucket%s %i" % (name, formatLabels(labels, (("le", repr(BUCKETS[i])),)), histogram[i]))
+                lines.append("%s_bucket%s %i" % (name, formatLabels(labels, (("le", "+Inf"),)), histogram[-1]))
+                lines.append("%s_sum%s %r" % (name, formatLabels(labels), histogram[-2]))
+                lines.append("%s_count%s %i" % (name, formatLabels(labels), histogram[-1]))
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler) :
+    """Serves the metrics saved in a file."""
+    filename = None
+    def do_GET(self) :
+        """Sends the metrics."""
+        if self.path.split("?")[0] not in ("/", "/metrics") :
+            self.send_error(404)
+            return
+        (counters, histograms) = loadMetrics(self.filename)
+        content = formatMetrics(counters, histograms)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *arguments) :
+        """Doesn't log requests."""
+        pass
+
+def main(filename, port=None, address="127.0.0.1") :
+    """Displays the metrics saved in a file, or serves them over HTTP if a port is given."""
+    if port is None :
+        (counters, histograms) = loadMetrics(filename)
+        sys.stdout.write(formatMetrics(counters, histograms))
+    else :
+        MetricsHandler.filename = filename
+        server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+        try :
+            server.serve_forever()
+        except KeyboardInterrupt :
+            pass
+
+if __name__ == "__main__" :
+    if len(sys.argv) == 2 :
+        main(sys.argv[1])
+    elif len(sys.argv) in (3, 4) :
+        main(sys.argv[1], int(sys.argv[2]), (sys.argv[3:] or ["127.0.0.1"])[0])
+    else :
+        sys.stderr.write("Usage :  python  %s  filename [port [address]]\n" % sys.argv[0])
@@ -0,0 +1,129 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module finds and imports the storage, accounter, logger and reporter backends.
+
+Backends are imported only once per process, through the normal
+import mechanism. Third party backends can be added either by calling
+registerPlugin(), or by declaring a setuptools entry point in the
+pykota.storages, pykota.accounters, pykota.loggers or pykota.reporters
+group, named like the backend.
+"""
+
+import sys
+import os
+import time
+
+# kind of backend : (package of the builtin backends, name of the backend's class)
+KINDS = { "storage" : ("pykota.storages", "Storage"),
+          "accounter" : ("pykota.accounters", "Accounter"),
+          "logger" : ("pykota.loggers", "Logger"),
+          "reporter" : ("pykota.reporters", "Reporter"),
+        }
+
+registered = {}  # (kind, name) : module or dotted module name
+loaded = {}      # (kind, name) : module
+importtimes = {} # (kind, name) : seconds spent importing the module
+
+def registerPlugin(kind, name, module) :
+    """Registers a backend, module being either a module or a dotted module name."""
+    key = (kind, name.lower())
+    registered[key] = module
+    if loaded.has_key(key) :
+        del loaded[key]
+
+def findEntryPoint(kind, name) :
+    """Returns the dotted name of the module declared by a setuptools entry point for a backend, or None."""
+    try :
+        import pkg_resources
+    except ImportError :
+        return None
+    for entrypoint in pkg_resources.iter_entry_points("%ss" % KINDS[kind][0], name) :
+        return entrypoint.module_name
+    return None
+
+def importModule(modulename) :
+    """Imports a module given its dotted name, and returns it."""
+    __import__(modulename)
+    return sys.modules[modulename]
+
+def loadPlugin(kind, name) :
+    """Returns the module of a backend, importing it if needed.
+
+       Raises ImportError if the backend doesn't exist or can't be imported.
+    """
+    name = name.lower()
+    key = (kind, name)
+    module = loaded.get(key)
+    if module is None :
+        if not name.replace("_", "").isalnum() :
+            raise ImportError, "Invalid backend name %s" % name
+        (package, classname) = KINDS[kind]
+        started = time.time()
+        module = registered.get(key)
+        if module is None :
+            builtin = os.path.join(os.path.dirname(__file__), package.split(".")[-1], "%s.py" % name)
+            if os.path.exists(builtin) :
+                module = "%s.%s" % (package, name)
+            else :
+                module = findEntryPoint(kind, name)
+                if module is None :
+                    raise ImportError, "No %s backend named %s" % (kind, name)
+        if isinstance(module, str) :
+            module = importModule(module)
+        if not hasattr(module, classname) :
+            raise ImportError, "Module %s doesn't define the %s class" % (module.__name__, classname)
+        importtimes[key] = time.time() - started
+        loaded[key] = module
+    return module
+
+def dumpImportStatistics(output) :
+    """Outputs the time spent importing each backend loaded so far."""
+    keys = importtimes.keys()
+    keys.sort()
+    for (kind, name) in keys :
+        output("Backend %s %s imported in %.3f seconds" % (kind, name, importtimes[(kind, name)]))
+
+def main(arguments) :
+    """Imports the given backends, or all the builtin ones, and displays how long each import took."""
+    if not arguments :
+        for kind in KINDS.keys() :
+            package = KINDS[kind][0]
+            directory = os.path.join(os.path.dirname(__file__), package.split(".")[-1])
+            for filename in os.listdir(directory) :
+                if filename.endswith(".py") and (filename != "__init__.py") :
+                    arguments.append("%s:%s" % (kind, filename[:-3]))
+    for argument in arguments :
+        (kind, name) = argument.split(":", 1)
+        try :
+            loadPlugin(kind, name)
+        except (ImportError, RuntimeError) :
+            pass # helper modules or missing dependencies
+    def output(message) :
+        print message
+    dumpImportStatistics(output)
+
+if __name__ == "__main__" :
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    main(sys.argv[1:])
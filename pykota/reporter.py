@@ -25,9 +25,10 @@
 """This module defines bases classes used by all reporters."""
 
 import os
-import imp
 from mx import DateTime
 
+from pykota.plugins import loadPlugin
+
 class PyKotaReporterError(Exception):
     """An exception for Reporter related stuff."""
     def __init__(self, message = ""):
@@ -151,10 +152,7 @@ class BaseReporter :
 def openReporter(tool, reporttype, printers, ugnames, isgroup) :
     """Returns a reporter instance of the proper reporter."""
     try :
-        reporterbackend = imp.load_source("reporterbackend", 
-                                           os.path.join(os.path.dirname(__file__),
-                                                        "reporters",
-                                                        "%s.py" % reporttype.lower()))
+        reporterbackend = loadPlugin("reporter", reporttype)
     except ImportError :
         raise PyKotaReporterError, _("Unsupported reporter backend %s") % reporttype
     else :    
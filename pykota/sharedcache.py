@@ -0,0 +1,285 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines a storage cache shared by all PyKota processes running on the same host."""
+
+import os
+import md5
+import time
+import types
+import errno
+import fcntl
+import marshal
+import tempfile
+
+SIMPLETYPES = (type(None), bool, int, long, float, str, unicode)
+SKIPPEDTYPES = (types.InstanceType, list, tuple, dict)
+
+class PyKotaSharedCacheError(Exception):
+    """An exception for shared cache related stuff."""
+    def __init__(self, message = ""):
+        self.message = message
+        Exception.__init__(self, message)
+    def __repr__(self):
+        return self.message
+    __str__ = __repr__
+
+def shareableAttributes(obj) :
+    """Returns the attributes of a storage object which can be shared with other processes.
+
+       References to other objects and lazily computed lists are skipped,
+       they will be recomputed when needed.
+    """
+    attributes = {}
+    for (name, value) in obj.__dict__.items() :
+        if isinstance(value, SIMPLETYPES) :
+            attributes[name] = value
+        elif not isinstance(value, SKIPPEDTYPES) :
+            attributes[name] = str(value)
+    return attributes
+
+class SharedCache :
+    """A cache stored as one small file per entry, ideally on a memory based filesystem.
+
+       Entries are written to a temporary file then renamed, so
+       concurrent readers always see either the old or the new
+       entry, never a partially written one.
+
+       Flushing an entry leaves a tombstone behind, so that another
+       process which read the same entry from the database before it
+       was modified can't store its stale copy afterwards. Each entry
+       is locked while it is checked then written. Expired entries,
+       tombstones included, are removed with their lock files.
+
+       PyKota's tools may run under different users, so directories
+       and files are group writable.
+    """
+    def __init__(self, directory, ttls) :
+        """Initializes the shared cache, creating its directories if needed."""
+        self.directory = directory
+        self.ttls = ttls
+        for cachetype in ttls.keys() :
+            path = self.typeDirectory(cachetype)
+            for subpath in (directory, path) :
+                try :
+                    os.makedirs(subpath, 02770)
+                except OSError, msg :
+                    if msg.errno != errno.EEXIST :
+                        raise PyKotaSharedCacheError, "Unable to create shared cache directory %s : %s" % (subpath, msg)
+                else :
+                    os.chmod(subpath, 02770) # the umask reduces the mode given to makedirs
+            if not os.access(path, os.R_OK | os.W_OK | os.X_OK) :
+                raise PyKotaSharedCacheError, "Shared cache directory %s isn't writable by uid %i : make it writable by the group of all the users running PyKota, or unset sharedcache." % (path, os.geteuid())
+
+    def isShared(self, cachetype) :
+        """Returns True if entries of this type are shared, else False."""
+        return self.ttls.get(cachetype, 0) > 0
+
+    def typeDirectory(self, cachetype) :
+        """Returns the directory containing a cache type's entries."""
+        return os.path.join(self.directory, cachetype.lower())
+
+    def entryPath(self, cachetype, key) :
+        """Returns the name of the file containing an entry."""
+        if isinstance(key, unicode) :
+            key = key.encode("UTF-8")
+        return os.path.join(self.typeDirectory(cachetype), md5.new(key).hexdigest())
+
+    def readEntry(self, path) :
+        """Returns (expiration, key, attributes, stamp) read from an entry's file, or None."""
+        try :
+            entryfile = open(path, "rb")
+            try :
+                data = entryfile.read()
+            finally :
+                entryfile.close()
+        except IOError :
+            return None
+        try :
+            return marshal.loads(data)
+        except (ValueError, EOFError, TypeError) :
+            self.removeEntry(path)
+            return None
+
+    def removeEntry(self, path) :
+        """Removes an entry's file, if it still exists."""
+        try :
+            os.remove(path)
+        except OSError :
+            pass
+
+    def lockPath(self, path) :
+        """Returns the name of the file used to lock an entry."""
+        (directory, name) = os.path.split(path)
+        return os.path.join(directory, ".%s.lock" % name)
+
+    def reapEntry(self, path) :
+        """Removes an entry's file and its lock file if the entry is missing or expired."""
+        lockfile = self.lockEntry(path)
+        if lockfile is not None :
+            try :
+                entry = self.readEntry(path)
+                if (entry is None) or (entry[0] < time.time()) :
+                    self.removeEntry(path)
+                    # still locked : the others will lock the next lock file
+                    self.removeEntry(self.lockPath(path))
+            finally :
+                self.unlockEntry(lockfile)
+
+    def get(self, cachetype, key) :
+        """Returns the attributes stored for key, or None if missing or expired."""
+        if not self.isShared(cachetype) :
+            return None
+        path = self.entryPath(cachetype, key)
+        entry = self.readEntry(path)
+        if entry is None :
+            return None
+        (expiration, storedkey, attributes, stamp) = entry
+        if storedkey != key :
+            return None
+        if expiration < time.time() :
+            self.reapEntry(path)
+            return None
+        return attributes
+
+    def writeEntry(self, cachetype, key, attributes) :
+        """Atomically writes an entry's file."""
+        path = self.entryPath(cachetype, key)
+        now = time.time()
+        data = marshal.dumps((now + self.ttls[cachetype], key, attributes, now))
+        try :
+            (fd, tempname) = tempfile.mkstemp(prefix=".", dir=os.path.dirname(path))
+        except (IOError, OSError) :
+            return
+        try :
+            try :
+                os.fchmod(fd, 0660)
+                os.write(fd, data)
+            finally :
+                os.close(fd)
+            os.rename(tempname, path)
+        except OSError :
+            self.removeEntry(tempname)
+
+    def lockEntry(self, path) :
+        """Locks an entry's file against concurrent updates, returns the opened lock file, or None if it can't be locked."""
+        lockpath = self.lockPath(path)
+        while True :
+            try :
+                fd = os.open(lockpath, os.O_WRONLY | os.O_CREAT, 0660)
+            except OSError :
+                return None
+            lockfile = os.fdopen(fd, "w")
+            try :
+                try :
+                    os.fchmod(fd, 0660)
+                except OSError :
+                    pass # created by another user
+                fcntl.lockf(lockfile, fcntl.LOCK_EX)
+                if os.fstat(fd).st_ino == os.stat(lockpath).st_ino :
+                    return lockfile
+            except (IOError, OSError) :
+                # reaped while we were waiting for it : lock the new one
+                pass
+            lockfile.close()
+
+    def unlockEntry(self, lockfile) :
+        """Unlocks an entry locked with lockEntry()."""
+        if lockfile is not None :
+            lockfile.close()
+
+    def put(self, cachetype, key, attributes, readtime) :
+        """Stores an entry's attributes, read from the database at readtime, for its cache type's time to live."""
+        if self.isShared(cachetype) :
+            path = self.entryPath(cachetype, key)
+            lockfile = self.lockEntry(path)
+            if lockfile is None :
+                return # better not share it than overwrite a tombstone
+            try :
+                entry = self.readEntry(path)
+                if (entry is not None) and (entry[2] is None) and (entry[3] >= readtime) :
+                    return # modified by someone else after we read it
+                self.writeEntry(cachetype, key, attributes)
+            finally :
+                self.unlockEntry(lockfile)
+
+    def update(self, cachetype, key, function) :
+        """Replaces an entry's attributes with function(attributes), all while it is locked.
+
+           attributes is None if the entry is missing or expired. Returns
+           the new attributes, or None if the entry can't be shared.
+        """
+        if not self.isShared(cachetype) :
+            return None
+        path = self.entryPath(cachetype, key)
+        lockfile = self.lockEntry(path)
+        if lockfile is None :
+            return None
+        try :
+            attributes = None
+            entry = self.readEntry(path)
+            if (entry is not None) and (entry[1] == key) and (entry[0] >= time.time()) :
+                attributes = entry[2]
+            attributes = function(attributes)
+            self.writeEntry(cachetype, key, attributes)
+            return attributes
+        finally :
+            self.unlockEntry(lockfile)
+
+    def flush(self, cachetype, key) :
+        """Replaces an entry with a tombstone."""
+        if self.isShared(cachetype) :
+            lockfile = self.lockEntry(self.entryPath(cachetype, key))
+            try :
+                self.writeEntry(cachetype, key, None)
+            finally :
+                self.unlockEntry(lockfile)
+
+    def flushMatching(self, cachetype, test=None) :
+        """Invalidates all the entries of a cache type whose key passes the test, or all of them if test is None.
+
+           Expired entries and lock files left without entry are removed.
+        """
+        if not self.isShared(cachetype) :
+            return
+        directory = self.typeDirectory(cachetype)
+        try :
+            names = os.listdir(directory)
+        except OSError :
+            return
+        now = time.time()
+        for name in names :
+            if name.startswith(".") :
+                if name.endswith(".lock") and (name[1:-5] not in names) :
+                    self.reapEntry(os.path.join(directory, name[1:-5]))
+                continue # else being written by another process
+            path = os.path.join(directory, name)
+            entry = self.readEntry(path)
+            if entry is None :
+                continue
+            (expiration, storedkey, attributes, stamp) = entry
+            if expiration < now :
+                self.reapEntry(path)
+            elif (attributes is not None) and ((test is None) or test(storedkey)) :
+                self.flush(cachetype, storedkey)
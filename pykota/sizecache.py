@@ -0,0 +1,177 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines a persistent cache of the sizes of already seen jobs."""
+
+import sys
+import os
+import md5
+import errno
+import fcntl
+import marshal
+import tempfile
+
+STATISTICSFILE = ".statistics"
+
+class PyKotaSizeCacheError(Exception):
+    """An exception for job size cache related stuff."""
+    def __init__(self, message = ""):
+        self.message = message
+        Exception.__init__(self, message)
+    def __repr__(self):
+        return self.message
+    __str__ = __repr__
+
+class JobSizeCache :
+    """A cache of job sizes and ink usages, keyed by the job's datas checksum and the accounter used.
+
+       Each entry is stored in its own file, and at most maxentries
+       entries are kept, the least recently used ones being removed
+       first.
+    """
+    def __init__(self, directory, maxentries) :
+        """Initializes the cache, creating its directory if needed."""
+        self.directory = directory
+        self.maxentries = maxentries
+        try :
+            os.makedirs(directory, 0700)
+        except OSError, msg :
+            if msg.errno != errno.EEXIST :
+                raise PyKotaSizeCacheError, "Unable to create job size cache directory %s : %s" % (directory, msg)
+
+    def entryPath(self, key) :
+        """Returns the name of the file containing an entry."""
+        return os.path.join(self.directory, md5.new(repr(key)).hexdigest())
+
+    def get(self, key) :
+        """Returns (jobsize, inkusage) cached for key, or None."""
+        path = self.entryPath(key)
+        entry = None
+        try :
+            entryfile = open(path, "rb")
+            try :
+                entry = marshal.load(entryfile)
+            finally :
+                entryfile.close()
+        except (IOError, EOFError, ValueError, TypeError) :
+            pass
+        if (entry is None) or (entry[0] != key) :
+            self.updateStatistics("misses")
+            return None
+        try :
+            os.utime(path, None) # recently used
+        except OSError :
+            pass
+        self.updateStatistics("hits")
+        return entry[1:]
+
+    def put(self, key, jobsize, inkusage) :
+        """Stores a job's size and ink usage, removing the least recently used entries if needed."""
+        data = marshal.dumps((key, jobsize, inkusage))
+        try :
+            (fd, tempname) = tempfile.mkstemp(prefix=".", dir=self.directory)
+        except (IOError, OSError) :
+            return
+        try :
+            try :
+                os.write(fd, data)
+            finally :
+                os.close(fd)
+            os.rename(tempname, self.entryPath(key))
+        except OSError :
+            try :
+                os.remove(tempname)
+            except OSError :
+                pass
+        else :
+            self.updateStatistics("stores", self.evict())
+
+    def evict(self) :
+        """Removes the least recently used entries above maxentries, returns how many were removed."""
+        if not self.maxentries :
+            return 0
+        entries = []
+        for name in os.listdir(self.directory) :
+            if not name.startswith(".") :
+                path = os.path.join(self.directory, name)
+                try :
+                    entries.append((os.stat(path).st_mtime, path))
+                except OSError :
+                    pass
+        surplus = len(entries) - self.maxentries
+        if surplus <= 0 :
+            return 0
+        entries.sort()
+        for (mtime, path) in entries[:surplus] :
+            try :
+                os.remove(path)
+            except OSError :
+                pass
+        return surplus
+
+    def updateStatistics(self, counter, evictions=0) :
+        """Increments one of the counters shared by all processes."""
+        try :
+            statsfile = open(os.path.join(self.directory, STATISTICSFILE), "a+b")
+        except IOError :
+            return
+        try :
+            fcntl.lockf(statsfile, fcntl.LOCK_EX)
+            statsfile.seek(0)
+            statistics = self.readStatistics(statsfile)
+            statistics[counter] += 1
+            statistics["evictions"] += evictions
+            statsfile.seek(0)
+            statsfile.truncate()
+            statsfile.write(marshal.dumps(statistics))
+        finally :
+            statsfile.close()
+
+    def readStatistics(self, statsfile=None) :
+        """Returns the cache's counters."""
+        statistics = { "hits" : 0, "misses" : 0, "stores" : 0, "evictions" : 0 }
+        try :
+            if statsfile is None :
+                statsfile = open(os.path.join(self.directory, STATISTICSFILE), "rb")
+            statistics.update(marshal.loads(statsfile.read()))
+        except (IOError, EOFError, ValueError, TypeError) :
+            pass
+        return statistics
+
+def main(directory) :
+    """Displays the statistics of a job size cache."""
+    statistics = JobSizeCache(directory, 0).readStatistics()
+    lookups = statistics["hits"] + statistics["misses"]
+    if lookups :
+        statistics["hitrate"] = 100.0 * statistics["hits"] / lookups
+    else :
+        statistics["hitrate"] = 0.0
+    statistics["entries"] = len([n for n in os.listdir(directory) if not n.startswith(".")])
+    print "%(entries)i entries, %(hits)i hits, %(misses)i misses (%(hitrate).1f%% hits), %(stores)i stores, %(evictions)i evictions" % statistics
+
+if __name__ == "__main__" :
+    if len(sys.argv) != 2 :
+        sys.stderr.write("Usage :  python  %s  directory\n" % sys.argv[0])
+    else :
+        main(sys.argv[1])
@@ -25,9 +25,34 @@
 """This module is the database abstraction layer for PyKota."""
 
 import os
-import imp
+import time
+from array import array
 from mx import DateTime
 
+try :
+    import numpy
+except ImportError :
+    def sumInkUsage(inkusage, inks) :
+        """Returns the array of each ink's usage summed over all pages."""
+        return array("d", [sum(array("d", [usage.get(ink, 0.0) for usage in inkusage])) for ink in inks])
+
+    def dotProduct(vector1, vector2) :
+        """Returns the dot product of two arrays."""
+        return sum(map(float.__mul__, vector1, vector2))
+else :
+    def sumInkUsage(inkusage, inks) :
+        """Returns the array of each ink's usage summed over all pages."""
+        return numpy.array([[usage.get(ink, 0.0) for ink in inks] for usage in inkusage], numpy.float64).sum(axis=0)
+
+    def dotProduct(vector1, vector2) :
+        """Returns the dot product of two arrays."""
+        return float(numpy.dot(vector1, vector2))
+
+from pykota import metrics
+from pykota.cache import LRUCache
+from pykota.plugins import loadPlugin
+from pykota.sharedcache import SharedCache, shareableAttributes
+
 class PyKotaStorageError(Exception):
     """An exception for database related stuff."""
     def __init__(self, message = ""):
@@ -58,6 +83,7 @@ class StorageObject :
         """Saves the object to the database."""
         if self.isDirty :
             getattr(self.parent, "save%s" % self.__class__.__name__[7:])(self)
+            self.parent.invalidateObject(self)
             self.isDirty = False
 
 
@@ -77,6 +103,7 @@ class StorageUser(StorageObject) :
     def consumeAccountBalance(self, amount) :
         """Consumes an amount of money from the user's account balance."""
         self.parent.decreaseUserAccountBalance(self, amount)
+        self.parent.invalidateObject(self)
         self.AccountBalance = float(self.AccountBalance or 0.0) - amount
 
     def setAccountBalance(self, balance, lifetimepaid, comment="") :
@@ -120,10 +147,10 @@ class StorageUser(StorageObject) :
         """Deletes an user from the database."""
         self.parent.deleteUser(self)
         self.parent.flushEntry("USERS", self.Name)
-        if self.parent.usecache :
-            for (k, v) in self.parent.caches["USERPQUOTAS"].items() :
-                if v.User.Name == self.Name :
-                    self.parent.flushEntry("USERPQUOTAS", "%s@%s" % (v.User.Name, v.Printer.Name))
+        self.parent.flushEntries("USERPQUOTAS", lambda key : key.split("@", 1)[0] == self.Name)
+        self.parent.flushEntries("LASTJOBS")
+        self.parent.flushEntry("USERGROUPS", self.Name)
+        self.parent.flushEntries("GROUPMEMBERS")
         self.Exists = False
         self.isDirty = False
 
@@ -155,19 +182,22 @@ class StorageGroup(StorageObject) :
     def addUserToGroup(self, user) :
         """Adds an user to an users group."""
         self.parent.addUserToGroup(user, self)
+        self.parent.flushEntry("GROUPMEMBERS", self.Name)
+        self.parent.flushEntry("USERGROUPS", user.Name)
 
     def delUserFromGroup(self, user) :
         """Removes an user from an users group."""
         self.parent.delUserFromGroup(user, self)
+        self.parent.flushEntry("GROUPMEMBERS", self.Name)
+        self.parent.flushEntry("USERGROUPS", user.Name)
 
     def delete(self) :
         """Deletes a group from the database."""
         self.parent.deleteGroup(self)
         self.parent.flushEntry("GROUPS", self.Name)
-        if self.parent.usecache :
-            for (k, v) in self.parent.caches["GROUPPQUOTAS"].items() :
-                if v.Group.Name == self.Name :
-                    self.parent.flushEntry("GROUPPQUOTAS", "%s@%s" % (v.Group.Name, v.Printer.Name))
+        self.parent.flushEntries("GROUPPQUOTAS", lambda key : key.split("@", 1)[0] == self.Name)
+        self.parent.flushEntry("GROUPMEMBERS", self.Name)
+        self.parent.flushEntries("USERGROUPS")
         self.Exists = False
         self.isDirty = False
 
@@ -189,7 +219,7 @@ class StoragePrinter(StorageObject) :
             self.parent.tool.logdebug("Lazy retrieval of last job for printer %s" % self.Name)
             return self.LastJob
         elif name == "Coefficients" :
-            self.Coefficients = self.parent.tool.config.getPrinterCoefficients(self.Name)
+            self.Coefficients = self.parent.config.getPrinterCoefficients(self.Name)
             self.parent.tool.logdebug("Lazy retrieval of coefficients for printer %s : %s" % (self.Name, self.Coefficients))
             return self.Coefficients
         else :
@@ -198,18 +228,19 @@ class StoragePrinter(StorageObject) :
     def addJobToHistory(self, jobid, user, pagecounter, action, jobsize=None, jobprice=None, filename=None, title=None, copies=None, options=None, clienthost=None, jobsizebytes=None, jobmd5sum=None, jobpages=None, jobbilling=None, precomputedsize=None, precomputedprice=None) :
         """Adds a job to the printer's history."""
         self.parent.writeJobNew(self, user, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, clienthost, jobsizebytes, jobmd5sum, jobpages, jobbilling, precomputedsize, precomputedprice)
+        self.parent.invalidateEntry("LASTJOBS", self.Name)
         # TODO : update LastJob object ? Probably not needed.
 
     def addPrinterToGroup(self, printer) :
         """Adds a printer to a printer group."""
         if (printer not in self.parent.getParentPrinters(self)) and (printer.ident != self.ident) :
             self.parent.writePrinterToGroup(self, printer)
-            # TODO : reset cached value for printer parents, or add new parent to cached value
+            self.parent.flushEntries("PARENTPRINTERS")
 
     def delPrinterFromGroup(self, printer) :
         """Deletes a printer from a printer group."""
         self.parent.removePrinterFromGroup(self, printer)
-        # TODO : reset cached value for printer parents, or add new parent to cached value
+        self.parent.flushEntries("PARENTPRINTERS")
 
     def setPrices(self, priceperpage = None, priceperjob = None) :
         """Sets the printer's prices."""
@@ -237,13 +268,10 @@ class StoragePrinter(StorageObject) :
         """Deletes a printer from the database."""
         self.parent.deletePrinter(self)
         self.parent.flushEntry("PRINTERS", self.Name)
-        if self.parent.usecache :
-            for (k, v) in self.parent.caches["USERPQUOTAS"].items() :
-                if v.Printer.Name == self.Name :
-                    self.parent.flushEntry("USERPQUOTAS", "%s@%s" % (v.User.Name, v.Printer.Name))
-            for (k, v) in self.parent.caches["GROUPPQUOTAS"].items() :
-                if v.Printer.Name == self.Name :
-                    self.parent.flushEntry("GROUPPQUOTAS", "%s@%s" % (v.Group.Name, v.Printer.Name))
+        self.parent.flushEntry("LASTJOBS", self.Name)
+        self.parent.flushEntries("USERPQUOTAS", lambda key : key.split("@", 1)[-1] == self.Name)
+        self.parent.flushEntries("GROUPPQUOTAS", lambda key : key.split("@", 1)[-1] == self.Name)
+        self.parent.flushEntries("PARENTPRINTERS")
         self.Exists = False
         self.isDirty = False
 
@@ -275,6 +303,7 @@ class StorageUserPQuota(StorageObject) :
         datelimit = DateTime.ISO.ParseDateTime(str(datelimit)[:19])
         date = "%04i-%02i-%02i %02i:%02i:%02i" % (datelimit.year, datelimit.month, datelimit.day, datelimit.hour, datelimit.minute, datelimit.second)
         self.parent.writeUserPQuotaDateLimit(self, date)
+        self.parent.invalidateObject(self)
         self.DateLimit = date
 
     def setLimits(self, softlimit, hardlimit) :
@@ -300,11 +329,13 @@ class StorageUserPQuota(StorageObject) :
     def incDenyBannerCounter(self) :
         """Increment the deny banner counter for this user quota."""
         self.parent.increaseUserPQuotaWarnCount(self)
+        self.parent.invalidateObject(self)
         self.WarnCount = (self.WarnCount or 0) + 1
 
     def resetDenyBannerCounter(self) :
         """Resets the deny banner counter for this user quota."""
         self.parent.writeUserPQuotaWarnCount(self, 0)
+        self.parent.invalidateObject(self)
         self.WarnCount = 0
 
     def reset(self) :
@@ -319,31 +350,43 @@ class StorageUserPQuota(StorageObject) :
         self.DateLimit = None
         self.isDirty = True
 
+    def computeInkPrice(self, jobsize, inkusage) :
+        """Returns the price of the job's ink usage for a base cost of one credit per page.
+
+           Pages without ink usage information count for their base cost.
+        """
+        inkusage = inkusage[:jobsize]
+        coefficients = self.Printer.Coefficients
+        inks = {}
+        for usage in inkusage :
+            inks.update(usage)
+        inks = inks.keys()
+        price = (jobsize - len(inkusage))
+        if inks :
+            coefvector = array("d", [float(coefficients.get(ink, 1.0)) for ink in inks])
+            price += dotProduct(sumInkUsage(inkusage, inks), coefvector) / 100.0
+        if self.parent.tool.debug :
+            for pageindex in range(len(inkusage), jobsize) :
+                self.parent.tool.logdebug("No ink usage information. Using base cost for page %i." % (pageindex+1))
+            for pageindex in range(len(inkusage)) :
+                for (ink, value) in inkusage[pageindex].items() :
+                    coefvalue = coefficients.get(ink, 1.0)
+                    self.parent.tool.logdebug("Applying coefficient %f for color %s (used at %f%% on page %i) to base cost gives %f" % (coefvalue, ink, value, pageindex+1, coefvalue * value / 100.0))
+        return price
+
     def computeJobPrice(self, jobsize, inkusage=[]) :
         """Computes the job price as the sum of all parent printers' prices + current printer's ones."""
         totalprice = 0.0
         if jobsize :
             if self.User.OverCharge != 0.0 :    # optimization, but TODO : beware of rounding errors
+                if inkusage :
+                    # the same coefficients apply to all parent printers
+                    pages = self.computeInkPrice(jobsize, inkusage)
+                else :
+                    pages = jobsize
                 for upq in [ self ] + self.ParentPrintersUserPQuota :
                     totalprice += float(upq.Printer.PricePerJob or 0.0)
-                    pageprice = float(upq.Printer.PricePerPage or 0.0)
-                    if not inkusage :
-                        totalprice += (jobsize * pageprice)
-                    else :
-                        for pageindex in range(jobsize) :
-                            try :
-                                usage = inkusage[pageindex]
-                            except IndexError :
-                                self.parent.tool.logdebug("No ink usage information. Using base cost of %f credits for page %i." % (pageprice, pageindex+1))
-                                totalprice += pageprice
-                            else :
-                                coefficients = self.Printer.Coefficients
-                                for (ink, value) in usage.items() :
-                                    coefvalue = coefficients.get(ink, 1.0)
-                                    coefprice = (coefvalue * pageprice) / 100.0
-                                    inkprice = coefprice * value
-                                    self.parent.tool.logdebug("Applying coefficient %f for color %s (used at %f%% on page %i) to base cost %f gives %f" % (coefvalue, ink, value, pageindex+1, pageprice, inkprice))
-                                    totalprice += inkprice
+                    totalprice += pages * float(upq.Printer.PricePerPage or 0.0)
         if self.User.OverCharge != 1.0 : # TODO : beware of rounding errors
             overcharged = totalprice * self.User.OverCharge
             self.parent.tool.logdebug("Overcharging %s by a factor of %s ===> User %s will be charged for %s credits." % (totalprice, self.User.OverCharge, self.User.Name, overcharged))
@@ -359,6 +402,7 @@ class StorageUserPQuota(StorageObject) :
                 self.User.consumeAccountBalance(jobprice)
             for upq in [ self ] + self.ParentPrintersUserPQuota :
                 self.parent.increaseUserPQuotaPagesCounters(upq, jobsize)
+                self.parent.invalidateObject(upq)
                 upq.PageCounter = int(upq.PageCounter or 0) + jobsize
                 upq.LifePageCounter = int(upq.LifePageCounter or 0) + jobsize
         return jobprice
@@ -366,14 +410,15 @@ class StorageUserPQuota(StorageObject) :
     def delete(self) :
         """Deletes an user print quota entry from the database."""
         self.parent.deleteUserPQuota(self)
-        if self.parent.usecache :
-            self.parent.flushEntry("USERPQUOTAS", "%s@%s" % (self.User.Name, self.Printer.Name))
+        self.parent.flushEntry("USERPQUOTAS", "%s@%s" % (self.User.Name, self.Printer.Name))
+        self.parent.flushEntry("LASTJOBS", self.Printer.Name)
         self.Exists = False
         self.isDirty = False
 
     def refund(self, nbpages) :
         """Refunds a number of pages to an user on a particular printer."""
         self.parent.increaseUserPQuotaPagesCounters(self, -nbpages)
+        self.parent.invalidateObject(self)
         self.PageCounter = int(self.PageCounter or 0) - nbpages
         self.LifePageCounter = int(self.LifePageCounter or 0) - nbpages
 
@@ -441,8 +486,7 @@ class StorageGroupPQuota(StorageObject) :
     def delete(self) :
         """Deletes a group print quota entry from the database."""
         self.parent.deleteGroupPQuota(self)
-        if self.parent.usecache :
-            self.parent.flushEntry("GROUPPQUOTAS", "%s@%s" % (self.Group.Name, self.Printer.Name))
+        self.parent.flushEntry("GROUPPQUOTAS", "%s@%s" % (self.Group.Name, self.Printer.Name))
         self.Exists = False
         self.isDirty = False
 
@@ -515,6 +559,7 @@ class StorageJob(StorageObject) :
                     if upq.Exists :
                         upq.refund(self.JobSize)
             self.parent.refundJob(self.ident)
+            self.parent.invalidateEntry("LASTJOBS", self.PrinterName)
         except :
             self.parent.rollbackTransaction()
             self.parent.tool.logdebug("Error while refunding job %s." % self.ident)
@@ -532,6 +577,26 @@ class StorageLastJob(StorageJob) :
         self.Printer = printer
 
 
+class StorageRecentJob(StorageObject) :
+    """User's recent jobs, as remembered by the PyKota processes running on this host."""
+    def __init__(self, parent, username) :
+        StorageObject.__init__(self, parent)
+        self.UserName = username
+        self.JobTimes = "" # "md5sum:time md5sum:time ..." : a string can be shared
+
+    def getJobTimes(self) :
+        """Returns a mapping of the recent jobs' MD5 sums to the last time they were printed."""
+        jobtimes = {}
+        for item in self.JobTimes.split() :
+            (md5sum, jobtime) = item.split(":")
+            jobtimes[md5sum] = float(jobtime)
+        return jobtimes
+
+    def setJobTimes(self, jobtimes) :
+        """Sets the recent jobs from a mapping of their MD5 sums to the last time they were printed."""
+        self.JobTimes = " ".join(["%s:%r" % (md5sum, jobtime) for (md5sum, jobtime) in jobtimes.items()])
+
+
 class StorageBillingCode(StorageObject) :
     """Billing code class."""
     def __init__(self, parent, name) :
@@ -557,6 +622,7 @@ class StorageBillingCode(StorageObject) :
         """Consumes some pages and credits for this billing code."""
         if pages :
             self.parent.consumeBillingCode(self, pages, price)
+            self.parent.invalidateObject(self)
             self.PageCounter += pages
             self.Balance -= price
 
@@ -565,26 +631,53 @@ class StorageBillingCode(StorageObject) :
         self.consume(-pages, -price)
 
 
+CACHETYPES = ("USERS", "GROUPS", "PRINTERS", "USERPQUOTAS", "GROUPPQUOTAS", \
+              "JOBS", "LASTJOBS", "BILLINGCODES", \
+              "PARENTPRINTERS", "GROUPMEMBERS", "USERGROUPS", "RECENTJOBS")
+
 class BaseStorage :
+    cachetypes = CACHETYPES
+    sharedtypes = ("USERS", "GROUPS", "PRINTERS", "USERPQUOTAS", "LASTJOBS", "BILLINGCODES", "RECENTJOBS")
+    # Summaries : allowed grouping keys, and fields totalized
+    summarykeys = { "history" : ("username", "printername", "hostname", "billingcode", "day", "month"),
+                    "payments" : ("username", "day", "month"),
+                  }
+    summarytotals = { "history" : (("jobsize", int), ("jobprice", float), ("jobsizebytes", int), \
+                                   ("precomputedjobsize", int), ("precomputedjobprice", float)),
+                      "payments" : (("amount", float),),
+                    }
+    datebuckets = { "day" : 10, "month" : 7 } # lengths of YYYY-MM-DD and YYYY-MM
     def __init__(self, pykotatool) :
         """Opens the storage connection."""
         self.closed = 1
         self.tool = pykotatool
+        self.config = pykotatool.config
         self.usecache = pykotatool.config.getCaching()
         self.disablehistory = pykotatool.config.getDisableHistory()
         self.privacy = pykotatool.config.getPrivacy()
+        self.sharedcache = None
+        self.pendinginvalidations = None
         if self.privacy :
             pykotatool.logdebug("Jobs' title, filename and options will be hidden because of privacy concerns.")
         if self.usecache :
             self.tool.logdebug("Caching enabled.")
-            self.caches = { "USERS" : {}, \
-                            "GROUPS" : {}, \
-                            "PRINTERS" : {}, \
-                            "USERPQUOTAS" : {}, \
-                            "GROUPPQUOTAS" : {}, \
-                            "JOBS" : {}, \
-                            "LASTJOBS" : {}, \
-                            "BILLINGCODES" : {} }
+            self.caches = {}
+            self.duplicatesdelay = pykotatool.config.getLongestDuplicatesDelay()
+            for cachetype in self.cachetypes :
+                self.caches[cachetype] = LRUCache(cachetype, \
+                                                  pykotatool.config.getCacheSize(cachetype), \
+                                                  pykotatool.config.getCacheTTL(cachetype))
+            directory = pykotatool.config.getSharedCache()
+            if directory :
+                # Groups print quota entries are not shared because their
+                # page counters change each time one of their members prints.
+                ttls = {}
+                for cachetype in self.sharedtypes :
+                    ttls[cachetype] = pykotatool.config.getSharedCacheTTL(cachetype)
+                # recent jobs are only useful to detect duplicates
+                ttls["RECENTJOBS"] = self.duplicatesdelay
+                self.sharedcache = SharedCache(directory, ttls)
+                self.tool.logdebug("Shared caching enabled in %s" % directory)
 
     def close(self) :
         """Must be overriden in children classes."""
@@ -594,65 +687,173 @@ class BaseStorage :
         """Ensures that the database connection is closed."""
         self.close()
 
-    def getFromCache(self, cachetype, key) :
-        """Tries to extract something from the cache."""
+    def getFromCache(self, cachetype, key, factory=None) :
+        """Tries to extract something from the cache.
+
+           When the entry is not in this process' cache, the shared cache
+           is searched, and factory() is called to create an empty object
+           which then receives the shared entry's attributes.
+        """
         if self.usecache :
-            entry = self.caches[cachetype].get(key)
-            if entry is not None :
-                self.tool.logdebug("Cache hit (%s->%s)" % (cachetype, key))
+            cache = self.caches[cachetype]
+            entry = cache.get(key)
+            if (entry is None) and (self.sharedcache is not None) and (factory is not None) :
+                attributes = self.sharedcache.get(cachetype, key)
+                if attributes is not None :
+                    entry = factory()
+                    entry.__dict__.update(attributes)
+                    cache.put(key, entry)
+                    cache.sharedhits += 1
+            if entry is None :
+                metrics.increment("pykota_cache_lookups_total", cache=cachetype, result="miss")
             else :
-                self.tool.logdebug("Cache miss (%s->%s)" % (cachetype, key))
+                metrics.increment("pykota_cache_lookups_total", cache=cachetype, result="hit")
             return entry
 
-    def cacheEntry(self, cachetype, key, value) :
-        """Puts an entry in the cache."""
-        if self.usecache and getattr(value, "Exists", 0) :
-            self.caches[cachetype][key] = value
-            self.tool.logdebug("Cache store (%s->%s)" % (cachetype, key))
+    def cacheEntry(self, cachetype, key, value, readtime=None) :
+        """Puts an entry in the cache.
+
+           readtime is the time at which value was read from the database.
+        """
+        if self.usecache and getattr(value, "Exists", True) :
+            self.caches[cachetype].put(key, value)
+            if (readtime is not None) and (self.sharedcache is not None) and self.sharedcache.isShared(cachetype) :
+                self.sharedcache.put(cachetype, key, shareableAttributes(value), readtime)
 
-    def flushEntry(self, cachetype, key) :
-        """Removes an entry from the cache."""
+    def flushEntry(self, cachetype, key, shared=True) :
+        """Removes an entry from the cache, and from the shared cache if shared is set."""
         if self.usecache :
-            try :
-                del self.caches[cachetype][key]
-            except KeyError :
-                pass
-            else :
-                self.tool.logdebug("Cache flush (%s->%s)" % (cachetype, key))
+            self.caches[cachetype].flush(key)
+            if shared and (self.sharedcache is not None) :
+                self.invalidateShared(self.sharedcache.flush, cachetype, key)
+
+    def flushEntries(self, cachetype, test=None, shared=True) :
+        """Removes all the entries whose key passes the test from the cache, or all of them if test is None."""
+        if self.usecache :
+            cache = self.caches[cachetype]
+            for key in cache.keys() :
+                if (test is None) or test(key) :
+                    cache.flush(key)
+            if shared and (self.sharedcache is not None) :
+                self.invalidateShared(self.sharedcache.flushMatching, cachetype, test)
+
+    def dumpCacheStatistics(self, output=None) :
+        """Outputs the caches' statistics, through the tool's logdebug() method by default."""
+        if self.usecache :
+            output = output or self.tool.logdebug
+            for cachetype in self.cachetypes :
+                statistics = self.caches[cachetype].statistics()
+                statistics["name"] = cachetype
+                output("Cache %(name)s : %(entries)i entries, %(bytes)i bytes, %(hits)i hits, %(sharedhits)i shared hits, %(misses)i misses (%(hitrate).1f%% hit rate), %(evictions)i evictions, %(expirations)i expirations, %(flushes)i flushes" % statistics)
+
+    def invalidateEntry(self, cachetype, key) :
+        """Removes an entry which was just modified in the database from the shared cache.
+
+           The entry stays in this process' cache, which is kept up to date
+           by the storage objects themselves.
+        """
+        if self.sharedcache is not None :
+            self.invalidateShared(self.sharedcache.flush, cachetype, key)
+
+    def invalidateShared(self, function, *arguments) :
+        """Invalidates shared cache entries now, or once the current transaction is committed.
+
+           Invalidating them before the commit would let another process
+           read the old values from the database and share them again.
+        """
+        if self.pendinginvalidations is None :
+            function(*arguments)
+        else :
+            self.pendinginvalidations.append((function, arguments))
+
+    def deferInvalidations(self) :
+        """Keeps the shared cache invalidations until the transaction which begins is over."""
+        if self.pendinginvalidations is None :
+            self.pendinginvalidations = []
+
+    def writeInvalidations(self) :
+        """Does the shared cache invalidations kept during the transaction which was just committed."""
+        pending = self.pendinginvalidations or []
+        self.pendinginvalidations = None
+        for (function, arguments) in pending :
+            function(*arguments)
+
+    def dropInvalidations(self) :
+        """Forgets the shared cache invalidations kept during the transaction which was just aborted."""
+        self.pendinginvalidations = None
+
+    def invalidateObject(self, obj) :
+        """Removes an object which was just modified in the database from the shared cache."""
+        if self.sharedcache is not None :
+            if isinstance(obj, StorageUser) :
+                self.invalidateEntry("USERS", obj.Name)
+            elif isinstance(obj, StorageGroup) :
+                self.invalidateEntry("GROUPS", obj.Name)
+            elif isinstance(obj, StoragePrinter) :
+                self.invalidateEntry("PRINTERS", obj.Name)
+            elif isinstance(obj, StorageUserPQuota) :
+                self.invalidateEntry("USERPQUOTAS", "%s@%s" % (obj.User.Name, obj.Printer.Name))
+            elif isinstance(obj, StorageBillingCode) :
+                self.invalidateEntry("BILLINGCODES", obj.BillingCode)
 
     def getUser(self, username) :
         """Returns the user from cache."""
-        user = self.getFromCache("USERS", username)
+        user = self.getFromCache("USERS", username, lambda : StorageUser(self, username))
         if user is None :
+            readtime = time.time()
             user = self.getUserFromBackend(username)
-            self.cacheEntry("USERS", username, user)
+            self.cacheEntry("USERS", username, user, readtime)
         return user
 
     def getGroup(self, groupname) :
         """Returns the group from cache."""
-        group = self.getFromCache("GROUPS", groupname)
+        group = self.getFromCache("GROUPS", groupname, lambda : StorageGroup(self, groupname))
         if group is None :
+            readtime = time.time()
             group = self.getGroupFromBackend(groupname)
-            self.cacheEntry("GROUPS", groupname, group)
+            self.cacheEntry("GROUPS", groupname, group, readtime)
         return group
 
     def getPrinter(self, printername) :
         """Returns the printer from cache."""
-        printer = self.getFromCache("PRINTERS", printername)
+        printer = self.getFromCache("PRINTERS", printername, lambda : StoragePrinter(self, printername))
         if printer is None :
+            readtime = time.time()
             printer = self.getPrinterFromBackend(printername)
-            self.cacheEntry("PRINTERS", printername, printer)
+            self.cacheEntry("PRINTERS", printername, printer, readtime)
         return printer
 
     def getUserPQuota(self, user, printer) :
         """Returns the user quota information from cache."""
         useratprinter = "%s@%s" % (user.Name, printer.Name)
-        upquota = self.getFromCache("USERPQUOTAS", useratprinter)
+        upquota = self.getFromCache("USERPQUOTAS", useratprinter, lambda : StorageUserPQuota(self, user, printer))
         if upquota is None :
+            readtime = time.time()
             upquota = self.getUserPQuotaFromBackend(user, printer)
-            self.cacheEntry("USERPQUOTAS", useratprinter, upquota)
+            self.cacheEntry("USERPQUOTAS", useratprinter, upquota, readtime)
         return upquota
 
+    def getAccountingContext(self, printername, username) :
+        """Returns the printer, the user and the user print quota entry, from cache or in a single request.
+
+           The printer's last job is retrieved at the same time.
+        """
+        printer = self.getFromCache("PRINTERS", printername, lambda : StoragePrinter(self, printername))
+        user = self.getFromCache("USERS", username, lambda : StorageUser(self, username))
+        if (printer is not None) and (user is not None) :
+            useratprinter = "%s@%s" % (username, printername)
+            upquota = self.getFromCache("USERPQUOTAS", useratprinter, lambda : StorageUserPQuota(self, user, printer))
+            if upquota is not None :
+                return (printer, user, upquota)
+        readtime = time.time()
+        (printer, user, upquota, lastjob) = self.getAccountingContextFromBackend(printername, username)
+        self.cacheEntry("PRINTERS", printername, printer, readtime)
+        self.cacheEntry("USERS", username, user, readtime)
+        self.cacheEntry("USERPQUOTAS", "%s@%s" % (username, printername), upquota, readtime)
+        self.cacheEntry("LASTJOBS", printername, lastjob, readtime)
+        printer.LastJob = lastjob
+        return (printer, user, upquota)
+
     def getGroupPQuota(self, group, printer) :
         """Returns the group quota information from cache."""
         groupatprinter = "%s@%s" % (group.Name, printer.Name)
@@ -664,64 +865,87 @@ class BaseStorage :
 
     def getPrinterLastJob(self, printer) :
         """Extracts last job information for a given printer from cache."""
-        lastjob = self.getFromCache("LASTJOBS", printer.Name)
+        lastjob = self.getFromCache("LASTJOBS", printer.Name, lambda : StorageLastJob(self, printer))
         if lastjob is None :
+            readtime = time.time()
             lastjob = self.getPrinterLastJobFromBackend(printer)
-            self.cacheEntry("LASTJOBS", printer.Name, lastjob)
+            self.cacheEntry("LASTJOBS", printer.Name, lastjob, readtime)
         return lastjob
 
     def getBillingCode(self, label) :
         """Returns the user from cache."""
-        code = self.getFromCache("BILLINGCODES", label)
+        code = self.getFromCache("BILLINGCODES", label, lambda : StorageBillingCode(self, label))
         if code is None :
+            readtime = time.time()
             code = self.getBillingCodeFromBackend(label)
-            self.cacheEntry("BILLINGCODES", label, code)
+            self.cacheEntry("BILLINGCODES", label, code, readtime)
         return code
 
+    def getUserRecentJob(self, username) :
+        """Returns the user's recent jobs from cache, or None if not remembered.
+
+           The database is never queried : only jobs printed since
+           the cache was filled are known.
+        """
+        return self.getFromCache("RECENTJOBS", username, lambda : StorageRecentJob(self, username))
+
+    def rememberUserJob(self, username, md5sum) :
+        """Remembers the user's job in the cache, forgetting the ones older than the longest duplicatesdelay.
+
+           The shared entry stays locked from its reading to its
+           writing, so concurrent jobs can't forget each other.
+        """
+        if self.usecache and (self.duplicatesdelay > 0) :
+            now = time.time()
+            job = StorageRecentJob(self, username)
+            job.Exists = True
+            def addJob(attributes) :
+                """Adds the job to the recent jobs, returns their shareable attributes."""
+                if attributes is not None :
+                    job.__dict__.update(attributes)
+                jobtimes = job.getJobTimes()
+                for (jobmd5sum, jobtime) in jobtimes.items() :
+                    if (now - jobtime) > self.duplicatesdelay :
+                        del jobtimes[jobmd5sum]
+                jobtimes[md5sum] = now
+                job.setJobTimes(jobtimes)
+                return shareableAttributes(job)
+            if (self.sharedcache is None) or (self.sharedcache.update("RECENTJOBS", username, addJob) is None) :
+                recentjob = self.getUserRecentJob(username)
+                if recentjob is not None :
+                    job.JobTimes = recentjob.JobTimes
+                addJob(None)
+            self.caches["RECENTJOBS"].put(username, job)
+
     def getParentPrinters(self, printer) :
-        """Extracts parent printers information for a given printer from cache."""
-        if self.usecache :
-            if not hasattr(printer, "Parents") :
-                self.tool.logdebug("Cache miss (%s->Parents)" % printer.Name)
-                printer.Parents = self.getParentPrintersFromBackend(printer)
-                self.tool.logdebug("Cache store (%s->Parents)" % printer.Name)
-            else :
-                self.tool.logdebug("Cache hit (%s->Parents)" % printer.Name)
-        else :
-            printer.Parents = self.getParentPrintersFromBackend(printer)
-        for parent in printer.Parents[:] :
-            printer.Parents.extend(self.getParentPrinters(parent))
-        uniquedic = {}
-        for parent in printer.Parents :
-            uniquedic[parent.Name] = parent
-        printer.Parents = uniquedic.values()
-        return printer.Parents
+        """Returns the printer's parents list from cache."""
+        parents = self.getFromCache("PARENTPRINTERS", printer.Name)
+        if parents is None :
+            parents = self.getParentPrintersFromBackend(printer)
+            for parent in parents[:] :
+                parents.extend(self.getParentPrinters(parent))
+            uniquedic = {}
+            for parent in parents :
+                uniquedic[parent.Name] = parent
+            parents = uniquedic.values()
+            self.cacheEntry("PARENTPRINTERS", printer.Name, parents)
+        return parents
 
     def getGroupMembers(self, group) :
-        """Returns the group's members list from in-group cache."""
-        if self.usecache :
-            if not hasattr(group, "Members") :
-                self.tool.logdebug("Cache miss (%s->Members)" % group.Name)
-                group.Members = self.getGroupMembersFromBackend(group)
-                self.tool.logdebug("Cache store (%s->Members)" % group.Name)
-            else :
-                self.tool.logdebug("Cache hit (%s->Members)" % group.Name)
-        else :
-            group.Members = self.getGroupMembersFromBackend(group)
-        return group.Members
+        """Returns the group's members list from cache."""
+        members = self.getFromCache("GROUPMEMBERS", group.Name)
+        if members is None :
+            members = self.getGroupMembersFromBackend(group)
+            self.cacheEntry("GROUPMEMBERS", group.Name, members)
+        return members
 
     def getUserGroups(self, user) :
-        """Returns the user's groups list from in-user cache."""
-        if self.usecache :
-            if not hasattr(user, "Groups") :
-                self.tool.logdebug("Cache miss (%s->Groups)" % user.Name)
-                user.Groups = self.getUserGroupsFromBackend(user)
-                self.tool.logdebug("Cache store (%s->Groups)" % user.Name)
-            else :
-                self.tool.logdebug("Cache hit (%s->Groups)" % user.Name)
-        else :
-            user.Groups = self.getUserGroupsFromBackend(user)
-        return user.Groups
+        """Returns the user's groups list from cache."""
+        groups = self.getFromCache("USERGROUPS", user.Name)
+        if groups is None :
+            groups = self.getUserGroupsFromBackend(user)
+            self.cacheEntry("USERGROUPS", user.Name, groups)
+        return groups
 
     def getParentPrintersUserPQuota(self, userpquota) :
         """Returns all user print quota on the printer and all its parents recursively."""
@@ -741,6 +965,53 @@ class BaseStorage :
                 gpquotas.append(gpq)
         return gpquotas
 
+    def summarizeRecords(self, records, datatype, keys, datefield) :
+        """Totalizes extracted records, grouped by some keys, in a single pass.
+
+           Returns the field names then one row per group, sorted by
+           keys, or None if there's no record. The day and month keys
+           group records by their datefield's day or month.
+        """
+        if not records :
+            return None
+        records = iter(records)
+        headers = records.next()
+        indexes = {}
+        for i in range(len(headers)) :
+            indexes[headers[i]] = i
+        keyindexes = []
+        for key in keys :
+            if self.datebuckets.has_key(key) :
+                keyindexes.append((indexes[datefield], self.datebuckets[key]))
+            else :
+                keyindexes.append((indexes[key], None))
+        totalize = self.summarytotals[datatype]
+        totalindexes = [(indexes[field], converter) for (field, converter) in totalize]
+        groups = {}
+        for record in records :
+            groupkey = []
+            for (index, length) in keyindexes :
+                if length is None :
+                    groupkey.append(record[index])
+                else :
+                    groupkey.append(str(record[index])[:length])
+            groupkey = tuple(groupkey)
+            totals = groups.get(groupkey)
+            if totals is None :
+                totals = groups[groupkey] = [0] + [converter(0) for (index, converter) in totalindexes]
+            totals[0] += 1
+            for i in range(len(totalindexes)) :
+                (index, converter) = totalindexes[i]
+                totals[i+1] += converter(record[index] or 0)
+        if not groups :
+            return None
+        groupkeys = groups.keys()
+        groupkeys.sort()
+        result = [tuple(list(keys) + ["count"] + [field for (field, converter) in totalize])]
+        for groupkey in groupkeys :
+            result.append(groupkey + tuple(groups[groupkey]))
+        return result
+
     def databaseToUserCharset(self, text) :
         """Converts from database format (UTF-8) to user's charset."""
         return self.tool.UTF8ToUserCharset(text)
@@ -852,10 +1123,7 @@ def openConnection(pykotatool) :
     backendinfo = pykotatool.config.getStorageBackend()
     backend = backendinfo["storagebackend"]
     try :
-        storagebackend = imp.load_source("storagebackend",
-                                         os.path.join(os.path.dirname(__file__),
-                                                      "storages",
-                                                      "%s.py" % backend.lower()))
+        storagebackend = loadPlugin("storage", backend)
     except ImportError :
         raise PyKotaStorageError, _("Unsupported quota storage backend %s") % backend
     else :
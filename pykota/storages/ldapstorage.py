@@ -42,6 +42,7 @@ from pykota.storage import PyKotaStorageError, BaseStorage, \
                            StorageUser, StorageGroup, StoragePrinter, \
                            StorageJob, StorageLastJob, StorageUserPQuota, \
                            StorageGroupPQuota, StorageBillingCode
+from pykota.storages.pool import PooledStorage
 
 try :
     import ldap
@@ -57,56 +58,51 @@ else :
         class cidict(UserDict.UserDict) :
             pass # Fake it all, and don't care for case insensitivity : users who need it will have to upgrade.
     
-class Storage(BaseStorage) :
+class Storage(BaseStorage, PooledStorage) :
     def __init__(self, pykotatool, host, dbname, user, passwd) :
         """Opens the LDAP connection."""
-        self.savedtool = pykotatool
-        self.savedhost = host
-        self.saveddbname = dbname
-        self.saveduser = user
-        self.savedpasswd = passwd
-        self.secondStageInit()
-        
-    def secondStageInit(self) :    
-        """Second stage initialisation."""
-        BaseStorage.__init__(self, self.savedtool)
+        BaseStorage.__init__(self, pykotatool)
         self.info = self.tool.config.getLDAPInfo()
-        message = ""
-        for tryit in range(3) :
+        self.basedn = dbname
+        
+        def opener() :
+            """Opens a new connection to the LDAP server."""
+            self.tool.logdebug("Trying to open database (host=%s, dbname=%s, user=%s)..." % (host, dbname, user))
             try :
-                self.tool.logdebug("Trying to open database (host=%s, dbname=%s, user=%s)..." % (self.savedhost, self.saveddbname, self.saveduser))
-                self.database = ldap.initialize(self.savedhost) 
+                database = ldap.initialize(host) 
                 if self.info["ldaptls"] :
                     # we want TLS
                     ldap.set_option(ldap.OPT_X_TLS_CACERTFILE, self.info["cacert"])
-                    self.database.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
-                    self.database.start_tls_s()
-                self.database.simple_bind_s(self.saveduser, self.savedpasswd)
-                self.basedn = self.saveddbname
+                    database.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
+                    database.start_tls_s()
+                database.simple_bind_s(user, passwd)
             except ldap.SERVER_DOWN :    
-                message = "LDAP backend for PyKota seems to be down !"
-                self.tool.printInfo("%s" % message, "error")
-                self.tool.printInfo("Trying again in 2 seconds...", "warn")
-                time.sleep(2)
+                raise PyKotaStorageError, "LDAP backend for PyKota seems to be down !"
             except ldap.LDAPError :    
-                message = "Unable to connect to LDAP server %s as %s." % (self.savedhost, self.saveduser)
-                self.tool.printInfo("%s" % message, "error")
-                self.tool.printInfo("Trying again in 2 seconds...", "warn")
-                time.sleep(2)
-            else :    
-                self.useldapcache = self.tool.config.getLDAPCache()
-                if self.useldapcache :
-                    self.tool.logdebug("Low-Level LDAP Caching enabled.")
-                    self.ldapcache = {} # low-level cache specific to LDAP backend
-                self.closed = 0
-                self.tool.logdebug("Database opened (host=%s, dbname=%s, user=%s)" % (self.savedhost, self.saveddbname, self.saveduser))
-                return # All is fine here.
-        raise PyKotaStorageError, message         
+                raise PyKotaStorageError, "Unable to connect to LDAP server %s as %s." % (host, user)
+            self.tool.logdebug("Database opened (host=%s, dbname=%s, user=%s)" % (host, dbname, user))
+            return database
+            
+        self.useldapcache = self.tool.config.getLDAPCache()
+        if self.useldapcache :
+            self.tool.logdebug("Low-Level LDAP Caching enabled.")
+            self.ldapcache = {} # low-level cache specific to LDAP backend
+        self.openPool("ldapstorage://%s@%s/%s" % (user, host, dbname), \
+                      opener, \
+                      lambda database : database.search_s("", ldap.SCOPE_BASE, "(objectClass=*)", ["objectClass"]), \
+                      lambda database : database.unbind_s())
+        self.closed = 0
+            
+    def setConnection(self, pooled) :
+        """Uses a connection checked out of the pool."""
+        self.database = pooled.connection
             
     def close(self) :    
         """Closes the database connection."""
         if not self.closed :
-            self.database.unbind_s()
+            self.dumpCacheStatistics()
+            self.dumpPoolStatistics()
+            self.releaseConnection()
             self.closed = 1
             self.tool.logdebug("Database closed.")
         
@@ -168,8 +164,7 @@ class Storage(BaseStorage) :
                 message = (_("Search for %s(%s) from %s(scope=%s) returned no answer.") % (key, fields, base, scope)) + " : %s" % str(msg)
                 self.tool.printInfo("LDAP error : %s" % message, "error")
                 self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
-                self.close()
-                self.secondStageInit()
+                self.reconnect()
             else :     
                 self.tool.logdebug("QUERY : Result : %s" % result)
                 result = [ (dn, cidict(attrs)) for (dn, attrs) in result ]
@@ -196,8 +191,7 @@ class Storage(BaseStorage) :
                 message = (_("Problem adding LDAP entry (%s, %s)") % (dn, str(fields))) + " : %s" % str(msg)
                 self.tool.printInfo("LDAP error : %s" % message, "error")
                 self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
-                self.close()
-                self.secondStageInit()
+                self.reconnect()
             else :
                 if self.useldapcache :
                     self.tool.logdebug("LDAP cache add %s => %s" % (dn, fields))
@@ -218,8 +212,7 @@ class Storage(BaseStorage) :
                 message = (_("Problem deleting LDAP entry (%s)") % dn) + " : %s" % str(msg)
                 self.tool.printInfo("LDAP error : %s" % message, "error")
                 self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
-                self.close()
-                self.secondStageInit()
+                self.reconnect()
             else :    
                 if self.useldapcache :
                     try :
@@ -275,8 +268,7 @@ class Storage(BaseStorage) :
                 message = (_("Problem modifying LDAP entry (%s, %s)") % (dn, fields)) + " : %s" % str(msg)
                 self.tool.printInfo("LDAP error : %s" % message, "error")
                 self.tool.printInfo("LDAP connection will be closed and reopened.", "warn")
-                self.close()
-                self.secondStageInit()
+                self.reconnect()
             else :
                 if self.useldapcache :
                     cachedentry = self.ldapcache[dn]
@@ -625,6 +617,12 @@ class Storage(BaseStorage) :
                 lastjob.Exists = True
         return lastjob
         
+    def getAccountingContextFromBackend(self, printername, username) :
+        """Extracts a printer, an user, the user's print quota and the printer's last job."""
+        printer = self.getPrinter(printername)
+        user = self.getUser(username)
+        return (printer, user, self.getUserPQuota(user, printer), self.getPrinterLastJob(printer))
+
     def getGroupMembersFromBackend(self, group) :        
         """Returns the group's members list."""
         groupmembers = []
@@ -1038,7 +1036,6 @@ class Storage(BaseStorage) :
                     fields[self.info["groupmembers"]] = []
                 fields[self.info["groupmembers"]].append(self.userCharsetToDatabase(user.Name))
                 self.doModify(group.ident, fields)
-                group.Members.append(user)
                 
     def delUserFromGroup(self, user, group) :    
         """Removes an user from a group."""
@@ -1054,7 +1051,6 @@ class Storage(BaseStorage) :
                     pass # TODO : Strange, shouldn't it be there ?
                 else :
                     self.doModify(group.ident, fields)
-                    group.Members.remove(user)
                 
     def addUserPQuota(self, upq) :
         """Initializes a user print quota on a printer."""
@@ -1715,7 +1711,7 @@ class Storage(BaseStorage) :
             result = []
             uname = extractonly.get("username")
             for entry in entries :
-                for member in entry.Members :
+                for member in self.getGroupMembers(entry) :
                     if (uname is None) or (member.Name == uname) :
                         result.append((entry.Name, member.Name, entry.ident, member.ident))
             return [fields] + self.sortRecords(fields, result, ["+groupdn", "+userdn"], ordering)
@@ -1757,6 +1753,14 @@ class Storage(BaseStorage) :
                 result.append((entry.UserName, entry.PrinterName, entry.ident, entry.JobId, entry.PrinterPageCounter, entry.JobSize, entry.JobAction, entry.JobDate, entry.JobFileName, entry.JobTitle, entry.JobCopies, entry.JobOptions, entry.JobPrice, entry.JobHostName, entry.JobSizeBytes, entry.JobMD5Sum, entry.JobPages, entry.JobBillingCode, entry.PrecomputedJobSize, entry.PrecomputedJobPrice)) 
             return [fields] + self.sortRecords(fields, result, ["+dn"], ordering)
             
+    def summarizeHistory(self, extractonly={}, keys=[]) :
+        """Totalizes the jobs history, grouped by some keys."""
+        return self.summarizeRecords(self.extractHistory(extractonly), "history", keys, "jobdate")
+        
+    def summarizePayments(self, extractonly={}, keys=[]) :
+        """Totalizes the payments, grouped by some keys."""
+        return self.summarizeRecords(self.extractPayments(extractonly), "payments", keys, "date")
+        
     def getBillingCodeFromBackend(self, label) :
         """Extracts billing code information given its label : returns first matching billing code."""
         code = StorageBillingCode(self, label)
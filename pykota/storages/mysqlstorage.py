@@ -28,91 +28,141 @@
 import time
 
 from pykota.storage import PyKotaStorageError, BaseStorage
+from pykota import metrics
+from pykota.latency import recordSpan
 from pykota.storages.sql import SQLStorage
+from pykota.storages.pool import PooledStorage
 
 try :
     import MySQLdb
+    import MySQLdb.cursors
 except ImportError :    
     import sys
     # TODO : to translate or not to translate ?
     raise PyKotaStorageError, "This python version (%s) doesn't seem to have the MySQL module installed correctly." % sys.version.split()[0]
 
-class Storage(BaseStorage, SQLStorage) :
+class Storage(BaseStorage, SQLStorage, PooledStorage) :
     def __init__(self, pykotatool, host, dbname, user, passwd) :
         """Opens the MySQL database connection."""
         BaseStorage.__init__(self, pykotatool)
+        SQLStorage.__init__(self)
         try :
             (host, port) = host.split(":")
             port = int(port)
         except ValueError :    
             port = 3306           # Use the default MySQL port
         
-        self.tool.logdebug("Trying to open database (host=%s, port=%s, dbname=%s, user=%s)..." % (host, port, dbname, user))
-        try :
-            self.database = MySQLdb.connect(host=host, port=port, db=dbname, user=user, passwd=passwd, charset="utf8")
-        except TypeError :    
-            self.tool.logdebug("'charset' argument not allowed with this version of python-mysqldb, retrying without...")
-            self.database = MySQLdb.connect(host=host, port=port, db=dbname, user=user, passwd=passwd)
+        def opener() :
+            """Opens a new connection to the database."""
+            self.tool.logdebug("Trying to open database (host=%s, port=%s, dbname=%s, user=%s)..." % (host, port, dbname, user))
+            try :
+                try :
+                    database = MySQLdb.connect(host=host, port=port, db=dbname, user=user, passwd=passwd, charset="utf8")
+                except TypeError :    
+                    self.tool.logdebug("'charset' argument not allowed with this version of python-mysqldb, retrying without...")
+                    database = MySQLdb.connect(host=host, port=port, db=dbname, user=user, passwd=passwd)
+            except MySQLdb.Error, msg :
+                raise PyKotaStorageError, str(msg)
+                
+            try :
+                database.autocommit(1)
+            except AttributeError :    
+                raise PyKotaStorageError, _("Your version of python-mysqldb is too old. Please install a newer release.")
+            cursor = database.cursor()
+            cursor.execute("SET NAMES 'utf8';")
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED;") # Same as PostgreSQL and Oracle's default
+            cursor.close()
+            self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s)" % (host, port, dbname, user))
+            return database
             
-        try :
-            self.database.autocommit(1)
-        except AttributeError :    
-            raise PyKotaStorageError, _("Your version of python-mysqldb is too old. Please install a newer release.")
-        self.cursor = self.database.cursor()
-        self.cursor.execute("SET NAMES 'utf8';")
-        self.cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED;") # Same as PostgreSQL and Oracle's default
+        self.openPool("mysqlstorage://%s@%s:%s/%s" % (user, host, port, dbname), \
+                      opener, \
+                      lambda database : database.ping(), \
+                      lambda database : database.close())
         self.closed = 0
-        self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s)" % (host, port, dbname, user))
             
+    def setConnection(self, pooled) :
+        """Uses a connection checked out of the pool."""
+        self.database = pooled.connection
+        self.cursor = self.database.cursor()
+        
     def close(self) :    
         """Closes the database connection."""
         if not self.closed :
+            self.dumpCacheStatistics()
+            self.dumpStatementStatistics()
+            self.dumpPoolStatistics()
             self.cursor.close()
-            self.database.close()
+            self.releaseConnection()
             self.closed = 1
             self.tool.logdebug("Database closed.")
         
     def beginTransaction(self) :    
         """Starts a transaction."""
+        self.checkConnection()
         self.before = time.time()
         self.cursor.execute("BEGIN;")
+        self.intransaction = True
+        self.deferInvalidations()
         self.tool.logdebug("Transaction begins...")
         
     def commitTransaction(self) :    
         """Commits a transaction."""
+        self.intransaction = False
         self.database.commit()
+        self.writeInvalidations()
         after = time.time()
         self.tool.logdebug("Transaction committed.")
-        #self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
+        recordSpan(self.tool, "transaction", self.before, after)
         
     def rollbackTransaction(self) :     
         """Rollbacks a transaction."""
+        self.intransaction = False
         self.database.rollback()
+        self.dropInvalidations()
         after = time.time()
         self.tool.logdebug("Transaction aborted.")
-        #self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
+        recordSpan(self.tool, "transaction", self.before, after)
         
-    def doRawSearch(self, query) :
-        """Does a raw search query."""
+    def prepareStatement(self, query) :
+        """Returns the query to give to the cursor along with its parameters.
+
+           MySQLdb has no server side prepared statements, but the
+           parameters are escaped by the driver instead of by us.
+        """
+        query = query.strip()
+        if not query.endswith(';') :
+            query += ';'
+        return query
+
+    def executeSearch(self, query, parameters=None) :
+        """Sends a search query to the database, with bound parameters if given."""
+        if parameters is not None :
+            query = self.getPreparedStatement(query)
         query = query.strip()    
         if not query.endswith(';') :    
             query += ';'
         try :
             before = time.time()
             self.tool.logdebug("QUERY : %s" % query)
-            self.cursor.execute(query)
+            self.cursor.execute(query, parameters)
         except self.database.Error, msg :    
             raise PyKotaStorageError, str(msg)
         else :    
             # This returns a list of lists. Integers are returned as longs.
             result = self.cursor.fetchall()
             after = time.time()
-            #self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            recordSpan(self.tool, "query", before, after)
+            metrics.observe("pykota_storage_query_seconds", after - before)
             return result
             
-    def doSearch(self, query) :        
-        """Does a search query."""
-        result = self.doRawSearch(query)
+    def doRawSearch(self, query, parameters=None) :
+        """Does a raw search query, with bound parameters if given."""
+        return self.runReadOnly(self.executeSearch, query, parameters)
+            
+    def doSearch(self, query, parameters=None) :        
+        """Does a search query, with bound parameters if given."""
+        result = self.doRawSearch(query, parameters)
         if result :
             rows = []
             fields = {}
@@ -131,21 +181,28 @@ class Storage(BaseStorage, SQLStorage) :
             # returns a list of dicts
             return rows
 
-    def doModify(self, query) :
-        """Does a (possibly multiple) modify query."""
+    def executeModification(self, query, parameters=None) :
+        """Sends a modification query to the database, with bound parameters if given."""
+        if parameters is not None :
+            query = self.getPreparedStatement(query)
         query = query.strip()    
         if not query.endswith(';') :    
             query += ';'
         try :
             before = time.time()
             self.tool.logdebug("QUERY : %s" % query)
-            self.cursor.execute(query)
+            self.cursor.execute(query, parameters)
         except self.database.Error, msg :    
             self.tool.logdebug("Query failed : %s" % repr(msg))
             raise PyKotaStorageError, str(msg)
         else :    
             after = time.time()
-            #self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            recordSpan(self.tool, "query", before, after)
+            metrics.observe("pykota_storage_query_seconds", after - before)
+            
+    def doModify(self, query, parameters=None) :
+        """Does a (possibly multiple) modify query, with bound parameters if given."""
+        self.runModification(self.executeModification, query, parameters)
             
     def doQuote(self, field) :
         """Quotes a field for use as a string in SQL queries."""
@@ -165,17 +222,50 @@ class Storage(BaseStorage, SQLStorage) :
             self.tool.logdebug("WARNING: field has no type, returning NULL")
             return "NULL"
 
-    def prepareRawResult(self, result) :
-        """Prepares a raw result by including the headers."""
-        if result :
-            entries = [tuple([f[0] for f in self.cursor.description])]
-            for entry in result :
-                row = []
-                for value in entry :
-                    try :
-                        value = value.encode("UTF-8")
-                    except :
-                        pass
-                    row.append(value)
-                entries.append(tuple(row))
-            return entries
+    def executeCursor(self, query) :
+        """Runs a search query on an unbuffered cursor of its own, and returns this cursor."""
+        query = query.strip()
+        if not query.endswith(';') :
+            query += ';'
+        # rows stay on the server until fetched
+        cursor = self.database.cursor(MySQLdb.cursors.SSCursor)
+        try :
+            self.tool.logdebug("QUERY : %s" % query)
+            cursor.execute(query)
+        except self.database.Error, msg :
+            cursor.close()
+            raise PyKotaStorageError, str(msg)
+        return cursor
+
+    def openCursor(self, query) :
+        """Runs a search query on an unbuffered cursor of its own, and returns this cursor."""
+        return self.runReadOnly(self.executeCursor, query)
+
+    def fetchBatch(self, cursor) :
+        """Returns the next batch of rows of a search, or an empty list at its end."""
+        try :
+            return cursor.fetchmany(self.fetchsize)
+        except self.database.Error, msg :
+            raise PyKotaStorageError, str(msg)
+
+    def cursorFields(self, cursor) :
+        """Returns the field names of a search."""
+        return tuple([f[0] for f in cursor.description])
+
+    def closeCursor(self, cursor) :
+        """Frees a search's cursor."""
+        cursor.close()
+
+    def prepareRawRows(self, rows) :
+        """Converts a batch of rows, encoding strings to UTF-8."""
+        entries = []
+        for entry in rows :
+            row = []
+            for value in entry :
+                try :
+                    value = value.encode("UTF-8")
+                except :
+                    pass
+                row.append(value)
+            entries.append(tuple(row))
+        return entries
@@ -28,7 +28,10 @@ import time
 from types import StringType
 
 from pykota.storage import PyKotaStorageError, BaseStorage
+from pykota import metrics
+from pykota.latency import recordSpan
 from pykota.storages.sql import SQLStorage
+from pykota.storages.pool import PooledStorage
 
 try :
     import pg
@@ -42,58 +45,103 @@ else :
     except AttributeError :
         PGError = pg.error
 
-class Storage(BaseStorage, SQLStorage) :
+class Storage(BaseStorage, SQLStorage, PooledStorage) :
     def __init__(self, pykotatool, host, dbname, user, passwd) :
         """Opens the PostgreSQL database connection."""
         BaseStorage.__init__(self, pykotatool)
+        SQLStorage.__init__(self)
         try :
             (host, port) = host.split(":")
             port = int(port)
         except ValueError :
             port = 5432         # Use PostgreSQL's default tcp/ip port (5432).
 
-        self.tool.logdebug("Trying to open database (host=%s, port=%s, dbname=%s, user=%s)..." % (host, port, dbname, user))
-        try :
-            self.database = pg.DB(host=host, port=port, dbname=dbname, user=user, passwd=passwd)
-        except PGError, msg :
-            msg = "%(msg)s --- the most probable cause of your problem is that PostgreSQL is down, or doesn't accept incoming connections because you didn't configure it as explained in PyKota's documentation." % locals()
-            raise PGError, msg
+        def opener() :
+            """Opens a new connection to the database."""
+            self.tool.logdebug("Trying to open database (host=%s, port=%s, dbname=%s, user=%s)..." % (host, port, dbname, user))
+            try :
+                database = pg.DB(host=host, port=port, dbname=dbname, user=user, passwd=passwd)
+            except PGError, msg :
+                msg = "%(msg)s --- the most probable cause of your problem is that PostgreSQL is down, or doesn't accept incoming connections because you didn't configure it as explained in PyKota's documentation." % locals()
+                raise PyKotaStorageError, msg
+            try :
+                database.query("SET CLIENT_ENCODING TO 'UTF-8';")
+            except PGError, msg :
+                self.tool.logdebug("Impossible to set database client encoding to UTF-8 : %s" % msg)
+            self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s)" % (host, port, dbname, user))
+            return database
+
+        self.openPool("pgstorage://%s@%s:%s/%s" % (user, host, port, dbname), \
+                      opener, \
+                      lambda database : database.query("SELECT 1;"), \
+                      lambda database : database.close())
         self.closed = 0
-        try :
-            self.database.query("SET CLIENT_ENCODING TO 'UTF-8';")
-        except PGError, msg :
-            self.tool.logdebug("Impossible to set database client encoding to UTF-8 : %s" % msg)
-        self.tool.logdebug("Database opened (host=%s, port=%s, dbname=%s, user=%s)" % (host, port, dbname, user))
+
+    def setConnection(self, pooled) :
+        """Uses a connection checked out of the pool."""
+        self.database = pooled.connection
+        # prepared statements only exist in the connection they were prepared in
+        self.preparedstatements = pooled.state.setdefault("preparedstatements", {})
 
     def close(self) :
         """Closes the database connection."""
         if not self.closed :
-            self.database.close()
+            self.dumpCacheStatistics()
+            self.dumpStatementStatistics()
+            self.dumpPoolStatistics()
+            self.releaseConnection()
             self.closed = 1
             self.tool.logdebug("Database closed.")
 
     def beginTransaction(self) :
         """Starts a transaction."""
+        self.checkConnection()
         self.before = time.time()
         self.database.query("BEGIN;")
+        self.intransaction = True
+        self.deferInvalidations()
         self.tool.logdebug("Transaction begins...")
 
     def commitTransaction(self) :
         """Commits a transaction."""
+        self.intransaction = False
         self.database.query("COMMIT;")
+        self.writeInvalidations()
         after = time.time()
         self.tool.logdebug("Transaction committed.")
-        #self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
+        recordSpan(self.tool, "transaction", self.before, after)
 
     def rollbackTransaction(self) :
         """Rollbacks a transaction."""
+        self.intransaction = False
         self.database.query("ROLLBACK;")
+        self.dropInvalidations()
         after = time.time()
         self.tool.logdebug("Transaction aborted.")
-        #self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
+        recordSpan(self.tool, "transaction", self.before, after)
+
+    def prepareStatement(self, query) :
+        """Prepares a parameterized query on the server, returns its name."""
+        name = "pykota%i" % (len(self.preparedstatements) + 1)
+        parts = query.strip().rstrip(";").split("%s")
+        text = [parts[0]]
+        for i in range(1, len(parts)) :
+            text.append("$%i%s" % (i, parts[i]))
+        self.executeQuery("PREPARE %s AS %s" % (name, "".join(text)))
+        return name
+
+    def executeStatement(self, query, parameters) :
+        """Returns the query executing a prepared statement with some parameters."""
+        name = self.getPreparedStatement(query)
+        if parameters :
+            return "EXECUTE %s (%s)" % (name, ", ".join([str(self.doQuote(p)) for p in parameters]))
+        else :
+            return "EXECUTE %s" % name
 
-    def doRawSearch(self, query) :
-        """Does a raw search query."""
+    def executeQuery(self, query, parameters=None) :
+        """Sends a query to the database, through a prepared statement if parameters are given."""
+        if parameters is not None :
+            query = self.executeStatement(query, parameters)
         query = query.strip()
         if not query.endswith(';') :
             query += ';'
@@ -102,51 +150,75 @@ class Storage(BaseStorage, SQLStorage) :
             self.tool.logdebug("QUERY : %s" % query)
             result = self.database.query(query)
         except PGError, msg :
+            self.tool.logdebug("Query failed : %s" % repr(msg))
             raise PyKotaStorageError, str(msg)
         else :
             after = time.time()
-            #self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            recordSpan(self.tool, "query", before, after)
+            metrics.observe("pykota_storage_query_seconds", after - before)
             return result
 
-    def doSearch(self, query) :
-        """Does a search query."""
-        result = self.doRawSearch(query)
+    def doRawSearch(self, query, parameters=None) :
+        """Does a raw search query, through a prepared statement if parameters are given."""
+        return self.runReadOnly(self.executeQuery, query, parameters)
+
+    def doSearch(self, query, parameters=None) :
+        """Does a search query, through a prepared statement if parameters are given."""
+        result = self.doRawSearch(query, parameters)
         if (result is not None) and (result.ntuples() > 0) :
             return result.dictresult()
 
-    def doModify(self, query) :
-        """Does a (possibly multiple) modify query."""
-        query = query.strip()
-        if not query.endswith(';') :
-            query += ';'
-        try :
-            before = time.time()
-            self.tool.logdebug("QUERY : %s" % query)
-            result = self.database.query(query)
-        except PGError, msg :
-            self.tool.logdebug("Query failed : %s" % repr(msg))
-            raise PyKotaStorageError, str(msg)
-        else :
-            after = time.time()
-            #self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
-            return result
+    def doModify(self, query, parameters=None) :
+        """Does a (possibly multiple) modify query, through a prepared statement if parameters are given."""
+        return self.runModification(self.executeQuery, query, parameters)
 
     def doQuote(self, field) :
         """Quotes a field for use as a string in SQL queries."""
         return self.database.adapter.adapt_inline(field)
 
-    def prepareRawResult(self, result) :
-        """Prepares a raw result by including the headers."""
-        if result.ntuples() > 0 :
-            entries = [result.listfields()]
-            entries.extend(result.getresult())
-            nbfields = len(entries[0])
-            for i in range(1, len(entries)) :
-                fields = list(entries[i])
-                for j in range(nbfields) :
-                    field = fields[j]
-                    if type(field) == StringType :
-                        fields[j] = self.databaseToUserCharset(field)
-                entries[i] = tuple(fields)
-            return entries
+    def openCursor(self, query) :
+        """Declares a server side cursor for a search query, and returns it as [name, field names].
+
+           PostgreSQL's cursors only exist inside a transaction.
+        """
+        cursor = ["pykotacursor", ()]
+        self.beginTransaction()
+        try :
+            self.executeQuery("DECLARE %s NO SCROLL CURSOR FOR %s" % (cursor[0], query.strip().rstrip(";")))
+        except :
+            self.rollbackTransaction()
+            raise
+        return cursor
+
+    def fetchBatch(self, cursor) :
+        """Returns the next batch of rows of a search, or an empty list at its end."""
+        result = self.executeQuery("FETCH FORWARD %i FROM %s" % (self.fetchsize, cursor[0]))
+        cursor[1] = result.listfields()
+        return result.getresult()
+
+    def cursorFields(self, cursor) :
+        """Returns the field names of a search."""
+        return cursor[1]
+
+    def closeCursor(self, cursor) :
+        """Frees a search's cursor, and ends its transaction."""
+        try :
+            self.executeQuery("CLOSE %s" % cursor[0])
+        except :
+            self.rollbackTransaction()
+            raise
+        else :
+            self.commitTransaction()
+
+    def prepareRawRows(self, rows) :
+        """Converts a batch of rows to the user's charset."""
+        entries = []
+        for row in rows :
+            fields = list(row)
+            for j in range(len(fields)) :
+                field = fields[j]
+                if type(field) == StringType :
+                    fields[j] = self.databaseToUserCharset(field)
+            entries.append(tuple(fields))
+        return entries
 
@@ -0,0 +1,300 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module defines the pools of database connections shared by the storage backends."""
+
+import time
+import threading
+
+from pykota.storage import PyKotaStorageError
+
+MAXRETRYDELAY = 30.0
+
+class PooledConnection :
+    """A database connection managed by a pool."""
+    def __init__(self, connection) :
+        """Wraps a newly opened connection."""
+        self.connection = connection
+        self.created = self.lastused = time.time()
+        self.state = {} # connection specific data, e.g. server side prepared statements
+
+class ConnectionPool :
+    """A pool of connections to the same database.
+
+       At most maxsize connections are in use at the same time, 0
+       meaning unlimited, and up to minsize released connections are
+       kept open to be reused. A connection unused for more than
+       idletimeout seconds is checked before being reused.
+
+       Failed connection attempts are retried up to retries times,
+       waiting retrydelay seconds the first time, then twice as long
+       each time.
+    """
+    def __init__(self, name, opener, checker, closer, minsize=0, maxsize=5, idletimeout=60, retries=3, retrydelay=1.0, logger=None) :
+        """Initializes the pool, opening minsize connections."""
+        self.name = name
+        self.opener = opener
+        self.checker = checker
+        self.closer = closer
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        self.retries = retries
+        self.retrydelay = retrydelay
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.idle = []
+        self.active = 0
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+        self.failures = 0
+        self.healthchecks = 0
+        self.deadconnections = 0
+        self.reconnections = 0
+        self.reexecutions = 0
+        self.waits = 0
+        for i in range(minsize) :
+            self.idle.append(self.connect())
+
+    def warn(self, message) :
+        """Outputs a warning message."""
+        if self.logger is not None :
+            self.logger(message, "warn")
+
+    def connect(self) :
+        """Opens a new connection, retrying with an exponential backoff."""
+        delay = self.retrydelay
+        attempt = 0
+        while True :
+            try :
+                connection = self.opener()
+            except PyKotaStorageError, msg :
+                self.failures += 1
+                if attempt >= self.retries :
+                    raise
+                attempt += 1
+                self.warn("%s : %s, trying again in %.1f seconds..." % (self.name, msg, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, MAXRETRYDELAY)
+            else :
+                self.opened += 1
+                return PooledConnection(connection)
+
+    def disconnect(self, pooled) :
+        """Closes a connection, ignoring errors."""
+        self.closed += 1
+        try :
+            self.closer(pooled.connection)
+        except :
+            pass
+
+    def isAlive(self, pooled) :
+        """Returns True if a connection still works, else False."""
+        self.healthchecks += 1
+        try :
+            self.checker(pooled.connection)
+        except :
+            self.deadconnections += 1
+            return False
+        return True
+
+    def isStale(self, pooled) :
+        """Returns True if a connection wasn't used for too long to be trusted without a check."""
+        return self.idletimeout and ((time.time() - pooled.lastused) > self.idletimeout)
+
+    def acquire(self, timeout=30.0) :
+        """Returns a connection, waiting at most timeout seconds for one to be released if needed."""
+        deadline = time.time() + timeout
+        while True :
+            self.condition.acquire()
+            try :
+                while (not self.idle) and self.maxsize and (self.active >= self.maxsize) :
+                    remaining = deadline - time.time()
+                    if remaining <= 0 :
+                        raise PyKotaStorageError, _("No database connection available after %.1f seconds") % timeout
+                    self.waits += 1
+                    self.condition.wait(remaining)
+                self.active += 1
+                if self.idle :
+                    pooled = self.idle.pop()
+                else :
+                    pooled = None
+            finally :
+                self.condition.release()
+            if pooled is None :
+                try :
+                    pooled = self.connect()
+                except :
+                    self.forget()
+                    raise
+                return pooled
+            elif (not self.isStale(pooled)) or self.isAlive(pooled) :
+                self.reused += 1
+                pooled.lastused = time.time()
+                return pooled
+            self.disconnect(pooled)
+            self.forget()
+
+    def forget(self) :
+        """Records that a connection in use doesn't exist anymore."""
+        self.condition.acquire()
+        try :
+            self.active -= 1
+            self.condition.notify()
+        finally :
+            self.condition.release()
+
+    def release(self, pooled) :
+        """Gives a connection back to the pool."""
+        pooled.lastused = time.time()
+        self.condition.acquire()
+        try :
+            self.active -= 1
+            if len(self.idle) < self.minsize :
+                self.idle.append(pooled)
+                pooled = None
+            self.condition.notify()
+        finally :
+            self.condition.release()
+        if pooled is not None :
+            self.disconnect(pooled)
+
+    def discard(self, pooled) :
+        """Closes a broken connection instead of giving it back to the pool."""
+        self.disconnect(pooled)
+        self.forget()
+
+    def reconnect(self, pooled) :
+        """Replaces a broken connection with a working one."""
+        self.reconnections += 1
+        self.discard(pooled)
+        return self.acquire()
+
+    def clear(self) :
+        """Closes all the idle connections."""
+        self.condition.acquire()
+        try :
+            (idle, self.idle) = (self.idle, [])
+        finally :
+            self.condition.release()
+        for pooled in idle :
+            self.disconnect(pooled)
+
+    def statistics(self) :
+        """Returns a mapping of this pool's counters."""
+        return { "active" : self.active,
+                 "idle" : len(self.idle),
+                 "opened" : self.opened,
+                 "reused" : self.reused,
+                 "closed" : self.closed,
+                 "failures" : self.failures,
+                 "healthchecks" : self.healthchecks,
+                 "deadconnections" : self.deadconnections,
+                 "reconnections" : self.reconnections,
+                 "reexecutions" : self.reexecutions,
+                 "waits" : self.waits,
+               }
+
+pools = {}
+poolslock = threading.Lock()
+
+def getPool(name, opener, checker, closer, options, logger=None) :
+    """Returns the pool of connections named name, creating it if needed.
+
+       options is the mapping returned by the configuration's getStoragePool() method.
+    """
+    poolslock.acquire()
+    try :
+        pool = pools.get(name)
+        if pool is None :
+            pool = pools[name] = ConnectionPool(name, opener, checker, closer, logger=logger, **options)
+        return pool
+    finally :
+        poolslock.release()
+
+class PooledStorage :
+    """A mixin for storage backends which get their connections from a pool.
+
+       Backends must define the setConnection() method, called each
+       time a new connection is checked out for them.
+    """
+    def openPool(self, name, opener, checker, closer) :
+        """Checks a connection out of the named pool."""
+        self.intransaction = False
+        self.pool = getPool(name, opener, checker, closer, self.tool.config.getStoragePool(), self.tool.printInfo)
+        self.pooled = self.pool.acquire()
+        self.setConnection(self.pooled)
+
+    def releaseConnection(self) :
+        """Gives the connection back to the pool."""
+        self.pool.release(self.pooled)
+        self.pooled = None
+
+    def reconnect(self) :
+        """Replaces the current connection with a new one."""
+        self.tool.printInfo(_("Database connection lost, reconnecting..."), "warn")
+        self.pooled = self.pool.reconnect(self.pooled)
+        self.intransaction = False
+        self.setConnection(self.pooled)
+
+    def checkConnection(self) :
+        """Reconnects if the current connection was unused for too long and doesn't work anymore."""
+        if self.pool.isStale(self.pooled) and not self.pool.isAlive(self.pooled) :
+            self.reconnect()
+        self.pooled.lastused = time.time()
+
+    def runReadOnly(self, function, *args) :
+        """Runs a read-only query, running it again on a new connection if the current one was lost."""
+        self.checkConnection()
+        try :
+            return function(*args)
+        except PyKotaStorageError :
+            if self.intransaction or self.pool.isAlive(self.pooled) :
+                raise
+        self.reconnect()
+        self.pool.reexecutions += 1
+        return function(*args)
+
+    def runModification(self, function, *args) :
+        """Runs a modification query, reconnecting for the next ones if the current connection was lost.
+
+           The query itself is not run again, since we can't know if it
+           was applied or not.
+        """
+        self.checkConnection()
+        try :
+            return function(*args)
+        except PyKotaStorageError, msg :
+            if (not self.intransaction) and (not self.pool.isAlive(self.pooled)) :
+                self.reconnect()
+            raise PyKotaStorageError, str(msg)
+
+    def dumpPoolStatistics(self, output=None) :
+        """Outputs the connection pool's statistics."""
+        output = output or self.tool.logdebug
+        stats = self.pool.statistics()
+        output(("Connection pool %s : " % self.pool.name) + \
+               ("%(active)i active, %(idle)i idle, %(opened)i opened, %(reused)i reused, %(closed)i closed, %(failures)i failures, " \
+                "%(healthchecks)i health checks, %(deadconnections)i dead, %(reconnections)i reconnections, %(reexecutions)i queries run again, %(waits)i waits" % stats))
@@ -28,7 +28,148 @@ from pykota.storage import StorageUser, StorageGroup, StoragePrinter, \
                            StorageJob, StorageLastJob, StorageUserPQuota, \
                            StorageGroupPQuota, StorageBillingCode
 
+class RawResultStream :
+    """Iterates over the field names then the rows of a search result.
+
+       Rows are fetched from the database in batches, so memory
+       use doesn't depend on the number of rows.
+    """
+    def __init__(self, storage, cursor, rows) :
+        """Initializes the iterator with the first batch of rows."""
+        self.storage = storage
+        self.cursor = cursor
+        self.headers = storage.cursorFields(cursor)
+        self.rows = storage.prepareRawRows(rows)
+        self.index = 0
+
+    def __iter__(self) :
+        """Returns the iterator itself."""
+        return self
+
+    def next(self) :
+        """Returns the field names the first time, then the next row."""
+        if self.headers is not None :
+            (headers, self.headers) = (self.headers, None)
+            return headers
+        if self.index >= len(self.rows) :
+            if self.cursor is None :
+                raise StopIteration
+            rows = self.storage.fetchBatch(self.cursor)
+            if not rows :
+                self.close()
+                raise StopIteration
+            self.rows = self.storage.prepareRawRows(rows)
+            self.index = 0
+        row = self.rows[self.index]
+        self.index += 1
+        return row
+
+    def close(self) :
+        """Frees the database cursor if it's still open."""
+        if self.cursor is not None :
+            (cursor, self.cursor) = (self.cursor, None)
+            self.storage.closeCursor(cursor)
+
+    def __del__(self) :
+        """Ensures the database cursor is freed when the iteration is abandoned."""
+        try :
+            self.close()
+        except :
+            pass
+
 class SQLStorage :
+    def __init__(self) :
+        """Initializes the prepared statements' cache."""
+        self.preparedstatements = {}
+        self.preparedreuses = 0
+        self.fetchsize = 1000
+
+    def getPreparedStatement(self, query) :
+        """Returns the backend's prepared statement for a query, preparing it the first time.
+
+           In the query, %s marks each parameter.
+        """
+        try :
+            statement = self.preparedstatements[query]
+        except KeyError :
+            statement = self.preparedstatements[query] = self.prepareStatement(query)
+        else :
+            self.preparedreuses += 1
+        return statement
+
+    def streamRawResult(self, query) :
+        """Returns an iterator over the field names then the rows of a search, or None if nothing matches."""
+        cursor = self.openCursor(query)
+        try :
+            rows = self.fetchBatch(cursor)
+        except :
+            self.closeCursor(cursor)
+            raise
+        if not rows :
+            self.closeCursor(cursor)
+            return None
+        return RawResultStream(self, cursor, rows)
+
+    def dumpStatementStatistics(self, output=None) :
+        """Outputs the prepared statements' statistics, through the tool's logdebug() method by default."""
+        output = output or self.tool.logdebug
+        output("Prepared statements : %i prepared, %i reused" % (len(self.preparedstatements), self.preparedreuses))
+
+    def refreshGroupsBalances(self, condition, parameters=None) :
+        """Recomputes the balances of the groups matching an SQL condition from their members'."""
+        self.doModify("UPDATE groups SET balance=(SELECT COALESCE(SUM(balance), 0.0) FROM users WHERE id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id)), " \
+                                        "lifetimepaid=(SELECT COALESCE(SUM(lifetimepaid), 0.0) FROM users WHERE id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id)) " \
+                      "WHERE %s" % condition, parameters)
+
+    def refreshGroupsPQuotasCounters(self, condition, parameters=None) :
+        """Recomputes the page counters of the group print quota entries matching an SQL condition from their members'."""
+        self.doModify("UPDATE grouppquota SET pagecounter=(SELECT COALESCE(SUM(pagecounter), 0) FROM userpquota WHERE printerid=grouppquota.printerid AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=grouppquota.groupid)), " \
+                                             "lifepagecounter=(SELECT COALESCE(SUM(lifepagecounter), 0) FROM userpquota WHERE printerid=grouppquota.printerid AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=grouppquota.groupid)) " \
+                      "WHERE %s" % condition, parameters)
+
+    def rebuildGroupsCounters(self) :
+        """Recomputes all the groups' balances and page counters."""
+        self.beginTransaction()
+        try :
+            self.refreshGroupsBalances("1=1")
+            self.refreshGroupsPQuotasCounters("1=1")
+        except :
+            self.rollbackTransaction()
+            raise
+        else :
+            self.commitTransaction()
+        self.flushEntries("GROUPS")
+        self.flushEntries("GROUPPQUOTAS")
+
+    def verifyGroupsCounters(self) :
+        """Returns the list of (groupname, printername, counter, stored value, computed value) for groups' counters which are wrong.
+
+           printername is None for balances.
+        """
+        errors = []
+        result = self.doSearch("SELECT groupname, balance, lifetimepaid, " \
+                                      "(SELECT COALESCE(SUM(balance), 0.0) FROM users WHERE id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id)) AS realbalance, " \
+                                      "(SELECT COALESCE(SUM(lifetimepaid), 0.0) FROM users WHERE id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id)) AS reallifetimepaid " \
+                               "FROM groups ORDER BY groupname")
+        for record in result or [] :
+            groupname = self.databaseToUserCharset(record["groupname"])
+            for counter in ("balance", "lifetimepaid") :
+                (stored, computed) = (float(record[counter] or 0.0), float(record["real%s" % counter] or 0.0))
+                if abs(stored - computed) > 0.001 :
+                    errors.append((groupname, None, counter, stored, computed))
+        result = self.doSearch("SELECT groupname, printername, grouppquota.pagecounter AS pagecounter, grouppquota.lifepagecounter AS lifepagecounter, " \
+                                      "(SELECT COALESCE(SUM(pagecounter), 0) FROM userpquota WHERE printerid=grouppquota.printerid AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=grouppquota.groupid)) AS realpagecounter, " \
+                                      "(SELECT COALESCE(SUM(lifepagecounter), 0) FROM userpquota WHERE printerid=grouppquota.printerid AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=grouppquota.groupid)) AS reallifepagecounter " \
+                               "FROM grouppquota, groups, printers WHERE groups.id=grouppquota.groupid AND printers.id=grouppquota.printerid ORDER BY groupname, printername")
+        for record in result or [] :
+            groupname = self.databaseToUserCharset(record["groupname"])
+            printername = self.databaseToUserCharset(record["printername"])
+            for counter in ("pagecounter", "lifepagecounter") :
+                (stored, computed) = (int(record[counter] or 0), int(record["real%s" % counter] or 0))
+                if stored != computed :
+                    errors.append((groupname, printername, counter, stored, computed))
+        return errors
+
     def storageUserFromRecord(self, username, record) :
         """Returns a StorageUser instance from a database record."""
         user = StorageUser(self, username)
@@ -47,8 +188,8 @@ class SQLStorage :
         group = StorageGroup(self, groupname)
         group.ident = record.get("id")
         group.LimitBy = record.get("limitby") or "quota"
-        group.AccountBalance = record.get("balance")
-        group.LifeTimePaid = record.get("lifetimepaid")
+        group.AccountBalance = record.get("balance") or 0.0
+        group.LifeTimePaid = record.get("lifetimepaid") or 0.0
         group.Description = self.databaseToUserCharset(record.get("description"))
         group.Exists = True
         return group
@@ -127,11 +268,8 @@ class SQLStorage :
         grouppquota.SoftLimit = record.get("softlimit")
         grouppquota.HardLimit = record.get("hardlimit")
         grouppquota.DateLimit = record.get("datelimit")
-        result = self.doSearch("SELECT SUM(lifepagecounter) AS lifepagecounter, SUM(pagecounter) AS pagecounter FROM userpquota WHERE printerid=%s AND userid IN (SELECT userid FROM groupsmembers WHERE groupid=%s)" \
-                      % (self.doQuote(printer.ident), self.doQuote(group.ident)))
-        if result :
-            grouppquota.PageCounter = result[0].get("pagecounter") or 0
-            grouppquota.LifePageCounter = result[0].get("lifepagecounter") or 0
+        grouppquota.PageCounter = record.get("pagecounter") or 0
+        grouppquota.LifePageCounter = record.get("lifepagecounter") or 0
         grouppquota.Exists = True
         return grouppquota
         
@@ -174,8 +312,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+id"], ordering)
-        result = self.doRawSearch("SELECT * FROM printers %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT * FROM printers %(thefilter)s ORDER BY %(orderby)s" % locals())
         
     def extractUsers(self, extractonly={}, ordering=[]) :
         """Extracts all user records."""
@@ -183,8 +320,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+id"], ordering)
-        result = self.doRawSearch("SELECT * FROM users %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT * FROM users %(thefilter)s ORDER BY %(orderby)s" % locals())
         
     def extractBillingcodes(self, extractonly={}, ordering=[]) :
         """Extracts all billing codes records."""
@@ -192,8 +328,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+id"], ordering)
-        result = self.doRawSearch("SELECT * FROM billingcodes %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT * FROM billingcodes %(thefilter)s ORDER BY %(orderby)s" % locals())
         
     def extractGroups(self, extractonly={}, ordering=[]) :
         """Extracts all group records."""
@@ -201,11 +336,10 @@ class SQLStorage :
         if thefilter :
             thefilter = "WHERE %s" % thefilter
         orderby = self.createOrderBy(["+groups.id"], ordering)
-        result = self.doRawSearch("SELECT groups.*,COALESCE(SUM(balance), 0) AS balance, COALESCE(SUM(lifetimepaid), 0) as lifetimepaid FROM groups LEFT OUTER JOIN users ON users.id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id) %(thefilter)s GROUP BY groups.id,groups.groupname,groups.limitby,groups.description ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT * FROM groups %(thefilter)s ORDER BY %(orderby)s" % locals())
         
-    def extractPayments(self, extractonly={}, ordering=[]) :
-        """Extracts all payment records."""
+    def createDatedFilter(self, extractonly, datefield) :
+        """Creates a suitable WHERE clause continuation, with start and end dates checked against datefield."""
         startdate = extractonly.get("start")
         enddate = extractonly.get("end")
         for limit in ("start", "end") :
@@ -218,12 +352,56 @@ class SQLStorage :
             thefilter = "AND %s" % thefilter
         (startdate, enddate) = self.cleanDates(startdate, enddate)
         if startdate : 
-            thefilter = "%s AND date>=%s" % (thefilter, self.doQuote(startdate))
+            thefilter = "%s AND %s>=%s" % (thefilter, datefield, self.doQuote(startdate))
         if enddate : 
-            thefilter = "%s AND date<=%s" % (thefilter, self.doQuote(enddate))
+            thefilter = "%s AND %s<=%s" % (thefilter, datefield, self.doQuote(enddate))
+        return thefilter
+        
+    def createDateBucket(self, datefield, bucket) :
+        """Returns an SQL expression for the day or month of a date, as YYYY-MM-DD or YYYY-MM."""
+        return "SUBSTR(CAST(%s AS CHAR(19)), 1, %i)" % (datefield, self.datebuckets[bucket])
+        
+    def createSummary(self, datatype, keys, fields, datefield, tables) :
+        """Totalizes records in the database, grouped by some keys.
+        
+           Returns the field names then one row per group, sorted by
+           keys, or None if there's no record.
+        """
+        columns = []
+        groupby = []
+        for key in keys :
+            if self.datebuckets.has_key(key) :
+                expression = self.createDateBucket(datefield, key)
+            else :    
+                expression = fields[key]
+            columns.append("%s AS %s" % (expression, key))
+            groupby.append(expression)
+        columns.append("COUNT(*) AS count")
+        for (field, converter) in self.summarytotals[datatype] :
+            columns.append("COALESCE(SUM(%s), 0) AS %s" % (field, field))
+        query = "SELECT %s %s" % (", ".join(columns), tables)
+        if groupby :
+            return self.streamRawResult("%s GROUP BY %s ORDER BY %s" % (query, ", ".join(groupby), ", ".join(keys)))
+        # without GROUP BY there's always a row, even without any record
+        result = self.streamRawResult(query)
+        if result is not None :
+            result = list(result)
+            if result[1][0] :
+                return result
+        
+    def extractPayments(self, extractonly={}, ordering=[]) :
+        """Extracts all payment records."""
+        thefilter = self.createDatedFilter(extractonly, "date")
         orderby = self.createOrderBy(["+payments.id"], ordering)
-        result = self.doRawSearch("SELECT username,payments.* FROM users,payments WHERE users.id=payments.userid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT username,payments.* FROM users,payments WHERE users.id=payments.userid %(thefilter)s ORDER BY %(orderby)s" % locals())
+        
+    def summarizePayments(self, extractonly={}, keys=[]) :
+        """Totalizes the payments, grouped by some keys."""
+        thefilter = self.createDatedFilter(extractonly, "payments.date")
+        return self.createSummary("payments", keys, \
+                                  { "username" : "users.username" }, \
+                                  "payments.date", \
+                                  "FROM users,payments WHERE users.id=payments.userid %s" % thefilter)
         
     def extractUpquotas(self, extractonly={}, ordering=[]) :
         """Extracts all userpquota records."""
@@ -231,8 +409,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+userpquota.id"], ordering)
-        result = self.doRawSearch("SELECT users.username,printers.printername,userpquota.* FROM users,printers,userpquota WHERE users.id=userpquota.userid AND printers.id=userpquota.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT users.username,printers.printername,userpquota.* FROM users,printers,userpquota WHERE users.id=userpquota.userid AND printers.id=userpquota.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
         
     def extractGpquotas(self, extractonly={}, ordering=[]) :
         """Extracts all grouppquota records."""
@@ -240,8 +417,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+grouppquota.id"], ordering)
-        result = self.doRawSearch("SELECT groups.groupname,printers.printername,grouppquota.*,coalesce(sum(pagecounter), 0) AS pagecounter,coalesce(sum(lifepagecounter), 0) AS lifepagecounter FROM groups,printers,grouppquota,userpquota WHERE groups.id=grouppquota.groupid AND printers.id=grouppquota.printerid AND userpquota.printerid=grouppquota.printerid AND userpquota.userid IN (SELECT userid FROM groupsmembers WHERE groupsmembers.groupid=grouppquota.groupid) %(thefilter)s GROUP BY grouppquota.id,grouppquota.groupid,grouppquota.printerid,grouppquota.softlimit,grouppquota.hardlimit,grouppquota.datelimit,grouppquota.maxjobsize,groups.groupname,printers.printername ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT groups.groupname,printers.printername,grouppquota.* FROM groups,printers,grouppquota WHERE groups.id=grouppquota.groupid AND printers.id=grouppquota.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
         
     def extractUmembers(self, extractonly={}, ordering=[]) :
         """Extracts all user groups members."""
@@ -249,8 +425,7 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+groupsmembers.groupid", "+groupsmembers.userid"], ordering)
-        result = self.doRawSearch("SELECT groups.groupname, users.username, groupsmembers.* FROM groups,users,groupsmembers WHERE users.id=groupsmembers.userid AND groups.id=groupsmembers.groupid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT groups.groupname, users.username, groupsmembers.* FROM groups,users,groupsmembers WHERE users.id=groupsmembers.userid AND groups.id=groupsmembers.groupid %(thefilter)s ORDER BY %(orderby)s" % locals())
         
     def extractPmembers(self, extractonly={}, ordering=[]) :
         """Extracts all printer groups members."""
@@ -265,29 +440,25 @@ class SQLStorage :
         if thefilter :
             thefilter = "AND %s" % thefilter
         orderby = self.createOrderBy(["+printergroupsmembers.groupid", "+printergroupsmembers.printerid"], ordering)
-        result = self.doRawSearch("SELECT p1.printername as pgroupname, p2.printername as printername, printergroupsmembers.* FROM printers p1, printers p2, printergroupsmembers WHERE p1.id=printergroupsmembers.groupid AND p2.id=printergroupsmembers.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT p1.printername as pgroupname, p2.printername as printername, printergroupsmembers.* FROM printers p1, printers p2, printergroupsmembers WHERE p1.id=printergroupsmembers.groupid AND p2.id=printergroupsmembers.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
         
     def extractHistory(self, extractonly={}, ordering=[]) :
         """Extracts all jobhistory records."""
-        startdate = extractonly.get("start")
-        enddate = extractonly.get("end")
-        for limit in ("start", "end") :
-            try :
-                del extractonly[limit]
-            except KeyError :    
-                pass
-        thefilter = self.createFilter(extractonly)
-        if thefilter :
-            thefilter = "AND %s" % thefilter
-        (startdate, enddate) = self.cleanDates(startdate, enddate)
-        if startdate : 
-            thefilter = "%s AND jobdate>=%s" % (thefilter, self.doQuote(startdate))
-        if enddate : 
-            thefilter = "%s AND jobdate<=%s" % (thefilter, self.doQuote(enddate))
+        thefilter = self.createDatedFilter(extractonly, "jobdate")
         orderby = self.createOrderBy(["+jobhistory.id"], ordering)
-        result = self.doRawSearch("SELECT users.username,printers.printername,jobhistory.* FROM users,printers,jobhistory WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
-        return self.prepareRawResult(result)
+        return self.streamRawResult("SELECT users.username,printers.printername,jobhistory.* FROM users,printers,jobhistory WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid %(thefilter)s ORDER BY %(orderby)s" % locals())
+            
+    def summarizeHistory(self, extractonly={}, keys=[]) :
+        """Totalizes the jobs history, grouped by some keys."""
+        thefilter = self.createDatedFilter(extractonly, "jobhistory.jobdate")
+        return self.createSummary("history", keys, \
+                                  { "username" : "users.username", \
+                                    "printername" : "printers.printername", \
+                                    "hostname" : "jobhistory.hostname", \
+                                    "billingcode" : "jobhistory.billingcode", \
+                                  }, \
+                                  "jobhistory.jobdate", \
+                                  "FROM users,printers,jobhistory WHERE users.id=jobhistory.userid AND printers.id=jobhistory.printerid %s" % thefilter)
             
     def filterNames(self, records, attribute, patterns=None) :
         """Returns a list of 'attribute' from a list of records.
@@ -344,15 +515,15 @@ class SQLStorage :
         
     def getUserNbJobsFromHistory(self, user) :
         """Returns the number of jobs the user has in history."""
-        result = self.doSearch("SELECT COUNT(*) AS count FROM jobhistory WHERE userid=%s" % self.doQuote(user.ident))
+        result = self.doSearch("SELECT COUNT(*) AS count FROM jobhistory WHERE userid=%s", (user.ident,))
         if result :
             return result[0]["count"]
         return 0
         
     def getUserFromBackend(self, username) :    
         """Extracts user information given its name."""
-        result = self.doSearch("SELECT * FROM users WHERE username=%s LIMIT 1"\
-                      % self.doQuote(self.userCharsetToDatabase(username)))
+        result = self.doSearch("SELECT * FROM users WHERE username=%s LIMIT 1", \
+                               (self.userCharsetToDatabase(username),))
         if result :
             return self.storageUserFromRecord(username, result[0])
         else :    
@@ -360,8 +531,8 @@ class SQLStorage :
        
     def getGroupFromBackend(self, groupname) :    
         """Extracts group information given its name."""
-        result = self.doSearch("SELECT groups.*,COALESCE(SUM(balance), 0.0) AS balance, COALESCE(SUM(lifetimepaid), 0.0) AS lifetimepaid FROM groups LEFT OUTER JOIN users ON users.id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id) WHERE groupname=%s GROUP BY groups.id,groups.groupname,groups.limitby,groups.description LIMIT 1" \
-                      % self.doQuote(self.userCharsetToDatabase(groupname)))
+        result = self.doSearch("SELECT * FROM groups WHERE groupname=%s LIMIT 1", \
+                               (self.userCharsetToDatabase(groupname),))
         if result :
             return self.storageGroupFromRecord(groupname, result[0])
         else :    
@@ -369,8 +540,8 @@ class SQLStorage :
        
     def getPrinterFromBackend(self, printername) :        
         """Extracts printer information given its name."""
-        result = self.doSearch("SELECT * FROM printers WHERE printername=%s LIMIT 1" \
-                      % self.doQuote(self.userCharsetToDatabase(printername)))
+        result = self.doSearch("SELECT * FROM printers WHERE printername=%s LIMIT 1", \
+                               (self.userCharsetToDatabase(printername),))
         if result :
             return self.storagePrinterFromRecord(printername, result[0])
         else :    
@@ -378,8 +549,8 @@ class SQLStorage :
         
     def getBillingCodeFromBackend(self, label) :        
         """Extracts a billing code information given its name."""
-        result = self.doSearch("SELECT * FROM billingcodes WHERE billingcode=%s LIMIT 1" \
-                      % self.doQuote(self.userCharsetToDatabase(label)))
+        result = self.doSearch("SELECT * FROM billingcodes WHERE billingcode=%s LIMIT 1", \
+                               (self.userCharsetToDatabase(label),))
         if result :
             return self.storageBillingCodeFromRecord(label, result[0])
         else :    
@@ -388,8 +559,8 @@ class SQLStorage :
     def getUserPQuotaFromBackend(self, user, printer) :        
         """Extracts a user print quota."""
         if printer.Exists and user.Exists :
-            result = self.doSearch("SELECT * FROM userpquota WHERE userid=%s AND printerid=%s;" \
-                          % (self.doQuote(user.ident), self.doQuote(printer.ident)))
+            result = self.doSearch("SELECT * FROM userpquota WHERE userid=%s AND printerid=%s", \
+                                   (user.ident, printer.ident))
             if result :
                 return self.storageUserPQuotaFromRecord(user, printer, result[0])
         return StorageUserPQuota(self, user, printer)
@@ -397,24 +568,70 @@ class SQLStorage :
     def getGroupPQuotaFromBackend(self, group, printer) :        
         """Extracts a group print quota."""
         if printer.Exists and group.Exists :
-            result = self.doSearch("SELECT * FROM grouppquota WHERE groupid=%s AND printerid=%s" \
-                          % (self.doQuote(group.ident), self.doQuote(printer.ident)))
+            result = self.doSearch("SELECT * FROM grouppquota WHERE groupid=%s AND printerid=%s", \
+                                   (group.ident, printer.ident))
             if result :
                 return self.storageGroupPQuotaFromRecord(group, printer, result[0])
         return StorageGroupPQuota(self, group, printer)
         
     def getPrinterLastJobFromBackend(self, printer) :        
         """Extracts a printer's last job information."""
-        result = self.doSearch("SELECT jobhistory.id, jobid, userid, username, pagecounter, jobsize, jobprice, filename, title, copies, options, hostname, jobdate, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice FROM jobhistory, users WHERE printerid=%s AND userid=users.id ORDER BY jobdate DESC LIMIT 1" % self.doQuote(printer.ident))
+        result = self.doSearch("SELECT jobhistory.id, jobid, userid, username, pagecounter, jobsize, jobprice, filename, title, copies, options, hostname, jobdate, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice FROM jobhistory, users WHERE printerid=%s AND userid=users.id ORDER BY jobdate DESC LIMIT 1", (printer.ident,))
         if result :
             return self.storageLastJobFromRecord(printer, result[0])
         else :    
             return StorageLastJob(self, printer)
             
+    def splitRecord(self, record) :
+        """Splits a record whose fields are named table_field into one record per table."""
+        records = {}
+        for (name, value) in record.items() :
+            (table, field) = name.split("_", 1)
+            records.setdefault(table, {})[field] = value
+        return records
+
+    def getAccountingContextFromBackend(self, printername, username) :
+        """Extracts a printer, an user, the user's print quota and the printer's last job in a single query."""
+        result = self.doSearch("SELECT printers.id AS p_id, printers.description AS p_description, printers.priceperpage AS p_priceperpage, printers.priceperjob AS p_priceperjob, printers.passthrough AS p_passthrough, printers.maxjobsize AS p_maxjobsize, " \
+                                      "users.id AS u_id, users.email AS u_email, users.balance AS u_balance, users.lifetimepaid AS u_lifetimepaid, users.limitby AS u_limitby, users.description AS u_description, users.overcharge AS u_overcharge, " \
+                                      "userpquota.id AS q_id, userpquota.pagecounter AS q_pagecounter, userpquota.lifepagecounter AS q_lifepagecounter, userpquota.softlimit AS q_softlimit, userpquota.hardlimit AS q_hardlimit, userpquota.datelimit AS q_datelimit, userpquota.warncount AS q_warncount, " \
+                                      "jobhistory.id AS j_id, jobhistory.jobid AS j_jobid, jobusers.username AS j_username, jobhistory.pagecounter AS j_pagecounter, jobhistory.jobsize AS j_jobsize, jobhistory.jobprice AS j_jobprice, jobhistory.action AS j_action, jobhistory.filename AS j_filename, jobhistory.title AS j_title, jobhistory.copies AS j_copies, jobhistory.options AS j_options, jobhistory.hostname AS j_hostname, jobhistory.jobdate AS j_jobdate, jobhistory.jobsizebytes AS j_jobsizebytes, jobhistory.md5sum AS j_md5sum, jobhistory.pages AS j_pages, jobhistory.billingcode AS j_billingcode, jobhistory.precomputedjobsize AS j_precomputedjobsize, jobhistory.precomputedjobprice AS j_precomputedjobprice " \
+                               "FROM (SELECT 1 AS one) AS wanted " \
+                               "LEFT OUTER JOIN printers ON printers.printername=%s " \
+                               "LEFT OUTER JOIN users ON users.username=%s " \
+                               "LEFT OUTER JOIN userpquota ON userpquota.userid=users.id AND userpquota.printerid=printers.id " \
+                               "LEFT OUTER JOIN jobhistory ON jobhistory.id=(SELECT id FROM jobhistory WHERE printerid=printers.id ORDER BY jobdate DESC LIMIT 1) " \
+                               "LEFT OUTER JOIN users AS jobusers ON jobusers.id=jobhistory.userid", \
+                               (self.userCharsetToDatabase(printername), self.userCharsetToDatabase(username)))
+        records = {}
+        if result :
+            records = self.splitRecord(result[0])
+        record = records.get("p", {})
+        if record.get("id") is not None :
+            printer = self.storagePrinterFromRecord(printername, record)
+        else :
+            printer = StoragePrinter(self, printername)
+        record = records.get("u", {})
+        if record.get("id") is not None :
+            user = self.storageUserFromRecord(username, record)
+        else :
+            user = StorageUser(self, username)
+        record = records.get("q", {})
+        if record.get("id") is not None :
+            userpquota = self.storageUserPQuotaFromRecord(user, printer, record)
+        else :
+            userpquota = StorageUserPQuota(self, user, printer)
+        record = records.get("j", {})
+        if (record.get("id") is not None) and (record.get("username") is not None) :
+            lastjob = self.storageLastJobFromRecord(printer, record)
+        else :
+            lastjob = StorageLastJob(self, printer)
+        return (printer, user, userpquota, lastjob)
+
     def getGroupMembersFromBackend(self, group) :        
         """Returns the group's members list."""
         groupmembers = []
-        result = self.doSearch("SELECT * FROM groupsmembers JOIN users ON groupsmembers.userid=users.id WHERE groupid=%s" % self.doQuote(group.ident))
+        result = self.doSearch("SELECT * FROM groupsmembers JOIN users ON groupsmembers.userid=users.id WHERE groupid=%s", (group.ident,))
         if result :
             for record in result :
                 user = self.storageUserFromRecord(self.databaseToUserCharset(record.get("username")), \
@@ -426,7 +643,7 @@ class SQLStorage :
     def getUserGroupsFromBackend(self, user) :        
         """Returns the user's groups list."""
         groups = []
-        result = self.doSearch("SELECT groupname FROM groupsmembers JOIN groups ON groupsmembers.groupid=groups.id WHERE userid=%s" % self.doQuote(user.ident))
+        result = self.doSearch("SELECT groupname FROM groupsmembers JOIN groups ON groupsmembers.groupid=groups.id WHERE userid=%s", (user.ident,))
         if result :
             for record in result :
                 groups.append(self.getGroup(self.databaseToUserCharset(record.get("groupname"))))
@@ -435,7 +652,7 @@ class SQLStorage :
     def getParentPrintersFromBackend(self, printer) :    
         """Get all the printer groups this printer is a member of."""
         pgroups = []
-        result = self.doSearch("SELECT groupid,printername FROM printergroupsmembers JOIN printers ON groupid=printers.id WHERE printerid=%s" % self.doQuote(printer.ident))
+        result = self.doSearch("SELECT groupid,printername FROM printergroupsmembers JOIN printers ON groupid=printers.id WHERE printerid=%s", (printer.ident,))
         if result :
             for record in result :
                 if record["groupid"] != printer.ident : # in case of integrity violation
@@ -498,7 +715,7 @@ class SQLStorage :
         # We 'could' do a SELECT groupname FROM groups WHERE groupname LIKE ...
         # but we don't because other storages semantics may be different, so every
         # storage should use fnmatch to match patterns and be storage agnostic
-        result = self.doSearch("SELECT groups.*,COALESCE(SUM(balance), 0.0) AS balance, COALESCE(SUM(lifetimepaid), 0.0) AS lifetimepaid FROM groups LEFT OUTER JOIN users ON users.id IN (SELECT userid FROM groupsmembers WHERE groupid=groups.id) GROUP BY groups.id,groups.groupname,groups.limitby,groups.description")
+        result = self.doSearch("SELECT * FROM groups")
         if result :
             patterns = grouppattern.split(",")
             try :
@@ -634,11 +851,15 @@ class SQLStorage :
             mexists = 0
         if not mexists :    
             self.doModify("INSERT INTO groupsmembers (groupid, userid) VALUES (%s, %s)" % (self.doQuote(group.ident), self.doQuote(user.ident)))
+            self.refreshGroupsBalances("id=%s", (group.ident,))
+            self.refreshGroupsPQuotasCounters("groupid=%s", (group.ident,))
             
     def delUserFromGroup(self, user, group) :    
         """Removes an user from a group."""
         self.doModify("DELETE FROM groupsmembers WHERE groupid=%s AND userid=%s" % \
                        (self.doQuote(group.ident), self.doQuote(user.ident)))
+        self.refreshGroupsBalances("id=%s", (group.ident,))
+        self.refreshGroupsPQuotasCounters("groupid=%s", (group.ident,))
             
     def addUserPQuota(self, upq) :
         """Initializes a user print quota on a printer."""
@@ -655,6 +876,9 @@ class SQLStorage :
                              self.doQuote(upq.PageCounter or 0), \
                              self.doQuote(upq.LifePageCounter or 0), \
                              self.doQuote(upq.MaxJobSize)))
+        if upq.PageCounter or upq.LifePageCounter :
+            self.refreshGroupsPQuotasCounters("printerid=%s AND groupid IN (SELECT groupid FROM groupsmembers WHERE userid=%s)", \
+                                              (upq.Printer.ident, upq.User.ident))
         upq.isDirty = False
         return None # the entry created doesn't need further modification
         
@@ -670,6 +894,7 @@ class SQLStorage :
                              self.doQuote(gpq.HardLimit), \
                              self.doQuote(gpq.DateLimit), \
                              self.doQuote(gpq.MaxJobSize)))
+        self.refreshGroupsPQuotasCounters("groupid=%s AND printerid=%s", (gpq.Group.ident, gpq.Printer.ident))
         gpq.isDirty = False
         return None # the entry created doesn't need further modification
         
@@ -693,6 +918,7 @@ class SQLStorage :
                                   self.doQuote(user.OverCharge), \
                                   self.doQuote(self.userCharsetToDatabase(user.Description)), \
                                   self.doQuote(user.ident)))
+        self.refreshGroupsBalances("id IN (SELECT groupid FROM groupsmembers WHERE userid=%s)", (user.ident,))
                                   
     def saveGroup(self, group) :        
         """Saves the group to the database in a single operation."""
@@ -703,15 +929,17 @@ class SQLStorage :
         
     def writeUserPQuotaDateLimit(self, userpquota, datelimit) :    
         """Sets the date limit permanently for a user print quota."""
-        self.doModify("UPDATE userpquota SET datelimit=%s WHERE id=%s" % (self.doQuote(datelimit), self.doQuote(userpquota.ident)))
+        self.doModify("UPDATE userpquota SET datelimit=%s WHERE id=%s", (datelimit, userpquota.ident))
             
     def writeGroupPQuotaDateLimit(self, grouppquota, datelimit) :    
         """Sets the date limit permanently for a group print quota."""
-        self.doModify("UPDATE grouppquota SET datelimit=%s WHERE id=%s" % (self.doQuote(datelimit), self.doQuote(grouppquota.ident)))
+        self.doModify("UPDATE grouppquota SET datelimit=%s WHERE id=%s", (datelimit, grouppquota.ident))
         
     def increaseUserPQuotaPagesCounters(self, userpquota, nbpages) :    
         """Increase page counters for a user print quota."""
-        self.doModify("UPDATE userpquota SET pagecounter=pagecounter + %s,lifepagecounter=lifepagecounter + %s WHERE id=%s" % (self.doQuote(nbpages), self.doQuote(nbpages), self.doQuote(userpquota.ident)))
+        self.doModify("UPDATE userpquota SET pagecounter=pagecounter + %s,lifepagecounter=lifepagecounter + %s WHERE id=%s", (nbpages, nbpages, userpquota.ident))
+        self.doModify("UPDATE grouppquota SET pagecounter=pagecounter + %s,lifepagecounter=lifepagecounter + %s WHERE printerid=%s AND groupid IN (SELECT groupid FROM groupsmembers WHERE userid=%s)", \
+                      (nbpages, nbpages, userpquota.Printer.ident, userpquota.User.ident))
        
     def saveBillingCode(self, bcode) :    
         """Saves the billing code to the database."""
@@ -723,26 +951,27 @@ class SQLStorage :
        
     def consumeBillingCode(self, bcode, pagecounter, balance) :
         """Consumes from a billing code."""
-        self.doModify("UPDATE billingcodes SET balance=balance + %s, pagecounter=pagecounter + %s WHERE id=%s" % (self.doQuote(balance), self.doQuote(pagecounter), self.doQuote(bcode.ident)))
+        self.doModify("UPDATE billingcodes SET balance=balance + %s, pagecounter=pagecounter + %s WHERE id=%s", (balance, pagecounter, bcode.ident))
        
     def refundJob(self, jobident) :   
         """Marks a job as refunded in the history."""
-        self.doModify("UPDATE jobhistory SET action='REFUND' WHERE id=%s;" % self.doQuote(jobident))
+        self.doModify("UPDATE jobhistory SET action='REFUND' WHERE id=%s", (jobident,))
         
     def decreaseUserAccountBalance(self, user, amount) :    
         """Decreases user's account balance from an amount."""
-        self.doModify("UPDATE users SET balance=balance - %s WHERE id=%s" % (self.doQuote(amount), self.doQuote(user.ident)))
+        self.doModify("UPDATE users SET balance=balance - %s WHERE id=%s", (amount, user.ident))
+        self.doModify("UPDATE groups SET balance=balance - %s WHERE id IN (SELECT groupid FROM groupsmembers WHERE userid=%s)", (amount, user.ident))
        
     def writeNewPayment(self, user, amount, comment="") :
         """Adds a new payment to the payments history."""
         if user.ident is not None :
-            self.doModify("INSERT INTO payments (userid, amount, description) VALUES (%s, %s, %s)" % (self.doQuote(user.ident), self.doQuote(amount), self.doQuote(self.userCharsetToDatabase(comment))))
+            self.doModify("INSERT INTO payments (userid, amount, description) VALUES (%s, %s, %s)", (user.ident, amount, self.userCharsetToDatabase(comment)))
         else :    
-            self.doModify("INSERT INTO payments (userid, amount, description) VALUES ((SELECT id FROM users WHERE username=%s), %s, %s)" % (self.doQuote(self.userCharsetToDatabase(user.Name)), self.doQuote(amount), self.doQuote(self.userCharsetToDatabase(comment))))
+            self.doModify("INSERT INTO payments (userid, amount, description) VALUES ((SELECT id FROM users WHERE username=%s), %s, %s)", (self.userCharsetToDatabase(user.Name), amount, self.userCharsetToDatabase(comment)))
         
     def writeLastJobSize(self, lastjob, jobsize, jobprice) :        
         """Sets the last job's size permanently."""
-        self.doModify("UPDATE jobhistory SET jobsize=%s, jobprice=%s WHERE id=%s" % (self.doQuote(jobsize), self.doQuote(jobprice), self.doQuote(lastjob.ident)))
+        self.doModify("UPDATE jobhistory SET jobsize=%s, jobprice=%s WHERE id=%s", (jobsize, jobprice, lastjob.ident))
         
     def writeJobNew(self, printer, user, jobid, pagecounter, action, jobsize=None, jobprice=None, filename=None, title=None, copies=None, options=None, clienthost=None, jobsizebytes=None, jobmd5sum=None, jobpages=None, jobbilling=None, precomputedsize=None, precomputedprice=None) :
         """Adds a job in a printer's history."""
@@ -755,12 +984,12 @@ class SQLStorage :
         jobbilling = self.userCharsetToDatabase(jobbilling)
         if (not self.disablehistory) or (not printer.LastJob.Exists) :
             if jobsize is not None :
-                self.doModify("INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" % (self.doQuote(user.ident), self.doQuote(printer.ident), self.doQuote(jobid), self.doQuote(pagecounter), self.doQuote(action), self.doQuote(jobsize), self.doQuote(jobprice), self.doQuote(filename), self.doQuote(title), self.doQuote(copies), self.doQuote(options), self.doQuote(clienthost), self.doQuote(jobsizebytes), self.doQuote(jobmd5sum), self.doQuote(jobpages), self.doQuote(jobbilling), self.doQuote(precomputedsize), self.doQuote(precomputedprice)))
+                self.doModify("INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (user.ident, printer.ident, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, clienthost, jobsizebytes, jobmd5sum, jobpages, jobbilling, precomputedsize, precomputedprice))
             else :    
-                self.doModify("INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" % (self.doQuote(user.ident), self.doQuote(printer.ident), self.doQuote(jobid), self.doQuote(pagecounter), self.doQuote(action), self.doQuote(filename), self.doQuote(title), self.doQuote(copies), self.doQuote(options), self.doQuote(clienthost), self.doQuote(jobsizebytes), self.doQuote(jobmd5sum), self.doQuote(jobpages), self.doQuote(jobbilling), self.doQuote(precomputedsize), self.doQuote(precomputedprice)))
+                self.doModify("INSERT INTO jobhistory (userid, printerid, jobid, pagecounter, action, filename, title, copies, options, hostname, jobsizebytes, md5sum, pages, billingcode, precomputedjobsize, precomputedjobprice) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (user.ident, printer.ident, jobid, pagecounter, action, filename, title, copies, options, clienthost, jobsizebytes, jobmd5sum, jobpages, jobbilling, precomputedsize, precomputedprice))
         else :        
             # here we explicitly want to reset jobsize to NULL if needed
-            self.doModify("UPDATE jobhistory SET userid=%s, jobid=%s, pagecounter=%s, action=%s, jobsize=%s, jobprice=%s, filename=%s, title=%s, copies=%s, options=%s, hostname=%s, jobsizebytes=%s, md5sum=%s, pages=%s, billingcode=%s, precomputedjobsize=%s, precomputedjobprice=%s, jobdate=now() WHERE id=%s" % (self.doQuote(user.ident), self.doQuote(jobid), self.doQuote(pagecounter), self.doQuote(action), self.doQuote(jobsize), self.doQuote(jobprice), self.doQuote(filename), self.doQuote(title), self.doQuote(copies), self.doQuote(options), self.doQuote(clienthost), self.doQuote(jobsizebytes), self.doQuote(jobmd5sum), self.doQuote(jobpages), self.doQuote(jobbilling), self.doQuote(precomputedsize), self.doQuote(precomputedprice), self.doQuote(printer.LastJob.ident)))
+            self.doModify("UPDATE jobhistory SET userid=%s, jobid=%s, pagecounter=%s, action=%s, jobsize=%s, jobprice=%s, filename=%s, title=%s, copies=%s, options=%s, hostname=%s, jobsizebytes=%s, md5sum=%s, pages=%s, billingcode=%s, precomputedjobsize=%s, precomputedjobprice=%s, jobdate=now() WHERE id=%s", (user.ident, jobid, pagecounter, action, jobsize, jobprice, filename, title, copies, options, clienthost, jobsizebytes, jobmd5sum, jobpages, jobbilling, precomputedsize, precomputedprice, printer.LastJob.ident))
             
     def saveUserPQuota(self, userpquota) :
         """Saves an user print quota entry."""
@@ -773,14 +1002,16 @@ class SQLStorage :
                                  self.doQuote(userpquota.LifePageCounter or 0), \
                                  self.doQuote(userpquota.MaxJobSize), \
                                  self.doQuote(userpquota.ident)))
+        self.refreshGroupsPQuotasCounters("printerid=%s AND groupid IN (SELECT groupid FROM groupsmembers WHERE userid=%s)", \
+                                          (userpquota.Printer.ident, userpquota.User.ident))
         
     def writeUserPQuotaWarnCount(self, userpquota, warncount) :
         """Sets the warn counter value for a user quota."""
-        self.doModify("UPDATE userpquota SET warncount=%s WHERE id=%s" % (self.doQuote(warncount), self.doQuote(userpquota.ident)))
+        self.doModify("UPDATE userpquota SET warncount=%s WHERE id=%s", (warncount, userpquota.ident))
         
     def increaseUserPQuotaWarnCount(self, userpquota) :
         """Increases the warn counter value for a user quota."""
-        self.doModify("UPDATE userpquota SET warncount=warncount+1 WHERE id=%s" % self.doQuote(userpquota.ident))
+        self.doModify("UPDATE userpquota SET warncount=warncount+1 WHERE id=%s", (userpquota.ident,))
         
     def saveGroupPQuota(self, grouppquota) :
         """Saves a group print quota entry."""
@@ -840,6 +1071,7 @@ class SQLStorage :
         # TODO : What should we do if we delete the last person who used a given printer ?
         # TODO : we can't reassign the last job to the previous one, because next user would be
         # TODO : incorrectly charged (overcharged).
+        groupids = [record["groupid"] for record in self.doSearch("SELECT groupid FROM groupsmembers WHERE userid=%s", (user.ident,)) or []]
         for q in [ 
                     "DELETE FROM payments WHERE userid=%s" % self.doQuote(user.ident),
                     "DELETE FROM groupsmembers WHERE userid=%s" % self.doQuote(user.ident),
@@ -848,6 +1080,10 @@ class SQLStorage :
                     "DELETE FROM users WHERE id=%s" % self.doQuote(user.ident),
                   ] :
             self.doModify(q)
+        if groupids :
+            groupids = ", ".join(["%s" % self.doQuote(groupid) for groupid in groupids])
+            self.refreshGroupsBalances("id IN (%s)" % groupids)
+            self.refreshGroupsPQuotasCounters("groupid IN (%s)" % groupids)
             
     def multipleQueriesInTransaction(self, queries) :        
         """Does many modifications in a single transaction."""
@@ -867,6 +1103,8 @@ class SQLStorage :
         if codeids :
             self.multipleQueriesInTransaction([ 
                     "DELETE FROM billingcodes WHERE id IN (%s)" % codeids,])
+            for b in billingcodes :
+                self.flushEntry("BILLINGCODES", b.BillingCode)
             
     def deleteManyUsers(self, users) :        
         """Deletes many users."""
@@ -878,6 +1116,15 @@ class SQLStorage :
                     "DELETE FROM jobhistory WHERE userid IN (%s)" % userids,
                     "DELETE FROM userpquota WHERE userid IN (%s)" % userids,
                     "DELETE FROM users WHERE id IN (%s)" % userids,])
+            self.rebuildGroupsCounters()
+            usernames = [u.Name for u in users]
+            for username in usernames :
+                self.flushEntry("USERS", username)
+            self.flushEntries("USERPQUOTAS", lambda key : key.split("@", 1)[0] in usernames)
+            self.flushEntries("LASTJOBS")
+            self.flushEntries("GROUPMEMBERS")
+            for username in usernames :
+                self.flushEntry("USERGROUPS", username)
                     
     def deleteManyGroups(self, groups) :        
         """Deletes many groups."""
@@ -887,6 +1134,13 @@ class SQLStorage :
                     "DELETE FROM groupsmembers WHERE groupid IN (%s)" % groupids,
                     "DELETE FROM grouppquota WHERE groupid IN (%s)" % groupids,
                     "DELETE FROM groups WHERE id IN (%s)" % groupids,])
+            groupnames = [g.Name for g in groups]
+            for groupname in groupnames :
+                self.flushEntry("GROUPS", groupname)
+            self.flushEntries("GROUPPQUOTAS", lambda key : key.split("@", 1)[0] in groupnames)
+            for groupname in groupnames :
+                self.flushEntry("GROUPMEMBERS", groupname)
+            self.flushEntries("USERGROUPS")
         
     def deleteManyPrinters(self, printers) :
         """Deletes many printers."""
@@ -898,6 +1152,13 @@ class SQLStorage :
                     "DELETE FROM grouppquota WHERE printerid IN (%s)" % printerids,
                     "DELETE FROM userpquota WHERE printerid IN (%s)" % printerids,
                     "DELETE FROM printers WHERE id IN (%s)" % printerids,])
+            printernames = [p.Name for p in printers]
+            for printername in printernames :
+                self.flushEntry("PRINTERS", printername)
+                self.flushEntry("LASTJOBS", printername)
+            self.flushEntries("USERPQUOTAS", lambda key : key.split("@", 1)[-1] in printernames)
+            self.flushEntries("GROUPPQUOTAS", lambda key : key.split("@", 1)[-1] in printernames)
+            self.flushEntries("PARENTPRINTERS")
         
     def deleteManyUserPQuotas(self, printers, users) :        
         """Deletes many user print quota entries."""
@@ -909,6 +1170,12 @@ class SQLStorage :
                                  % (userids, printerids),
                     "DELETE FROM userpquota WHERE userid IN (%s) AND printerid IN (%s)" \
                                  % (userids, printerids),])
+            self.refreshGroupsPQuotasCounters("printerid IN (%s) AND groupid IN (SELECT groupid FROM groupsmembers WHERE userid IN (%s))" \
+                                                 % (printerids, userids))
+            for p in printers :
+                for u in users :
+                    self.flushEntry("USERPQUOTAS", "%s@%s" % (u.Name, p.Name))
+                self.flushEntry("LASTJOBS", p.Name)
             
     def deleteManyGroupPQuotas(self, printers, groups) :
         """Deletes many group print quota entries."""
@@ -918,6 +1185,9 @@ class SQLStorage :
             self.multipleQueriesInTransaction([ 
                     "DELETE FROM grouppquota WHERE groupid IN (%s) AND printerid IN (%s)" \
                                  % (groupids, printerids),])
+            for p in printers :
+                for g in groups :
+                    self.flushEntry("GROUPPQUOTAS", "%s@%s" % (g.Name, p.Name))
         
     def deleteUserPQuota(self, upquota) :    
         """Completely deletes an user print quota entry from the database."""
@@ -927,6 +1197,8 @@ class SQLStorage :
                     "DELETE FROM userpquota WHERE id=%s" % self.doQuote(upquota.ident),
                   ] :
             self.doModify(q)
+        self.refreshGroupsPQuotasCounters("printerid=%s AND groupid IN (SELECT groupid FROM groupsmembers WHERE userid=%s)", \
+                                          (upquota.Printer.ident, upquota.User.ident))
         
     def deleteGroupPQuota(self, gpquota) :    
         """Completely deletes a group print quota entry from the database."""
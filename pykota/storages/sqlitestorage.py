@@ -27,6 +27,8 @@
 import time
 
 from pykota.storage import PyKotaStorageError, BaseStorage
+from pykota import metrics
+from pykota.latency import recordSpan
 from pykota.storages.sql import SQLStorage
 
 try :
@@ -40,6 +42,7 @@ class Storage(BaseStorage, SQLStorage) :
     def __init__(self, pykotatool, host, dbname, user, passwd) :
         """Opens the SQLite database connection."""
         BaseStorage.__init__(self, pykotatool)
+        SQLStorage.__init__(self)
         
         self.tool.logdebug("Trying to open database (dbname=%s)..." % dbname)
         self.database = sqlite.connect(dbname, isolation_level=None)
@@ -50,6 +53,8 @@ class Storage(BaseStorage, SQLStorage) :
     def close(self) :    
         """Closes the database connection."""
         if not self.closed :
+            self.dumpCacheStatistics()
+            self.dumpStatementStatistics()
             self.cursor.close()
             self.database.close()
             self.closed = 1
@@ -59,42 +64,76 @@ class Storage(BaseStorage, SQLStorage) :
         """Starts a transaction."""
         self.before = time.time()
         self.cursor.execute("BEGIN;")
+        self.deferInvalidations()
         self.tool.logdebug("Transaction begins...")
         
     def commitTransaction(self) :    
         """Commits a transaction."""
         self.cursor.execute("COMMIT;")
+        self.writeInvalidations()
         after = time.time()
         self.tool.logdebug("Transaction committed.")
-        #self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
+        recordSpan(self.tool, "transaction", self.before, after)
         
     def rollbackTransaction(self) :     
         """Rollbacks a transaction."""
         self.cursor.execute("ROLLBACK;")
+        self.dropInvalidations()
         after = time.time()
         self.tool.logdebug("Transaction aborted.")
-        #self.tool.logdebug("Transaction duration : %.4f seconds" % (after - self.before))
+        recordSpan(self.tool, "transaction", self.before, after)
         
-    def doRawSearch(self, query) :
-        """Does a raw search query."""
+    def prepareStatement(self, query) :
+        """Returns the query with PySQLite's placeholders.
+
+           PySQLite keeps the compiled statements in its own cache,
+           keyed by their text, so they are reused as long as the
+           parameters are not inlined.
+        """
+        query = query.strip()
+        if not query.endswith(';') :
+            query += ';'
+        return query.replace("%s", "?")
+
+    def bindParameters(self, parameters) :
+        """Converts the parameters to the types PySQLite expects."""
+        values = []
+        for value in parameters :
+            if type(value) == type("") :
+                value = value.decode("UTF-8")
+            values.append(value)
+        return values
+
+    def execute(self, query, parameters) :
+        """Executes a query, with bound parameters if given."""
+        if parameters is None :
+            self.cursor.execute(query)
+        else :
+            self.cursor.execute(query, self.bindParameters(parameters))
+
+    def doRawSearch(self, query, parameters=None) :
+        """Does a raw search query, with bound parameters if given."""
+        if parameters is not None :
+            query = self.getPreparedStatement(query)
         query = query.strip()    
         if not query.endswith(';') :    
             query += ';'
         try :
             before = time.time()
             self.tool.logdebug("QUERY : %s" % query)
-            self.cursor.execute(query)
+            self.execute(query, parameters)
         except self.database.Error, msg :    
             raise PyKotaStorageError, str(msg)
         else :    
             result = self.cursor.fetchall()
             after = time.time()
-            #self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            recordSpan(self.tool, "query", before, after)
+            metrics.observe("pykota_storage_query_seconds", after - before)
             return result
             
-    def doSearch(self, query) :        
-        """Does a search query."""
-        result = self.doRawSearch(query)
+    def doSearch(self, query, parameters=None) :        
+        """Does a search query, with bound parameters if given."""
+        result = self.doRawSearch(query, parameters)
         if result : 
             rows = []
             fields = {}
@@ -112,21 +151,24 @@ class Storage(BaseStorage, SQLStorage) :
                 rows.append(rowdict)    
             return rows    
         
-    def doModify(self, query) :
-        """Does a (possibly multiple) modify query."""
+    def doModify(self, query, parameters=None) :
+        """Does a (possibly multiple) modify query, with bound parameters if given."""
+        if parameters is not None :
+            query = self.getPreparedStatement(query)
         query = query.strip()    
         if not query.endswith(';') :    
             query += ';'
         try :
             before = time.time()
             self.tool.logdebug("QUERY : %s" % query)
-            self.cursor.execute(query)
+            self.execute(query, parameters)
         except self.database.Error, msg :    
             self.tool.logdebug("Query failed : %s" % repr(msg))
             raise PyKotaStorageError, str(msg)
         else :    
             after = time.time()
-            #self.tool.logdebug("Query Duration : %.4f seconds" % (after - before))
+            recordSpan(self.tool, "query", before, after)
+            metrics.observe("pykota_storage_query_seconds", after - before)
             
     def doQuote(self, field) :
         """Quotes a field for use as a string in SQL queries."""
@@ -141,18 +183,46 @@ class Storage(BaseStorage, SQLStorage) :
         else :     
             return "NULL"
             
-    def prepareRawResult(self, result) :
-        """Prepares a raw result by including the headers."""
-        if result :
-            entries = [tuple([f[0] for f in self.cursor.description])]
-            for entry in result :    
-                row = []
-                for value in entry :
-                    try :
-                        value = value.encode("UTF-8")
-                    except :
-                        pass
-                    row.append(value)
-                entries.append(tuple(row))    
-            return entries   
+    def openCursor(self, query) :
+        """Runs a search query on a cursor of its own, and returns this cursor."""
+        query = query.strip()
+        if not query.endswith(';') :
+            query += ';'
+        cursor = self.database.cursor()
+        try :
+            self.tool.logdebug("QUERY : %s" % query)
+            cursor.execute(query)
+        except self.database.Error, msg :
+            cursor.close()
+            raise PyKotaStorageError, str(msg)
+        return cursor
+
+    def fetchBatch(self, cursor) :
+        """Returns the next batch of rows of a search, or an empty list at its end."""
+        try :
+            return cursor.fetchmany(self.fetchsize)
+        except self.database.Error, msg :
+            raise PyKotaStorageError, str(msg)
+
+    def cursorFields(self, cursor) :
+        """Returns the field names of a search."""
+        return tuple([f[0] for f in cursor.description])
+
+    def closeCursor(self, cursor) :
+        """Frees a search's cursor."""
+        cursor.close()
+
+    def prepareRawRows(self, rows) :
+        """Converts a batch of rows, encoding strings to UTF-8."""
+        entries = []
+        for entry in rows :
+            row = []
+            for value in entry :
+                try :
+                    value = value.encode("UTF-8")
+                except :
+                    pass
+                row.append(value)
+            entries.append(tuple(row))
+        return entries
         
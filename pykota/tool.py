@@ -51,7 +51,7 @@ else :
         """Uses the chardet module to workaround CUPS lying to us."""
         return chardet.detect(text)["encoding"] or "UTF-8"
 
-from pykota import config, storage, logger
+from pykota import config, storage, logger, metrics
 from pykota.version import __version__, __author__, __years__, __gplblurb__
 
 def N_(message) :
@@ -166,8 +166,8 @@ class Tool :
         # pykota specific stuff
         self.documentation = doc
         
-    def deferredInit(self) :        
-        """Deferred initialization."""
+    def findConfigDirectory(self) :
+        """Returns the directory containing the configuration files, and if it came from PYKOTA_HOME or if the 'pykota' account is missing."""
         confdir = os.environ.get("PYKOTA_HOME")
         environHome = True
         missingUser = False
@@ -181,12 +181,25 @@ class Tool :
                 self.pykotauser = None
                 confdir = "/etc/pykota"
                 missingUser = True
-            
+        return (confdir, environHome, missingUser)
+        
+    def deferredInit(self) :        
+        """Deferred initialization."""
+        (confdir, environHome, missingUser) = self.findConfigDirectory()
         self.config = config.PyKotaConfig(confdir)
         self.debug = self.config.getDebug()
         self.smtpserver = self.config.getSMTPServer()
         self.maildomain = self.config.getMailDomain()
-        self.logger = logger.openLogger(self.config.getLoggingBackend())
+        loggingbackend = self.config.getLoggingBackend()
+        if loggingbackend == "batch" :
+            self.logger = logger.openLogger(loggingbackend, \
+                                            self.config.getLoggerOutput(), \
+                                            self.config.getLoggerFlushDelay())
+        else :    
+            self.logger = logger.openLogger(loggingbackend)
+        metricsfile = self.config.getMetricsFile()
+        if metricsfile :
+            metrics.openMetrics(metricsfile)
             
         # now drop priviledge if possible
         self.dropPriv()    
@@ -287,9 +300,15 @@ class Tool :
             sys.stdout.write(message)
             sys.stdout.flush()
             
-    def logdebug(self, message) :    
-        """Logs something to debug output if debug is enabled."""
+    def logdebug(self, message, *arguments) :    
+        """Logs something to debug output if debug is enabled.
+        
+           The message is formatted with the arguments, if any, only
+           when it is really logged.
+        """
         if self.debug :
+            if arguments :
+                message = message % arguments
             self.logger.log_message(message, "debug")
             
     def printInfo(self, message, level="info") :        
@@ -512,8 +531,13 @@ class PyKotaTool(Tool) :
         msg["To"] = adminmail
         self.sendMessage(adminmail, adminmail, msg.as_string())
         
-    def _checkUserPQuota(self, userpquota) :            
-        """Checks the user quota on a printer and deny or accept the job."""
+    def _checkUserPQuota(self, userpquota, jobsize=None) :            
+        """Checks the user quota on a printer and deny or accept the job.
+        
+           jobsize is the precomputed job's size, self.softwareJobSize by default.
+        """
+        if jobsize is None :
+            jobsize = self.softwareJobSize
         # then we check the user's own quota
         # if we get there we are sure that policy is not EXTERNAL
         user = userpquota.User
@@ -531,7 +555,7 @@ class PyKotaTool(Tool) :
         else :    
             pagecounter = int(userpquota.PageCounter or 0)
             if enforcement == "STRICT" :
-                pagecounter += self.softwareJobSize
+                pagecounter += jobsize
             if userpquota.SoftLimit is not None :
                 softlimit = int(userpquota.SoftLimit)
                 if pagecounter < softlimit :
@@ -568,8 +592,16 @@ class PyKotaTool(Tool) :
                     action = "ALLOW"
         return action
     
-    def checkGroupPQuota(self, grouppquota) :    
-        """Checks the group quota on a printer and deny or accept the job."""
+    def checkGroupPQuota(self, grouppquota, jobsize=None, jobprice=None) :    
+        """Checks the group quota on a printer and deny or accept the job.
+        
+           jobsize and jobprice are the precomputed job's size and price,
+           self.softwareJobSize and self.softwareJobPrice by default.
+        """
+        if jobsize is None :
+            jobsize = self.softwareJobSize
+        if jobprice is None :
+            jobprice = self.softwareJobPrice
         group = grouppquota.Group
         printer = grouppquota.Printer
         enforcement = self.config.getPrinterEnforcement(printer.Name)
@@ -577,7 +609,7 @@ class PyKotaTool(Tool) :
         if group.LimitBy and (group.LimitBy.lower() == "balance") : 
             val = group.AccountBalance or 0.0
             if enforcement == "STRICT" : 
-                val -= self.softwareJobPrice # use precomputed size.
+                val -= jobprice # use precomputed size.
             balancezero = self.config.getBalanceZero()
             if val <= balancezero :
                 action = "DENY"
@@ -590,7 +622,7 @@ class PyKotaTool(Tool) :
         else :
             val = grouppquota.PageCounter or 0
             if enforcement == "STRICT" :
-                val += int(self.softwareJobSize) # TODO : this is not a fix, problem is elsewhere in grouppquota.PageCounter
+                val += int(jobsize) # TODO : this is not a fix, problem is elsewhere in grouppquota.PageCounter
             if grouppquota.SoftLimit is not None :
                 softlimit = int(grouppquota.SoftLimit)
                 if val < softlimit :
@@ -627,8 +659,16 @@ class PyKotaTool(Tool) :
                     action = "ALLOW"
         return action
     
-    def checkUserPQuota(self, userpquota) :
-        """Checks the user quota on a printer and all its parents and deny or accept the job."""
+    def checkUserPQuota(self, userpquota, jobsize=None, jobprice=None) :
+        """Checks the user quota on a printer and all its parents and deny or accept the job.
+        
+           jobsize and jobprice are the precomputed job's size and price,
+           self.softwareJobSize and self.softwareJobPrice by default.
+        """
+        if jobsize is None :
+            jobsize = self.softwareJobSize
+        if jobprice is None :
+            jobprice = self.softwareJobPrice
         user = userpquota.User
         printer = userpquota.Printer
         
@@ -643,7 +683,7 @@ class PyKotaTool(Tool) :
                 # for the printer and all its parents
                 for gpquota in [ grouppquota ] + grouppquota.ParentPrintersGroupPQuota :
                     if gpquota.Exists :
-                        action = self.checkGroupPQuota(gpquota)
+                        action = self.checkGroupPQuota(gpquota, jobsize, jobprice)
                         if action == "DENY" :
                             return action
                         elif action == "WARN" :    
@@ -669,7 +709,7 @@ class PyKotaTool(Tool) :
                     val = float(user.AccountBalance or 0.0)
                     enforcement = self.config.getPrinterEnforcement(printer.Name)
                     if enforcement == "STRICT" : 
-                        val -= self.softwareJobPrice # use precomputed size.
+                        val -= jobprice # use precomputed size.
                     balancezero = self.config.getBalanceZero()    
                     if val <= balancezero :
                         action = "DENY"
@@ -684,7 +724,7 @@ class PyKotaTool(Tool) :
             # Then check the user quota on current printer and all its parents.                
             policyallowed = 0
             for upquota in [ userpquota ] + userpquota.ParentPrintersUserPQuota :               
-                action = self._checkUserPQuota(upquota)
+                action = self._checkUserPQuota(upquota, jobsize)
                 if action in ("DENY", "POLICY_DENY") :
                     return action
                 elif action == "WARN" :    
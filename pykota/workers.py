@@ -0,0 +1,359 @@
+# PyKota
+# -*- coding: ISO-8859-15 -*-
+#
+# PyKota : Print Quotas for CUPS and LPRng
+#
+# (c) 2003, 2004, 2005, 2006, 2007 Jerome Alet <alet@librelogiciel.com>
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# $Id$
+#
+#
+
+"""This module runs functions and external commands in child processes."""
+
+import sys
+import os
+import time
+import errno
+import fcntl
+import select
+import signal
+import marshal
+
+READSIZE = 65536
+KILLDELAY = 2.0 # seconds given to a command to exit after SIGTERM, before SIGKILL
+
+class PyKotaWorkerError(Exception):
+    """An exception for external commands related stuff."""
+    def __init__(self, message = ""):
+        self.message = message
+        Exception.__init__(self, message)
+    def __repr__(self):
+        return self.message
+    __str__ = __repr__
+
+def cpuCount() :
+    """Returns the number of processors, or 1 if unknown."""
+    try :
+        return max(1, int(os.sysconf("SC_NPROCESSORS_ONLN")))
+    except (AttributeError, ValueError, OSError) :
+        return 1
+
+class Worker :
+    """A function running in a child process.
+
+       The function's result is sent back to the parent process
+       with marshal, so it must only contain simple types.
+    """
+    def __init__(self, function, args) :
+        """Forks a child process to call function(*args)."""
+        (self.readfd, writefd) = os.pipe()
+        self.pid = os.fork()
+        if not self.pid :
+            try :
+                os.close(self.readfd)
+                try :
+                    result = ("OK", function(*args))
+                except :
+                    result = ("ERROR", "%s" % sys.exc_info()[1])
+                try :
+                    data = marshal.dumps(result)
+                except ValueError :
+                    data = marshal.dumps(("ERROR", "Unexpected result type"))
+                while data :
+                    data = data[os.write(writefd, data):]
+            finally :
+                os._exit(0)
+        os.close(writefd)
+        self.chunks = []
+        self.finished = False
+
+    def fileno(self) :
+        """Returns the file descriptor the result is read from."""
+        return self.readfd
+
+    def read(self) :
+        """Reads what is available of the result."""
+        chunk = os.read(self.readfd, READSIZE)
+        if chunk :
+            self.chunks.append(chunk)
+        else :
+            self.finished = True
+            os.close(self.readfd)
+            os.waitpid(self.pid, 0)
+
+    def result(self) :
+        """Returns (status, value), status being OK or ERROR."""
+        try :
+            return marshal.loads("".join(self.chunks))
+        except (ValueError, EOFError, TypeError) :
+            return ("ERROR", "Worker process %s died" % self.pid)
+
+    def kill(self) :
+        """Kills the child process."""
+        try :
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError :
+            pass
+        os.close(self.readfd)
+        os.waitpid(self.pid, 0)
+
+def runWorkers(calls, maxworkers=None, timeout=0) :
+    """Calls functions in at most maxworkers child processes at once.
+
+       calls is a list of (function, args) tuples. Returns the list of
+       their (status, value) results, status being OK, ERROR or TIMEOUT
+       if the function wasn't done after timeout seconds, 0 meaning
+       no timeout.
+    """
+    maxworkers = maxworkers or cpuCount()
+    if timeout :
+        deadline = time.time() + timeout
+    else :
+        deadline = None
+    results = [("TIMEOUT", None)] * len(calls)
+    waiting = range(len(calls))
+    waiting.reverse()
+    running = {}
+    try :
+        while waiting or running :
+            while waiting and (len(running) < maxworkers) :
+                index = waiting.pop()
+                (function, args) = calls[index]
+                running[Worker(function, args)] = index
+            if deadline is None :
+                remaining = None
+            else :
+                remaining = deadline - time.time()
+                if remaining <= 0 :
+                    break
+            try :
+                (readable, writable, errors) = select.select(running.keys(), [], [], remaining)
+            except select.error, (err, msg) :
+                if err == errno.EINTR :
+                    continue
+                raise
+            for worker in readable :
+                worker.read()
+                if worker.finished :
+                    results[running.pop(worker)] = worker.result()
+    finally :
+        for worker in running.keys() :
+            worker.kill()
+    return results
+
+def spawnCommand(commandline) :
+    """Launches a shell command, returns (pid, fd to its stdin, fd to its stdout and stderr)."""
+    (childin, towrite) = os.pipe()
+    (toread, childout) = os.pipe()
+    pid = os.fork()
+    if not pid :
+        try :
+            os.dup2(childin, 0)
+            os.dup2(childout, 1)
+            os.dup2(childout, 2)
+            for fd in (childin, towrite, toread, childout) :
+                os.close(fd)
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            os.execv("/bin/sh", ["/bin/sh", "-c", commandline])
+        finally :
+            os._exit(127)
+    os.close(childin)
+    os.close(childout)
+    return (pid, towrite, toread)
+
+def terminate(pid) :
+    """Asks a child process to exit, kills it if it doesn't, and returns its exit status."""
+    try :
+        os.kill(pid, signal.SIGTERM)
+    except OSError :
+        pass
+    deadline = time.time() + KILLDELAY
+    while time.time() < deadline :
+        (wpid, status) = os.waitpid(pid, os.WNOHANG)
+        if wpid :
+            return status
+        time.sleep(0.05)
+    try :
+        os.kill(pid, signal.SIGKILL)
+    except OSError :
+        pass
+    return os.waitpid(pid, 0)[1]
+
+class Command :
+    """An external command fed with datas while its output is read.
+
+       Its standard input is written to and its standard output
+       and error are read at the same time, so commands which print
+       while reading can't block us.
+    """
+    def __init__(self, commandline) :
+        """Initializes the command."""
+        self.commandline = commandline
+        self.pid = None
+        self.output = ""
+        self.status = None
+        self.elapsed = None
+        self.timedout = False
+        self.interrupted = False
+        self.feederror = None
+
+    def run(self, infile=None, timeout=0, stopped=None) :
+        """Runs the command and returns its exit status as given by os.waitpid().
+
+           The command is fed with infile's content, if any. It is
+           terminated if it isn't done after timeout seconds, 0 meaning
+           no timeout, or as soon as stopped(), if any, returns True.
+        """
+        started = time.time()
+        if timeout :
+            deadline = started + timeout
+        else :
+            deadline = None
+        (self.pid, towrite, toread) = spawnCommand(self.commandline)
+        if infile is None :
+            os.close(towrite)
+            towrite = None
+        else :
+            fcntl.fcntl(towrite, fcntl.F_SETFL, fcntl.fcntl(towrite, fcntl.F_GETFL) | os.O_NONBLOCK)
+        pending = ""
+        chunks = []
+        try :
+            while toread is not None :
+                if (stopped is not None) and stopped() :
+                    self.interrupted = True
+                    break
+                if deadline is None :
+                    remaining = None
+                else :
+                    remaining = deadline - time.time()
+                    if remaining <= 0 :
+                        self.timedout = True
+                        break
+                if (towrite is not None) and not pending :
+                    pending = infile.read(READSIZE)
+                    if not pending :
+                        os.close(towrite)
+                        towrite = None
+                writers = [fd for fd in (towrite,) if fd is not None]
+                try :
+                    (readable, writable, errors) = select.select([toread], writers, [], remaining)
+                except select.error, (err, msg) :
+                    if err == errno.EINTR :
+                        continue # signal received, check if we must stop
+                    raise
+                if writable :
+                    try :
+                        pending = pending[os.write(towrite, pending):]
+                    except OSError, msg :
+                        if msg.errno != errno.EAGAIN :
+                            # the command doesn't want more datas
+                            self.feederror = msg
+                            pending = ""
+                            os.close(towrite)
+                            towrite = None
+                if readable :
+                    chunk = os.read(toread, READSIZE)
+                    if chunk :
+                        chunks.append(chunk)
+                    else :
+                        os.close(toread)
+                        toread = None
+        finally :
+            if towrite is not None :
+                os.close(towrite)
+            if toread is not None :
+                os.close(toread)
+                self.status = terminate(self.pid)
+            else :
+                self.status = os.waitpid(self.pid, 0)[1]
+            self.output = "".join(chunks)
+            self.elapsed = time.time() - started
+        return self.status
+
+    def exitCode(self) :
+        """Returns the command's exit code, or its exit status if it was killed."""
+        if (self.status is not None) and os.WIFEXITED(self.status) :
+            return os.WEXITSTATUS(self.status)
+        return self.status
+
+def runCommand(commandline, infile=None, timeout=0, stopped=None) :
+    """Runs an external command, and returns the Command instance once it is done."""
+    command = Command(commandline)
+    command.run(infile, timeout, stopped)
+    return command
+
+class CoProcess :
+    """A long running external command answering one line for each line it's sent."""
+    def __init__(self, commandline) :
+        """Launches the command."""
+        self.commandline = commandline
+        (self.pid, self.towrite, self.toread) = spawnCommand(commandline)
+        self.buffer = ""
+        self.queries = 0
+        self.elapsed = 0.0
+
+    def query(self, line, timeout=0) :
+        """Sends a line to the command and returns its answer, without the end of line."""
+        if self.pid is None :
+            raise PyKotaWorkerError, "Command %s is not running" % self.commandline
+        started = time.time()
+        try :
+            data = line + "\n"
+            while data :
+                data = data[os.write(self.towrite, data):]
+            while "\n" not in self.buffer :
+                if timeout :
+                    remaining = started + timeout - time.time()
+                    if remaining <= 0 :
+                        raise PyKotaWorkerError, "No answer from %s after %s seconds" % (self.commandline, timeout)
+                else :
+                    remaining = None
+                try :
+                    (readable, writable, errors) = select.select([self.toread], [], [], remaining)
+                except select.error, (err, msg) :
+                    if err == errno.EINTR :
+                        continue
+                    raise
+                if readable :
+                    chunk = os.read(self.toread, READSIZE)
+                    if not chunk :
+                        raise PyKotaWorkerError, "Command %s exited" % self.commandline
+                    self.buffer += chunk
+        except (OSError, PyKotaWorkerError), msg :
+            self.close()
+            raise PyKotaWorkerError, str(msg)
+        (answer, self.buffer) = self.buffer.split("\n", 1)
+        self.queries += 1
+        self.elapsed += time.time() - started
+        return answer.strip()
+
+    def close(self) :
+        """Stops the command."""
+        if self.pid is not None :
+            os.close(self.towrite)
+            os.close(self.toread)
+            terminate(self.pid)
+            self.pid = None
+
+coprocesses = {}
+
+def getCoProcess(commandline) :
+    """Returns the co-process running a command, launching it if needed."""
+    coprocess = coprocesses.get(commandline)
+    if (coprocess is None) or (coprocess.pid is None) :
+        coprocess = coprocesses[commandline] = CoProcess(commandline)
+    return coprocess
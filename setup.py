@@ -130,6 +130,7 @@ setup(name = "pykota", version = __version__,
                   "bin/pkrefund", "bin/pkturnkey", "bin/pkbcodes", "bin/pkmail", \
                   "bin/pkbanner", "bin/autopykota", "bin/dumpykota", \
                   "bin/pykosd", "bin/edpykota", "bin/repykota", \
-                  "bin/warnpykota", "bin/pykotme", "bin/pkprinters" ],
+                  "bin/warnpykota", "bin/pykotme", "bin/pkprinters", \
+                  "bin/pykotad", "bin/pkcounters" ],
       data_files = data_files,
       cmdclass = { "install_data" : MyInstallData })